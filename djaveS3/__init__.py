@@ -0,0 +1 @@
+default_app_config = 'djaveS3.apps.FilesConfig'
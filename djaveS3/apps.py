@@ -1,5 +1,25 @@
 from django.apps import AppConfig
+from django.conf import settings
+from django.core.signals import setting_changed
 
 
 class FilesConfig(AppConfig):
-    name = 'photos'
+  name = 'djaveS3'
+
+  def ready(self):
+    from djaveS3.get_bucket_config import load_bucket_configs
+    # Check S3_BUCKETS right away so mistakes show up at startup instead of
+    # in the middle of a request.
+    if hasattr(settings, 'S3_BUCKETS'):
+      load_bucket_configs()
+    setting_changed.connect(_s3_buckets_changed)
+
+
+def _s3_buckets_changed(setting, **kwargs):
+  if setting == 'S3_BUCKETS':
+    from djaveS3.get_bucket_config import (
+        forget_bucket_configs, reload_bucket_configs)
+    if hasattr(settings, 'S3_BUCKETS'):
+      reload_bucket_configs()
+    else:
+      forget_bucket_configs()
@@ -1,4 +1,32 @@
-""" boto3 does the heavy lifting of talking with S3. """
+""" boto3 does the heavy lifting of talking with S3.
+
+Building a boto3 client is surprisingly expensive. It loads service models off
+disk, sets up an event system, and every client gets its own urllib3
+connection pool. So I keep one client per (access_key_id, secret_access_key,
+region_name, endpoint_url) for the life of the process. boto3 clients are
+thread safe, so all the threads in a process can share them.
+
+You can tune the clients in your settings.py:
+
+S3_REGION_NAME = 'us-east-2'
+S3_MAX_POOL_CONNECTIONS = 50  # Connections kept open per client
+S3_CONNECT_TIMEOUT = 5  # Seconds
+S3_READ_TIMEOUT = 60  # Seconds
+S3_RETRY_MODE = 'standard'  # 'legacy', 'standard' or 'adaptive'
+S3_MAX_ATTEMPTS = 3
+
+When credentials rotate, call forget_boto_clients or refresh_boto_client so
+the old clients don't hang around.
+
+AsyncBucket uses aiobotocore clients instead, which you get with
+get_async_boto_client. pip install aiobotocore if you want those. An
+aiobotocore client belongs to the event loop that created it, so those get
+cached per (credentials, region, endpoint, event loop). """
+import asyncio
+from collections import namedtuple
+import threading
+import time
+
 import boto3
 import botocore
 from django.conf import settings
@@ -7,16 +35,185 @@ from django.conf import settings
 s3_region_name = getattr(settings, 'S3_REGION_NAME', 'us-east-2')
 
 
-# You need signature_version='s3v4' to avoid "The authorization mechanism you
-# have provided is not supported. Please use AWS4-HMAC-SHA256
-_s3_config = botocore.client.Config(
-    signature_version='s3v4',
-    region_name=s3_region_name)
+def _s3_config_kwargs(region_name):
+  # You need signature_version='s3v4' to avoid "The authorization mechanism
+  # you have provided is not supported. Please use AWS4-HMAC-SHA256
+  return {
+      'signature_version': 's3v4',
+      'region_name': region_name,
+      'max_pool_connections': getattr(settings, 'S3_MAX_POOL_CONNECTIONS', 50),
+      'connect_timeout': getattr(settings, 'S3_CONNECT_TIMEOUT', 5),
+      'read_timeout': getattr(settings, 'S3_READ_TIMEOUT', 60),
+      'retries': {
+          'mode': getattr(settings, 'S3_RETRY_MODE', 'standard'),
+          'max_attempts': getattr(settings, 'S3_MAX_ATTEMPTS', 3)}}
+
+
+BotoClientStats = namedtuple(
+    'BotoClientStats', 'hits misses cached construction_seconds')
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+_stats_lock = threading.Lock()
+_hits = 0
+_misses = 0
+_construction_seconds = 0.0
+
+
+def get_boto_client(
+    access_key_id, secret_access_key, region_name=None, endpoint_url=None):
+  global _hits, _misses, _construction_seconds
+  key = _client_key(
+      access_key_id, secret_access_key, region_name, endpoint_url)
+  # Fast path. Dict reads are atomic so there's no need to lock here.
+  client = _clients.get(key)
+  if client is not None:
+    with _stats_lock:
+      _hits += 1
+    return client
+  with _clients_lock:
+    # Another thread may have built it while I was waiting for the lock.
+    client = _clients.get(key)
+    if client is not None:
+      with _stats_lock:
+        _hits += 1
+      return client
+    started = time.perf_counter()
+    client = _new_boto_client(*key)
+    with _stats_lock:
+      _construction_seconds += time.perf_counter() - started
+      _misses += 1
+    _clients[key] = client
+    return client
+
+
+def refresh_boto_client(
+    access_key_id, secret_access_key, region_name=None, endpoint_url=None):
+  """ Throw out the cached client for these credentials and build a new one.
+  """
+  forget_boto_clients(access_key_id, region_name, endpoint_url)
+  return get_boto_client(
+      access_key_id, secret_access_key, region_name=region_name,
+      endpoint_url=endpoint_url)
+
+
+def forget_boto_clients(
+    access_key_id=None, region_name=None, endpoint_url=None):
+  """ Drop cached clients. With no arguments, drop everything. Otherwise drop
+  the clients that match whatever you did specify. Returns how many clients got
+  dropped. """
+  def matches(key):
+    return (
+        (access_key_id is None or key[0] == access_key_id)
+        and (region_name is None or key[2] == region_name)
+        and (endpoint_url is None or key[3] == endpoint_url))
+  # Async clients can only be closed from their own event loop, so they just
+  # get set aside here, and close_async_boto_clients closes them.
+  with _async_clients_lock:
+    for key in [key for key in _async_clients if matches(key)]:
+      _dropped_async_clients.append((key[4], _async_clients.pop(key)))
+  with _clients_lock:
+    doomed = [key for key in _clients if matches(key)]
+    for key in doomed:
+      del _clients[key]
+    return len(doomed)
+
 
+def boto_client_stats():
+  return BotoClientStats(
+      hits=_hits, misses=_misses, cached=len(_clients),
+      construction_seconds=_construction_seconds)
 
-def get_boto_client(access_key_id, secret_access_key):
+
+def reset_boto_client_stats():
+  global _hits, _misses, _construction_seconds
+  with _stats_lock:
+    _hits = 0
+    _misses = 0
+    _construction_seconds = 0.0
+
+
+def _client_key(access_key_id, secret_access_key, region_name, endpoint_url):
+  return (
+      access_key_id, secret_access_key, region_name or s3_region_name,
+      endpoint_url or None)
+
+
+def _new_boto_client(
+    access_key_id, secret_access_key, region_name, endpoint_url):
   return boto3.client(
       's3',
       aws_access_key_id=access_key_id,
       aws_secret_access_key=secret_access_key,
-      config=_s3_config)
+      endpoint_url=endpoint_url,
+      config=botocore.client.Config(**_s3_config_kwargs(region_name)))
+
+
+# (credentials, region, endpoint, event loop) -> Task that makes the client
+_async_clients = {}
+# [(event loop, Task)] for clients forget_boto_clients dropped, which still
+# need closing.
+_dropped_async_clients = []
+# forget_boto_clients can get called from any thread, not just the one running
+# the event loop.
+_async_clients_lock = threading.Lock()
+
+
+async def get_async_boto_client(
+    access_key_id, secret_access_key, region_name=None, endpoint_url=None):
+  loop = asyncio.get_running_loop()
+  key = _client_key(
+      access_key_id, secret_access_key, region_name, endpoint_url) + (loop,)
+  with _async_clients_lock:
+    if key not in _async_clients:
+      # Everybody who asks while the client is getting built waits on the same
+      # Task, so there's only ever one client per key.
+      _async_clients[key] = loop.create_task(
+          _new_async_boto_client(*key[:4]))
+    task = _async_clients[key]
+  try:
+    return await task
+  except Exception:
+    with _async_clients_lock:
+      if _async_clients.get(key) is task:
+        del _async_clients[key]
+    raise
+
+
+async def close_async_boto_clients():
+  """ Close the async clients that belong to the running event loop. Call this
+  before the loop shuts down. """
+  loop = asyncio.get_running_loop()
+  with _async_clients_lock:
+    tasks = [
+        _async_clients.pop(key) for key in list(_async_clients)
+        if key[4] is loop]
+    tasks.extend(
+        task for task_loop, task in _dropped_async_clients
+        if task_loop is loop)
+    _dropped_async_clients[:] = [
+        (task_loop, task) for task_loop, task in _dropped_async_clients
+        if task_loop is not loop]
+  for task in tasks:
+    if task.done() and not task.cancelled() and not task.exception():
+      await task.result().close()
+
+
+async def _new_async_boto_client(
+    access_key_id, secret_access_key, region_name, endpoint_url):
+  try:
+    from aiobotocore.config import AioConfig
+    from aiobotocore.session import get_session
+  except ImportError:
+    raise Exception('pip install aiobotocore to talk to S3 asynchronously')
+  client_context = get_session().create_client(
+      's3',
+      aws_access_key_id=access_key_id,
+      aws_secret_access_key=secret_access_key,
+      endpoint_url=endpoint_url,
+      config=AioConfig(**_s3_config_kwargs(region_name)))
+  # The context manager just builds the client on the way in and closes it on
+  # the way out. I keep the client around for good, and
+  # close_async_boto_clients closes it.
+  return await client_context.__aenter__()
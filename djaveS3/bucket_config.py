@@ -23,17 +23,93 @@ S3_BUCKETS = [
 
 This configuration is basically so we know how to view an image given a bucket
 name and a file name.
+
+region_name and endpoint_url are optional. Leave them out to use
+settings.S3_REGION_NAME and Amazon's own endpoint. endpoint_url is handy for
+S3 compatible services.
+
+transfer_profile is an optional TransferProfile which says how Bucket.upload
+and Bucket.download move big files. Files bigger than multipart_threshold bytes
+get split into multipart_chunksize byte parts, and up to max_concurrency parts
+move at once if use_threads.
+
+backend says where files actually go. It's S3_BACKEND by default. You can use
+LOCAL_BACKEND to keep files in local_root on local disk, or MEMORY_BACKEND to
+keep files in memory. See djaveS3.storage_backends
+
+public_domain and addressing_style say where public files get linked to. Put
+a CDN like CloudFront in front of a public bucket and set public_domain to
+'cdn.example.com', or 'https://cdn.example.com/some/path/', and public file
+urls point there instead of at S3. Without a public_domain, urls point straight
+at S3, at https://bucket.s3.amazonaws.com/ by default, or at
+https://s3.amazonaws.com/bucket/ if addressing_style is PATH_ADDRESSING. Path
+style is what a lot of S3 compatible services at an endpoint_url want.
+
+image_encoding is an optional ImageEncoding which says how resized photos get
+saved. quality 100 makes about the biggest JPEG there is for no visible gain
+over 85, so the default is 85, progressive and optimized, with the usual 4:2:0
+chroma subsampling. alternate_formats is a list of content types from
+ALTERNATE_IMAGE_TYPES in djaveS3.file_types, and resized photos get a copy in
+each of those formats too, if your Pillow can write them. Browsers that say
+they take them get those instead. See Photo.image_encoding in
+djaveS3.models.photo
 """
 from collections import namedtuple
 import json
+from urllib.parse import urlsplit
 
 from django.utils.safestring import mark_safe
 
 
-FIELDS = 'name access_key_id secret_access_key is_public max_width_or_height'
+FIELDS = (
+    'name access_key_id secret_access_key is_public max_width_or_height '
+    'region_name endpoint_url transfer_profile backend local_root '
+    'public_domain addressing_style image_encoding')
+S3_BACKEND = 's3'
+LOCAL_BACKEND = 'local'
+MEMORY_BACKEND = 'memory'
+VIRTUAL_ADDRESSING = 'virtual'
+PATH_ADDRESSING = 'path'
+DEFAULTS = (
+    None, None, None, S3_BACKEND, None, None, VIRTUAL_ADDRESSING, None)
+
+
+MB = 1024 * 1024
+TRANSFER_FIELDS = (
+    'multipart_threshold multipart_chunksize max_concurrency use_threads')
+
+
+class TransferProfile(namedtuple(
+    'TransferProfile', TRANSFER_FIELDS, defaults=(8 * MB, 8 * MB, 10, True))):
+  pass
+
+
+ENCODING_FIELDS = (
+    'quality progressive optimize subsampling alternate_formats')
+
+
+class ImageEncoding(namedtuple(
+    'ImageEncoding', ENCODING_FIELDS, defaults=(85, True, True, '4:2:0', ()))):
+  pass
+
 
+class BucketConfig(namedtuple('BucketConfig', FIELDS, defaults=DEFAULTS)):
+  def public_url_root(self):
+    """ Public files live at this plus the file name. See public_file_url in
+    djaveS3.public_file_url """
+    if self.public_domain:
+      if '://' in self.public_domain:
+        return self.public_domain.rstrip('/') + '/'
+      return 'https://{}/'.format(self.public_domain.strip('/'))
+    if self.endpoint_url:
+      endpoint = urlsplit(self.endpoint_url)
+      scheme, host = endpoint.scheme or 'https', endpoint.netloc
+    else:
+      scheme, host = 'https', 's3.amazonaws.com'
+    if self.addressing_style == PATH_ADDRESSING:
+      return '{}://{}/{}/'.format(scheme, host, self.name)
+    return '{}://{}.{}/'.format(scheme, self.name, host)
 
-class BucketConfig(namedtuple('BucketConfig', FIELDS)):
   def as_javascript(self):
     return mark_safe(json.dumps({
         'name': self.name,
@@ -0,0 +1,270 @@
+""" Sensitive files get served through our own server, and the same few files
+tend to get viewed over and over again. File names are random and files almost
+never change, so there's no point in pulling the same bytes out of S3 every
+time. FileCache keeps recently read files around, up to a byte budget, and
+throws out whatever was least recently used when it runs out of room.
+
+Before handing back a cached file, FileCache asks S3 whether the file changed
+with a conditional If-None-Match GET. If it didn't, S3 answers with a tiny 304
+instead of the whole file. You can skip even that for max_age seconds after
+the last check.
+
+Bucket.upload, Bucket.delete and friends, and the same methods on
+AsyncBucket, drop whatever they touch from this process's cache. Other
+processes find out about changes when they revalidate.
+
+FileCache also remembers each file's ETag and last modified time, so while a
+file is fresh, Bucket.head_object can answer without asking S3 at all. That's
+what lets sensitive_file_response in djaveS3.views send a 304 to a browser
+that already has the file without any S3 requests.
+
+Turn it on in your settings.py:
+
+S3_FILE_CACHE_BYTES = 200 * 1024 * 1024  # 0, the default, means no cache.
+S3_FILE_CACHE_DIR = '/tmp/djaveS3_cache'  # Leave this out to cache in memory.
+S3_FILE_CACHE_MAX_AGE = 0  # Seconds to trust a file without revalidating.
+S3_FILE_CACHE_MAX_FILE_BYTES = 10 * 1024 * 1024  # Don't cache bigger files.
+"""
+from collections import namedtuple, OrderedDict
+import hashlib
+import os
+import shutil
+import threading
+import time
+
+from botocore.exceptions import ClientError
+from django.conf import settings
+from djaveS3.storage_backends import FileMetadata, metadata_from_response
+
+
+NOT_MODIFIED_CODES = ('304', 'NotModified')
+
+
+FileCacheStats = namedtuple(
+    'FileCacheStats',
+    'hits misses revalidations evictions invalidations entries bytes')
+_Entry = namedtuple(
+    '_Entry', 'size etag last_modified content_type checked_at')
+
+
+class MemoryTier(object):
+  """ Keeps cached bytes in a dict. """
+  def __init__(self):
+    self.files = {}
+
+  def read(self, key):
+    return self.files.get(key)
+
+  def write(self, key, data):
+    self.files[key] = data
+
+  def remove(self, key):
+    self.files.pop(key, None)
+
+
+class DiskTier(object):
+  """ Keeps cached bytes in files in directory. Each process gets its own
+  subdirectory, which gets emptied out when the process starts, because the
+  list of what's in the cache only lives in memory. Subdirectories that
+  belong to processes that aren't running anymore get thrown out then too,
+  or else every restart and deploy would leave another one behind. """
+  def __init__(self, directory):
+    self.directory = os.path.join(directory, str(os.getpid()))
+    shutil.rmtree(self.directory, ignore_errors=True)
+    os.makedirs(self.directory, exist_ok=True)
+    for name in os.listdir(directory):
+      if name.isdigit() and not _process_is_running(int(name)):
+        shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
+
+  def read(self, key):
+    try:
+      with open(self._path(key), 'rb') as f:
+        return f.read()
+    except FileNotFoundError:
+      return None
+
+  def write(self, key, data):
+    path = self._path(key)
+    temp_path = '{}.{}.tmp'.format(path, threading.get_ident())
+    with open(temp_path, 'wb') as f:
+      f.write(data)
+    os.replace(temp_path, path)
+
+  def remove(self, key):
+    try:
+      os.remove(self._path(key))
+    except FileNotFoundError:
+      pass
+
+  def _path(self, key):
+    return os.path.join(
+        self.directory, hashlib.sha256('/'.join(key).encode()).hexdigest())
+
+
+def _process_is_running(pid):
+  try:
+    os.kill(pid, 0)
+  except ProcessLookupError:
+    return False
+  except PermissionError:
+    # It's running, it just belongs to somebody else.
+    return True
+  return True
+
+
+class FileCache(object):
+  def __init__(
+      self, max_bytes, tier=None, max_age=0, max_file_bytes=None):
+    self.max_bytes = max_bytes
+    self.tier = tier or MemoryTier()
+    self.max_age = max_age
+    self.max_file_bytes = max_file_bytes or max_bytes
+    # (bucket name, file name) -> _Entry, least recently used first.
+    self.entries = OrderedDict()
+    self.bytes = 0
+    self.lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+    self.revalidations = 0
+    self.evictions = 0
+    self.invalidations = 0
+
+  def file_bytes(self, bucket, file_name, read_response):
+    """ The bytes of file_name in bucket. read_response turns a get_object
+    response into bytes. If file_name doesn't exist this raises the
+    ClientError. """
+    return self.read(bucket, file_name, read_response)[0]
+
+  def read(self, bucket, file_name, read_response):
+    """ Same as file_bytes except this returns (bytes, FileMetadata) """
+    key = (bucket.name(), file_name)
+    with self.lock:
+      entry = self.entries.get(key)
+      if entry:
+        self.entries.move_to_end(key)
+    if entry and time.time() - entry.checked_at < self.max_age:
+      data = self.tier.read(key)
+      if data is not None:
+        with self.lock:
+          self.hits += 1
+        return data, _metadata(entry)
+    try:
+      response = bucket.get_object(
+          file_name, if_none_match=entry.etag if entry else None)
+    except ClientError as ex:
+      code = str(ex.response.get('Error', {}).get('Code', ''))
+      if entry and code in NOT_MODIFIED_CODES:
+        data = self.tier.read(key)
+        if data is not None:
+          with self.lock:
+            self.revalidations += 1
+            if key in self.entries:
+              self.entries[key] = entry._replace(checked_at=time.time())
+          return data, _metadata(entry)
+        # Somebody evicted it while I was asking. Just get the whole thing.
+        response = bucket.get_object(file_name)
+      else:
+        self.invalidate(*key)
+        raise ex
+    data = read_response(response)
+    with self.lock:
+      self.misses += 1
+    self._put(key, data, response)
+    return data, metadata_from_response(response)
+
+  def fresh_metadata(self, bucket_name, file_name):
+    """ The FileMetadata of a file that was checked against S3 less than
+    max_age seconds ago, or None. """
+    with self.lock:
+      entry = self.entries.get((bucket_name, file_name))
+    if entry and time.time() - entry.checked_at < self.max_age:
+      return _metadata(entry)
+    return None
+
+  def revalidated(self, bucket_name, file_name, metadata):
+    """ Somebody just got metadata for this file straight from S3. If the file
+    changed, what I have is stale. Otherwise it's fresh again. """
+    key = (bucket_name, file_name)
+    with self.lock:
+      entry = self.entries.get(key)
+      if entry and entry.etag == metadata.etag:
+        self.entries[key] = entry._replace(checked_at=time.time())
+        return
+    if entry:
+      self.invalidate(bucket_name, file_name)
+
+  def invalidate(self, bucket_name, file_name):
+    key = (bucket_name, file_name)
+    with self.lock:
+      entry = self.entries.pop(key, None)
+      if entry:
+        self.bytes -= entry.size
+        self.invalidations += 1
+        self.tier.remove(key)
+
+  def clear(self):
+    with self.lock:
+      for key in self.entries:
+        self.tier.remove(key)
+      self.entries.clear()
+      self.bytes = 0
+
+  def stats(self):
+    with self.lock:
+      return FileCacheStats(
+          self.hits, self.misses, self.revalidations, self.evictions,
+          self.invalidations, len(self.entries), self.bytes)
+
+  def _put(self, key, data, response):
+    size = len(data)
+    if size > self.max_file_bytes or not response.get('ETag'):
+      return
+    # Writing to disk can be slow, so it happens before taking the lock. If
+    # somebody evicts or invalidates the file in the meantime, the worst that
+    # happens is the next read misses.
+    self.tier.write(key, data)
+    evicted_keys = []
+    with self.lock:
+      old = self.entries.pop(key, None)
+      if old:
+        self.bytes -= old.size
+      while self.entries and self.bytes + size > self.max_bytes:
+        evicted_key, evicted = self.entries.popitem(last=False)
+        self.bytes -= evicted.size
+        self.evictions += 1
+        evicted_keys.append(evicted_key)
+      self.entries[key] = _Entry(
+          size, response['ETag'], response.get('LastModified'),
+          response.get('ContentType'), time.time())
+      self.bytes += size
+    for evicted_key in evicted_keys:
+      self.tier.remove(evicted_key)
+
+
+def _metadata(entry):
+  return FileMetadata(
+      entry.etag, entry.last_modified, entry.content_type, entry.size)
+
+
+_file_cache = None
+_file_cache_lock = threading.Lock()
+
+
+def get_file_cache():
+  """ The process wide FileCache, or None if settings.S3_FILE_CACHE_BYTES isn't
+  set. """
+  global _file_cache
+  max_bytes = getattr(settings, 'S3_FILE_CACHE_BYTES', 0)
+  if not max_bytes:
+    return None
+  if _file_cache is None:
+    with _file_cache_lock:
+      if _file_cache is None:
+        directory = getattr(settings, 'S3_FILE_CACHE_DIR', None)
+        _file_cache = FileCache(
+            max_bytes,
+            tier=DiskTier(directory) if directory else MemoryTier(),
+            max_age=getattr(settings, 'S3_FILE_CACHE_MAX_AGE', 0),
+            max_file_bytes=getattr(
+                settings, 'S3_FILE_CACHE_MAX_FILE_BYTES', None))
+  return _file_cache
@@ -8,6 +8,14 @@ JPEG_CONTENT_TYPE = 'image/jpeg'
 PNG = 'png'
 PNG_CONTENT_TYPE = 'image/png'
 VALID_IMAGE_TYPES = [JPEG_CONTENT_TYPE, PNG_CONTENT_TYPE]
+WEBP = 'webp'
+WEBP_CONTENT_TYPE = 'image/webp'
+AVIF = 'avif'
+AVIF_CONTENT_TYPE = 'image/avif'
+# Resized photos can have copies in these formats too. Smallest first, which
+# is the order I'd rather serve them in. See ImageEncoding in
+# djaveS3.bucket_config
+ALTERNATE_IMAGE_TYPES = [AVIF_CONTENT_TYPE, WEBP_CONTENT_TYPE]
 
 
 def content_type_from_file_name(file_name):
@@ -17,6 +25,33 @@ def content_type_from_file_name(file_name):
       return JPEG_CONTENT_TYPE
     if suffix == PNG:
       return PNG_CONTENT_TYPE
+    if suffix == WEBP:
+      return WEBP_CONTENT_TYPE
+    if suffix == AVIF:
+      return AVIF_CONTENT_TYPE
+
+
+def suffix_from_content_type(content_type):
+  return {
+      JPEG_CONTENT_TYPE: JPG, PNG_CONTENT_TYPE: PNG,
+      WEBP_CONTENT_TYPE: WEBP, AVIF_CONTENT_TYPE: AVIF}.get(content_type)
+
+
+def best_alternate(alternates, accept):
+  """ alternates is {content type: whatever}. accept is an HTTP Accept header.
+  Returns the content type from ALTERNATE_IMAGE_TYPES that's in alternates and
+  that accept specifically asks for, or None. Every browser sends */* so that
+  doesn't count. """
+  accepted = set()
+  for media_range in (accept or '').split(','):
+    parts = [part.strip() for part in media_range.split(';')]
+    if any(part.replace(' ', '') in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000')
+           for part in parts[1:]):
+      continue
+    accepted.add(parts[0].lower())
+  for content_type in ALTERNATE_IMAGE_TYPES:
+    if content_type in alternates and content_type in accepted:
+      return content_type
 
 
 def suffix_from_file_type(file_type):
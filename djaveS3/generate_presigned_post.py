@@ -1,3 +1,5 @@
+from asgiref.sync import sync_to_async
+from djaveS3.models.async_bucket import AsyncBucket
 from djaveS3.models.bucket import get_bucket_config, Bucket
 from djaveS3.models.signed_file import SignedFile
 
@@ -6,10 +8,47 @@ def generate_presigned_post(
     bucket_config, file_name, file_type, boto_client=None):
   """ This gets its own file because it knows about Buckets and SignedFiles.
   bucket_config can be the name of a bucket or a bucket config. """
-  bucket = Bucket(get_bucket_config(bucket_config))
-  boto_client = boto_client or bucket.boto_client
+  bucket = Bucket(get_bucket_config(bucket_config), boto_client=boto_client)
   SignedFile.objects.get_or_create(
       file_name=file_name, bucket_name=bucket.name())
+  fields, conditions = _fields_and_conditions(file_type)
+  return bucket.generate_presigned_post(
+      file_name, fields, conditions, expires_in=3600)
+
+
+def generate_presigned_posts(
+    bucket_config, file_names_and_types, boto_client=None):
+  """ generate_presigned_post for a bunch of files at once.
+  file_names_and_types is like [('abc.jpg', 'image/jpeg'), ...] and this
+  returns the presigned posts in the same order. All the SignedFiles get
+  recorded in a single query. Signing doesn't talk to S3, so the whole thing
+  costs one database round trip no matter how many files there are. """
+  bucket = Bucket(get_bucket_config(bucket_config), boto_client=boto_client)
+  # ignore_conflicts makes this act like get_or_create for every file.
+  SignedFile.objects.bulk_create([
+      SignedFile(file_name=file_name, bucket_name=bucket.name())
+      for file_name, _ in file_names_and_types], ignore_conflicts=True)
+  presigned_posts = []
+  for file_name, file_type in file_names_and_types:
+    fields, conditions = _fields_and_conditions(file_type)
+    presigned_posts.append(bucket.generate_presigned_post(
+        file_name, fields, conditions, expires_in=3600))
+  return presigned_posts
+
+
+async def async_generate_presigned_post(
+    bucket_config, file_name, file_type, client=None):
+  """ generate_presigned_post for async views. client can be overridden for
+  the sake of tests. """
+  bucket = AsyncBucket(get_bucket_config(bucket_config), client=client)
+  await sync_to_async(SignedFile.objects.get_or_create)(
+      file_name=file_name, bucket_name=bucket.name())
+  fields, conditions = _fields_and_conditions(file_type)
+  return await bucket.generate_presigned_post(
+      file_name, fields, conditions, expires_in=3600)
+
+
+def _fields_and_conditions(file_type):
   fields = {'Content-Type': file_type}
   conditions = [{'Content-Type': file_type}]
   """
@@ -21,9 +60,4 @@ def generate_presigned_post(
   fields['acl'] = 'public-read'
   conditions.insert(0, {'acl': 'public-read'})
   """
-  return boto_client.generate_presigned_post(
-      Bucket=bucket.name(),
-      Key=file_name,
-      Fields=fields,
-      Conditions=conditions,
-      ExpiresIn=3600)
+  return fields, conditions
@@ -1,4 +1,18 @@
-from djaveS3.bucket_config import BucketConfig
+""" Bucket names get turned into BucketConfigs all over the place, on every
+Bucket, every public_file_url and every signed upload. So rather than search
+settings.S3_BUCKETS every time, djaveS3 checks all of S3_BUCKETS once, when
+Django starts up, and indexes them by name. If there's anything wrong with
+them you find out right away instead of in the middle of some request.
+
+If you change S3_BUCKETS after startup, like when credentials rotate, call
+reload_bucket_configs. override_settings(S3_BUCKETS=...) reloads them for you.
+"""
+import threading
+
+from djaveS3.boto_client import forget_boto_clients
+from djaveS3.bucket_config import (
+    BucketConfig, ImageEncoding, TransferProfile, S3_BACKEND, LOCAL_BACKEND,
+    MEMORY_BACKEND, PATH_ADDRESSING, VIRTUAL_ADDRESSING)
 from django.conf import settings
 
 
@@ -6,6 +20,13 @@ class GetBucketConfigException(Exception):
   pass
 
 
+# bucket name -> BucketConfig
+_bucket_configs = None
+# bucket name -> public url root, for public buckets only
+_public_url_roots = None
+_load_lock = threading.Lock()
+
+
 def get_bucket_config(bucket_config):
   if isinstance(bucket_config, BucketConfig):
     return bucket_config
@@ -14,28 +35,118 @@ def get_bucket_config(bucket_config):
         'In tests, you should pass bucket objects around instead of using '
         'get_bucket_config which accesses global settings. Tests hate '
         'global settings because you can not replace them with test values.')
-  if not hasattr(settings, 'S3_BUCKETS'):
-    message = ''.join([
-        'You need to configure your S3_BUCKETS in django.conf.settings. For '
-        'example,\nfrom djaveS3.bucket_config import BucketConfig\n'
-        'S3_BUCKETS = [BucketConfig(\'my_bucket_name\', '
-        'my_access_key_id, my_secret_access_key, is_public=True)]'])
-    raise GetBucketConfigException(message)
   if isinstance(bucket_config, str):
-    got_bucket = None
-    for next_bucket in settings.S3_BUCKETS:
-      if next_bucket.name == bucket_config:
-        got_bucket = next_bucket
+    got_bucket = _loaded_bucket_configs().get(bucket_config)
     if got_bucket is None:
       raise GetBucketConfigException((
           'S3 bucket {} is not configured in S3_BUCKETS in '
           'django.conf.settings').format(bucket_config))
-    if not isinstance(got_bucket, BucketConfig):
-      raise GetBucketConfigException((
-          'S3 bucket {} in S3_BUCKETS in django.conf.settings should be a '
-          'BucketConfig, but it is a {}').format(
-              bucket_config, got_bucket.__class__))
     return got_bucket
   raise GetBucketConfigException(
       'I am expecting a BucketConfig or a string. You gave me a {}'.format(
           bucket_config.__class__))
+
+
+def get_public_url_root(bucket_name):
+  """ The public url root of a configured public bucket, or None. """
+  if settings.TEST:
+    # get_bucket_config will explain why that's not allowed.
+    return None
+  _loaded_bucket_configs()
+  return _public_url_roots.get(bucket_name)
+
+
+def load_bucket_configs():
+  """ Check every BucketConfig in settings.S3_BUCKETS and index them. djaveS3's
+  AppConfig calls this when Django starts. Raises a GetBucketConfigException
+  if anything is wrong. """
+  global _bucket_configs, _public_url_roots
+  with _load_lock:
+    bucket_configs = {}
+    for bucket_config in _settings_buckets():
+      _check_bucket_config(bucket_config, bucket_configs)
+      bucket_configs[bucket_config.name] = bucket_config
+    _public_url_roots = {
+        name: bucket_config.public_url_root()
+        for name, bucket_config in bucket_configs.items()
+        if bucket_config.is_public}
+    _bucket_configs = bucket_configs
+    return _bucket_configs
+
+
+def reload_bucket_configs():
+  """ Load settings.S3_BUCKETS all over again, and throw out all the cached
+  boto clients so nothing keeps using old credentials. """
+  forget_boto_clients()
+  return load_bucket_configs()
+
+
+def forget_bucket_configs():
+  """ The next get_bucket_config loads settings.S3_BUCKETS all over again. """
+  global _bucket_configs, _public_url_roots
+  with _load_lock:
+    _bucket_configs = None
+    _public_url_roots = None
+
+
+def _loaded_bucket_configs():
+  return _bucket_configs if _bucket_configs is not None else (
+      load_bucket_configs())
+
+
+def _settings_buckets():
+  if not hasattr(settings, 'S3_BUCKETS'):
+    message = ''.join([
+        'You need to configure your S3_BUCKETS in django.conf.settings. For '
+        'example,\nfrom djaveS3.bucket_config import BucketConfig\n'
+        'S3_BUCKETS = [BucketConfig(\'my_bucket_name\', '
+        'my_access_key_id, my_secret_access_key, is_public=True)]'])
+    raise GetBucketConfigException(message)
+  if not isinstance(settings.S3_BUCKETS, (list, tuple)):
+    raise GetBucketConfigException(
+        'S3_BUCKETS in django.conf.settings should be a list of '
+        'BucketConfigs, but it is a {}'.format(settings.S3_BUCKETS.__class__))
+  return settings.S3_BUCKETS
+
+
+def _check_bucket_config(bucket_config, bucket_configs):
+  if not isinstance(bucket_config, BucketConfig):
+    raise GetBucketConfigException((
+        '{} in S3_BUCKETS in django.conf.settings should be a BucketConfig, '
+        'but it is a {}').format(bucket_config, bucket_config.__class__))
+  name = bucket_config.name
+  if not name or not isinstance(name, str):
+    raise GetBucketConfigException(
+        'Every BucketConfig in S3_BUCKETS needs a name. {} does not have '
+        'one'.format(bucket_config))
+  if name in bucket_configs:
+    raise GetBucketConfigException(
+        'S3 bucket {} is in S3_BUCKETS more than once'.format(name))
+  backend = bucket_config.backend or S3_BACKEND
+  if backend not in (S3_BACKEND, LOCAL_BACKEND, MEMORY_BACKEND):
+    raise GetBucketConfigException(
+        'S3 bucket {} has a backend of {}, which I do not know about'.format(
+            name, backend))
+  if backend == LOCAL_BACKEND and not (
+      bucket_config.local_root or getattr(settings, 'S3_LOCAL_ROOT', None)):
+    raise GetBucketConfigException((
+        'S3 bucket {} keeps its files on local disk, so it needs a '
+        'local_root, or you need to set S3_LOCAL_ROOT').format(name))
+  if bucket_config.addressing_style not in (
+      None, VIRTUAL_ADDRESSING, PATH_ADDRESSING):
+    raise GetBucketConfigException((
+        'The addressing_style of S3 bucket {} should be VIRTUAL_ADDRESSING '
+        'or PATH_ADDRESSING, not {}').format(
+            name, bucket_config.addressing_style))
+  if bucket_config.transfer_profile is not None and not isinstance(
+      bucket_config.transfer_profile, TransferProfile):
+    raise GetBucketConfigException(
+        'The transfer_profile of S3 bucket {} should be a TransferProfile, '
+        'but it is a {}'.format(
+            name, bucket_config.transfer_profile.__class__))
+  if bucket_config.image_encoding is not None and not isinstance(
+      bucket_config.image_encoding, ImageEncoding):
+    raise GetBucketConfigException(
+        'The image_encoding of S3 bucket {} should be an ImageEncoding, '
+        'but it is a {}'.format(
+            name, bucket_config.image_encoding.__class__))
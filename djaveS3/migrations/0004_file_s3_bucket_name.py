@@ -0,0 +1,18 @@
+# Generated by Django 3.0.14 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djaveS3', '0003_auto_20200513_1147'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='file',
+            name='s3_bucket_name',
+            field=models.CharField(blank=True, db_index=True, default='', max_length=200),
+        ),
+    ]
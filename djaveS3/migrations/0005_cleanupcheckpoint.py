@@ -0,0 +1,24 @@
+# Generated by Django 3.0.14 on 2026-10-18 15:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djaveS3', '0004_file_s3_bucket_name'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CleanupCheckpoint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('job_name', models.CharField(max_length=200, unique=True)),
+                ('last_pk', models.BigIntegerField(null=True)),
+                ('processed', models.BigIntegerField(default=0, help_text='How many items the last run processed')),
+                ('remaining', models.BigIntegerField(help_text='How many items were left after the last run', null=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
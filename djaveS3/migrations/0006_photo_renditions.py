@@ -0,0 +1,35 @@
+# Generated by Django 3.0.14 on 2026-10-18 15:18
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djaveS3', '0005_cleanupcheckpoint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='photo',
+            name='height',
+            field=models.IntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='photo',
+            name='width',
+            field=models.IntegerField(null=True),
+        ),
+        migrations.CreateModel(
+            name='RenditionFile',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=50)),
+                ('file_name', models.CharField(max_length=200, unique=True)),
+                ('width', models.IntegerField()),
+                ('height', models.IntegerField()),
+                ('file', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='rendition_files', to='djaveS3.File')),
+            ],
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 3.0.14 on 2026-10-18 15:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djaveS3', '0006_photo_renditions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='renditionfile',
+            name='content_type',
+            field=models.CharField(default='image/jpeg', max_length=50),
+        ),
+        migrations.AlterField(
+            model_name='renditionfile',
+            name='name',
+            field=models.CharField(blank=True, max_length=50),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 3.0.14 on 2026-10-18 15:22
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djaveS3', '0007_renditionfile_content_type'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ResizeJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('pending', 'pending'), ('claimed', 'claimed'), ('dead', 'dead')], default='pending', max_length=20)),
+                ('attempts', models.IntegerField(default=0)),
+                ('run_after', models.DateTimeField(db_index=True)),
+                ('claimed_until', models.DateTimeField(help_text='If the worker that claimed this job is still at it after this, it probably died, so somebody else can claim it', null=True)),
+                ('last_error', models.TextField(blank=True, default='')),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('file', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='resize_job', to='djaveS3.File')),
+            ],
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 3.0.14 on 2026-10-18 15:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djaveS3', '0008_resizejob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='file',
+            name='blob_file_name',
+            field=models.CharField(blank=True, db_index=True, default='', max_length=200),
+        ),
+        migrations.AddField(
+            model_name='file',
+            name='content_hash',
+            field=models.CharField(blank=True, db_index=True, default='', max_length=100),
+        ),
+        migrations.AlterField(
+            model_name='renditionfile',
+            name='file_name',
+            field=models.CharField(db_index=True, max_length=200),
+        ),
+        migrations.AlterUniqueTogether(
+            name='renditionfile',
+            unique_together={('file', 'file_name')},
+        ),
+    ]
@@ -1,4 +1,7 @@
 # flake8: noqa
+from djaveS3.models.cleanup_checkpoint import CleanupCheckpoint
 from djaveS3.models.file import File
+from djaveS3.models.rendition_file import RenditionFile
+from djaveS3.models.resize_job import ResizeJob
 from djaveS3.models.signed_file import SignedFile
 from djaveS3.models.test_photo import TestPhoto
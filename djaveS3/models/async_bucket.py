@@ -0,0 +1,306 @@
+""" AsyncBucket is Bucket for async views. Every method that talks to S3 is a
+coroutine, and they all go through aiobotocore, so waiting on S3 doesn't tie up
+a thread. All the AsyncBuckets in an event loop share one client, and
+therefore one connection pool, per set of credentials. See
+get_async_boto_client in djaveS3.boto_client.
+
+from asgiref.sync import sync_to_async
+
+async def view_photo_of_steve(request, file_name):
+  # The ORM isn't async, and neither is request.user since it loads the
+  # session, so those have to run in a thread.
+  steve_file = await sync_to_async(get_steve_file)(request, file_name)
+  return await async_sensitive_file_response(steve_file, request=request)
+
+def get_steve_file(request, file_name):
+  if request.user.username != 'Steve':
+    raise Exception('Only Steve may look at photos of Steve!')
+  return SteveFile.objects.get(file_name=file_name)
+
+You need Django 3.1 or later for async views, and pip install aiobotocore.
+
+Buckets with a local or memory backend don't need aiobotocore. Their backends
+just run in threads. """
+import asyncio
+import functools
+from io import BytesIO
+import itertools
+
+from botocore.exceptions import ClientError
+from django.conf import settings
+from djaveS3.boto_client import get_async_boto_client
+from djaveS3.bucket_config import S3_BACKEND
+from djaveS3.file_cache import get_file_cache
+from djaveS3.get_bucket_config import get_bucket_config
+from djaveS3.models.bucket import (
+    DEFAULT_CHUNK_SIZE, DELETE_MANY_BATCH_SIZE, NO_SUCH_KEY_CODES,
+    FileTooBigException, ListedObject, check_file_name, client_error_code)
+from djaveS3.storage_backends import make_backend, metadata_from_response
+
+
+class AsyncBucket(object):
+  def __init__(self, bucket_config, client=None, file_cache=None):
+    # bucket_config can be a bucket name or a bucket_config object.
+    # client can be overridden for the sake of tests. It should act like an
+    # aiobotocore S3 client. Like with Bucket, uploads and deletes drop
+    # whatever they touch from file_cache, which defaults to the one in
+    # djaveS3.file_cache if you turned that on.
+    self.bucket_config = get_bucket_config(bucket_config)
+    self.file_cache = file_cache or get_file_cache()
+    is_s3 = (self.bucket_config.backend or S3_BACKEND) == S3_BACKEND
+    if settings.TEST and is_s3 and not client:
+      raise Exception(
+          'You should use a fake async S3 client in unit tests so your tests '
+          'do not attempt to contact Amazon servers.')
+    if not client and not is_s3:
+      client = AsyncBackendClient(make_backend(self.bucket_config))
+    self._client = client
+
+  def name(self):
+    return self.bucket_config.name
+
+  async def client(self):
+    if self._client:
+      return self._client
+    # I don't hang on to this client because it belongs to the running event
+    # loop, and this AsyncBucket might get used from a different loop later.
+    return await get_async_boto_client(
+        self.bucket_config.access_key_id, self.bucket_config.secret_access_key,
+        region_name=self.bucket_config.region_name,
+        endpoint_url=self.bucket_config.endpoint_url)
+
+  async def list(self):
+    """ [('blahblahblah.jpg', datetime(2018, 6, 28, 21)),
+         (file name, last modified)] """
+    return [
+        (listed.key, listed.last_modified)
+        async for listed in self.iter_list()]
+
+  async def iter_list(self, prefix='', start_after=None, page_size=1000):
+    """ Generate a ListedObject for every file in the bucket in key order, one
+    page at a time. """
+    client = await self.client()
+    kwargs = {'Bucket': self.bucket_config.name, 'MaxKeys': page_size}
+    if prefix:
+      kwargs['Prefix'] = prefix
+    if start_after:
+      kwargs['StartAfter'] = start_after
+    while True:
+      lookup_result = await client.list_objects_v2(**kwargs)
+      for obj in lookup_result.get('Contents', []):
+        yield ListedObject(
+            obj['Key'], obj['LastModified'], obj.get('Size'), obj.get('ETag'))
+      if not lookup_result.get('IsTruncated'):
+        return
+      kwargs['ContinuationToken'] = lookup_result['NextContinuationToken']
+
+  async def get_object(self, file_name, byte_range=None):
+    kwargs = {'Bucket': self.bucket_config.name, 'Key': file_name}
+    if byte_range:
+      kwargs['Range'] = byte_range
+    return await (await self.client()).get_object(**kwargs)
+
+  async def head_object(self, file_name):
+    """ Same as Bucket.head_object. """
+    check_file_name(file_name)
+    if self.file_cache:
+      metadata = self.file_cache.fresh_metadata(self.name(), file_name)
+      if metadata:
+        return metadata
+    metadata = metadata_from_response(await (await self.client()).head_object(
+        Bucket=self.bucket_config.name, Key=file_name))
+    if self.file_cache:
+      self.file_cache.revalidated(self.name(), file_name, metadata)
+    return metadata
+
+  async def file_bytes(self, file_name, max_bytes=None):
+    """ Same as Bucket.file_bytes. Returns None if the file doesn't exist. """
+    return (await self.file_bytes_and_metadata(
+        file_name, max_bytes=max_bytes))[0]
+
+  async def file_bytes_and_metadata(self, file_name, max_bytes=None):
+    """ Same as file_bytes, but returns (bytes, FileMetadata), or (None, None)
+    if the file doesn't exist. """
+    check_file_name(file_name)
+    try:
+      response = await self.get_object(file_name)
+    except ClientError as ex:
+      if client_error_code(ex) in NO_SUCH_KEY_CODES:
+        return None, None
+      raise ex
+    return (
+        await self._read_body(response, file_name, max_bytes),
+        metadata_from_response(response))
+
+  async def _read_body(self, response, file_name, max_bytes):
+    body = response['Body']
+    try:
+      if max_bytes is None:
+        return await body.read()
+      size = response.get('ContentLength')
+      if size is not None and size > max_bytes:
+        raise FileTooBigException(file_name, size, max_bytes)
+      # A read can come back with fewer bytes than I asked for, well before
+      # the end of the file, so I keep reading until there's no more.
+      read = bytearray()
+      while len(read) <= max_bytes:
+        chunk = await body.read(max_bytes + 1 - len(read))
+        if not chunk:
+          return bytes(read)
+        read.extend(chunk)
+      raise FileTooBigException(file_name, None, max_bytes)
+    finally:
+      body.close()
+
+  async def iter_file_bytes(self, file_name, chunk_size=DEFAULT_CHUNK_SIZE):
+    check_file_name(file_name)
+    body = (await self.get_object(file_name))['Body']
+    try:
+      while True:
+        chunk = await body.read(chunk_size)
+        if not chunk:
+          return
+        yield chunk
+    finally:
+      body.close()
+
+  async def upload(self, file_name, remote_file_name=None, content_type=None):
+    """ This reads the whole file into memory and sends it in a single request,
+    so it's meant for photo sized files, not 5GB videos. """
+    remote_file_name = remote_file_name or file_name
+    loop = asyncio.get_running_loop()
+    data = await loop.run_in_executor(None, _read_file, file_name)
+    await self.upload_bytes(data, remote_file_name, content_type=content_type)
+
+  async def upload_bytes(self, data, remote_file_name, content_type=None):
+    kwargs = {
+        'Bucket': self.bucket_config.name, 'Key': remote_file_name,
+        'Body': data}
+    if content_type:
+      kwargs['ContentType'] = content_type
+    await (await self.client()).put_object(**kwargs)
+    self._forget_cached([remote_file_name])
+
+  async def delete(self, file_name):
+    got = await (await self.client()).delete_object(
+        Bucket=self.bucket_config.name, Key=file_name)
+    self._forget_cached([file_name])
+    return got['ResponseMetadata']['HTTPStatusCode'] == 204
+
+  async def delete_many(self, file_names, max_concurrent=None):
+    """ Same as Bucket.delete_many except up to max_concurrent batches go at
+    once. That defaults to settings.S3_WORK_MAX_WORKERS, like the
+    S3WorkExecutor in djaveS3.s3_executor. """
+    file_names = list(file_names)
+    client = await self.client()
+    batches = [
+        file_names[start:start + DELETE_MANY_BATCH_SIZE]
+        for start in range(0, len(file_names), DELETE_MANY_BATCH_SIZE)]
+    semaphore = asyncio.Semaphore(
+        max_concurrent or getattr(settings, 'S3_WORK_MAX_WORKERS', 4))
+
+    async def delete_batch(batch):
+      async with semaphore:
+        return await client.delete_objects(
+            Bucket=self.bucket_config.name,
+            Delete={
+                'Objects': [{'Key': file_name} for file_name in batch],
+                'Quiet': True})
+    results = await asyncio.gather(*[
+        delete_batch(batch) for batch in batches])
+    self._forget_cached(file_names)
+    errors = {}
+    for got in results:
+      for error in got.get('Errors', []):
+        errors[error['Key']] = '{}: {}'.format(
+            error.get('Code', ''), error.get('Message', ''))
+    return errors
+
+  async def generate_presigned_post(
+      self, file_name, fields, conditions, expires_in=3600):
+    return await (await self.client()).generate_presigned_post(
+        Bucket=self.bucket_config.name,
+        Key=file_name,
+        Fields=fields,
+        Conditions=conditions,
+        ExpiresIn=expires_in)
+
+  def _forget_cached(self, file_names):
+    if self.file_cache:
+      for file_name in file_names:
+        self.file_cache.invalidate(self.name(), file_name)
+
+  def __repr__(self):
+    return '<AsyncBucket {}>'.format(self.bucket_config.name)
+
+
+class AsyncBackendClient(object):
+  """ Makes a local or memory backend look enough like an aiobotocore client
+  for AsyncBucket. Each call runs the backend in a thread. """
+  def __init__(self, backend):
+    self.backend = backend
+
+  async def list_objects_v2(
+      self, Bucket, MaxKeys=1000, Prefix='', StartAfter=None,
+      ContinuationToken=None):
+    # My continuation tokens are just the last key on the previous page.
+    listed = await self._run(lambda: list(itertools.islice(
+        self.backend.list(
+            prefix=Prefix, start_after=ContinuationToken or StartAfter),
+        MaxKeys + 1)))
+    page = listed[:MaxKeys]
+    result = {
+        'IsTruncated': len(listed) > MaxKeys,
+        'Contents': [{
+            'Key': obj.key, 'LastModified': obj.last_modified,
+            'Size': obj.size, 'ETag': obj.etag} for obj in page]}
+    if result['IsTruncated']:
+      result['NextContinuationToken'] = page[-1].key
+    return result
+
+  async def head_object(self, Bucket, Key):
+    return await self._run(self.backend.head, Key)
+
+  async def get_object(self, Bucket, Key, Range=None):
+    response = await self._run(self.backend.get, Key, byte_range=Range)
+    response['Body'] = _AsyncBody(response['Body'])
+    return response
+
+  async def put_object(self, Bucket, Key, Body, ContentType=None):
+    await self._run(
+        self.backend.put, Key, BytesIO(Body), content_type=ContentType)
+
+  async def delete_object(self, Bucket, Key):
+    await self._run(self.backend.delete, Key)
+    return {'ResponseMetadata': {'HTTPStatusCode': 204}}
+
+  async def delete_objects(self, Bucket, Delete):
+    errors = await self._run(
+        self.backend.delete_many, [obj['Key'] for obj in Delete['Objects']])
+    return {'Errors': [
+        {'Key': key, 'Message': error} for key, error in errors.items()]}
+
+  async def generate_presigned_post(
+      self, Bucket, Key, Fields, Conditions, ExpiresIn):
+    return self.backend.presign_post(Key, Fields, Conditions, ExpiresIn)
+
+  async def _run(self, function, *args, **kwargs):
+    return await asyncio.get_running_loop().run_in_executor(
+        None, functools.partial(function, *args, **kwargs))
+
+
+class _AsyncBody(object):
+  def __init__(self, body):
+    self.body = body
+
+  async def read(self, amt=None):
+    return await asyncio.get_running_loop().run_in_executor(
+        None, self.body.read, amt)
+
+  def close(self):
+    self.body.close()
+
+
+def _read_file(file_name):
+  with open(file_name, 'rb') as f:
+    return f.read()
@@ -1,11 +1,21 @@
 import base64
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
 import os
+import queue
 import re
+import threading
 
-from django.conf import settings
+from botocore.exceptions import ClientError
 from djavError.log_error import log_error
-from djaveS3.boto_client import get_boto_client
+from djaveS3.file_cache import get_file_cache
 from djaveS3.get_bucket_config import get_bucket_config
+from djaveS3.random_string import RANDOM_STRING_CHARACTERS
+# Some of these live in storage_backends, but everybody's used to getting them
+# from here.
+from djaveS3.storage_backends import (  # noqa: F401
+    make_backend, metadata_from_response, DELETE_MANY_BATCH_SIZE, FileMetadata,
+    ListedObject, TransferProgress, TransferStats)
 
 
 """ Why isn't there a sensitive_file_url(bucket_config, file_name) function?
@@ -13,21 +23,38 @@ That's because sensitive files require security checks, and I don't know what
 business rules your organization has, so I can't write a view for you that will
 display a sensitive file, so I don't know what view to reverse, so I can't
 calculate a sensitive_file_url for you. See sensitive_file_response in
-djaveS3.views which explains how to write just such a view. """
+djaveS3.views which explains how to write just such a view.
+
+That view doesn't have to pass the bytes through your server though. Once your
+security checks pass, sensitive_file_redirect in djaveS3.views sends the
+browser to a presigned_url that only works for a minute or so, and the bytes
+go straight from S3 to the browser. """
+
+
+DEFAULT_CHUNK_SIZE = 64 * 1024
+NO_SUCH_KEY_CODES = ('NoSuchKey', '404')
+
+
+class FileTooBigException(Exception):
+  pass
 
 
 class Bucket(object):
-  def __init__(self, bucket_config, boto_client=None):
+  def __init__(
+      self, bucket_config, boto_client=None, backend=None, file_cache=None):
     # bucket_config can be a bucket name or a bucket_config object.
-    # boto_client can be overridden for the sake of tests.
+    # boto_client or the entire backend can be overridden for the sake of
+    # tests. file_cache defaults to the one in djaveS3.file_cache, if you
+    # turned that on.
     self.bucket_config = get_bucket_config(bucket_config)
-    if settings.TEST and not boto_client:
-      raise Exception(
-          'You should use a mock boto3 client in unit tests so your tests do '
-          'not attempt to contact Amazon servers because that could slow your '
-          'tests down and put test files on Amazon servers.')
-    self.boto_client = boto_client or get_boto_client(
-        self.bucket_config.access_key_id, self.bucket_config.secret_access_key)
+    self.backend = backend or make_backend(
+        self.bucket_config, boto_client=boto_client)
+    self.file_cache = file_cache or get_file_cache()
+
+  @property
+  def boto_client(self):
+    # Only S3 backends have one.
+    return getattr(self.backend, 'boto_client', None)
 
   def name(self):
     return self.bucket_config.name
@@ -35,70 +62,251 @@ class Bucket(object):
   def list(self):
     """ [('blahblahblah.jpg', datetime(2018, 6, 28, 21)),
          (file name, last modified)] """
-    to_return = []
+    return [
+        (listed.key, listed.last_modified) for listed in self.iter_list()]
+
+  def iter_list(self, prefix='', start_after=None, page_size=1000):
+    """ Generate a ListedObject for every file in the bucket in key order,
+    following continuation tokens, so it doesn't matter how many files there
+    are. Only one page is ever in memory at a time. """
     # You don't have to can_read_net here. __init__ forces tests to pass in an
     # s3_override, and  dev and stage use the dev s3 buckets.
-    lookup_result = self.boto_client.list_objects_v2(
-        Bucket=self.bucket_config.name)
-    # If the bucket_name is empty they omit the Contents entirely.
-    if 'Contents' in lookup_result:
-      for obj in lookup_result['Contents']:
-        to_return.append((obj['Key'], obj['LastModified']))
-    return to_return
-
-  def download(self, file_name, local_file_name=None):
-    local_file_name = local_file_name or file_name
-    self.boto_client.download_file(
-        self.bucket_config.name, file_name, local_file_name)
+    return self.backend.list(
+        prefix=prefix, start_after=start_after, page_size=page_size)
+
+  def iter_list_parallel(
+      self, prefixes=None, max_workers=8, start_after=None, page_size=1000):
+    """ Like iter_list, except each prefix gets listed in its own thread.
+    That's a lot faster for big buckets, but files come out in whatever order
+    the threads find them, NOT in key order.
+
+    prefixes have to cover every key you care about. The default covers
+    everything random_string generates, which is every file that was uploaded
+    through sign_upload. """
+    prefixes = prefixes or list(RANDOM_STRING_CHARACTERS)
+    # The bounded queue is what keeps memory flat. If the consumer is slow, the
+    # threads wait.
+    found = queue.Queue(maxsize=page_size * max_workers)
+    stop = threading.Event()
+    done = object()
+
+    def list_prefix(prefix):
+      try:
+        for listed in self.iter_list(
+            prefix=prefix, start_after=start_after, page_size=page_size):
+          while not stop.is_set():
+            try:
+              found.put(listed, timeout=0.1)
+              break
+            except queue.Full:
+              pass
+          if stop.is_set():
+            return
+      finally:
+        found.put(done)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+      futures = [executor.submit(list_prefix, prefix) for prefix in prefixes]
+      try:
+        remaining = len(futures)
+        while remaining:
+          listed = found.get()
+          if listed is done:
+            remaining -= 1
+          else:
+            yield listed
+      finally:
+        stop.set()
+        # Make room so no thread is stuck putting into a full queue.
+        while any(not future.done() for future in futures):
+          try:
+            found.get(timeout=0.1)
+          except queue.Empty:
+            pass
+      for future in futures:
+        # Surface exceptions from the listing threads.
+        future.result()
+
+  def download(self, file_name, local_file_name=None, callback=None):
+    """ callback gets called with TransferStats as the download progresses.
+    """
+    self.backend.get_file(
+        file_name, local_file_name or file_name, callback=callback)
+
+  def download_fileobj(self, file_name, fileobj=None, callback=None):
+    """ Download file_name into fileobj, or into a fresh BytesIO if you don't
+    give me one. Returns fileobj, rewound to the beginning. Big files come down
+    in parallel parts, and nothing touches the disk. """
+    fileobj = fileobj or BytesIO()
+    self.backend.get_into(file_name, fileobj, callback=callback)
+    fileobj.seek(0)
+    return fileobj
 
   def rm_download(self, local_file_name):
     os.remove(local_file_name)
 
-  def file_bytes(self, file_name):
+  def get_object(self, file_name, byte_range=None, if_none_match=None):
+    """ The raw boto3 get_object response. response['Body'] is a stream, so
+    nothing gets downloaded until you read it. byte_range is an HTTP Range
+    header value like 'bytes=0-499'. If the file's ETag is if_none_match this
+    raises a ClientError with the code '304'. """
+    return self.backend.get(
+        file_name, byte_range=byte_range, if_none_match=if_none_match)
+
+  def head_object(self, file_name):
+    """ The FileMetadata for file_name without downloading it. If the
+    FileCache checked this file less than S3_FILE_CACHE_MAX_AGE seconds ago
+    this doesn't even ask S3. If the file doesn't exist this raises a
+    ClientError with the code '404'. """
+    check_file_name(file_name)
+    if self.file_cache:
+      metadata = self.file_cache.fresh_metadata(self.name(), file_name)
+      if metadata:
+        return metadata
+    metadata = metadata_from_response(self.backend.head(file_name))
+    if self.file_cache:
+      self.file_cache.revalidated(self.name(), file_name, metadata)
+    return metadata
+
+  def file_bytes(self, file_name, max_bytes=None):
     """
     return HttpResponse(
         Bucket('StevesBucket').file_bytes(file_name),
         content_type='image/jpeg')
-    """
-    if re.compile(r'[\/\\]').search(file_name):
-      raise Exception(
-          'I\'m expecting simply a file_name I can download, '
-          'not a path to a file that\'s already downloaded.')
-    for tries in range(3):
-      if not os.path.exists(file_name):  # More or less always.
-        # This throws an exception if the file doesn't exist on Bucket.
-        self.download(file_name)
-      # So if we get here, we know the file exists on Bucket. So far so good.
-      # But one time, this open call here triggered a FileNotFoundError. Now, I
-      # could see that happening if somebody opens a pile of tabs that all try
-      # to load this image at once, and then there's a race where
-      # os.path.exists at first but then before open gets called, a different
-      # thread runs os.remove. My answer is to take 3 tries to load an image.
-      try:
-        f = open(file_name, 'rb')
-      except FileNotFoundError:
-        continue
-      read = f.read()
-      f.close()
-      self.rm_download(file_name)
-      return read
-    log_error('Never able to download and read an image', (
-        'I tried 3 times to download and read {}').format(file_name))
+
+    This reads straight out of S3 into memory, so concurrent requests for the
+    same file don't trip over each other. If the file is bigger than max_bytes
+    this raises a FileTooBigException instead of reading the whole thing. If
+    the file doesn't exist this returns None. If you turned on the FileCache in
+    djaveS3.file_cache, this reads through it. """
+    return self.file_bytes_and_metadata(file_name, max_bytes=max_bytes)[0]
+
+  def file_bytes_and_metadata(self, file_name, max_bytes=None):
+    """ Same as file_bytes, but returns (bytes, FileMetadata), or (None, None)
+    if the file doesn't exist. """
+    check_file_name(file_name)
+
+    def read_response(response):
+      return read_body(response, file_name, max_bytes)
+    try:
+      if self.file_cache:
+        read, metadata = self.file_cache.read(self, file_name, read_response)
+        if max_bytes is not None and len(read) > max_bytes:
+          raise FileTooBigException(file_name, len(read), max_bytes)
+        return read, metadata
+      response = self.get_object(file_name)
+      return read_response(response), metadata_from_response(response)
+    except ClientError as ex:
+      if client_error_code(ex) in NO_SUCH_KEY_CODES:
+        return None, None
+      raise ex
+
+  def iter_file_bytes(self, file_name, chunk_size=DEFAULT_CHUNK_SIZE):
+    """ Generate the bytes of file_name chunk_size bytes at a time, so the
+    whole file never has to be in memory at once. """
+    check_file_name(file_name)
+    return iter_body(self.get_object(file_name)['Body'], chunk_size)
 
   def utf8_encoded_image(self, file_name):
-    return base64.b64encode(self.file_bytes(file_name)).decode('utf-8')
+    read = self.file_bytes(file_name)
+    if read is None:
+      log_error('Unable to encode an image', (
+          '{} does not exist in {}').format(file_name, self.name()))
+      return None
+    return base64.b64encode(read).decode('utf-8')
 
-  def upload(self, file_name, remote_file_name=None):
+  def upload(self, file_name, remote_file_name=None, callback=None):
+    """ callback gets called with TransferStats as the upload progresses. """
     remote_file_name = remote_file_name or file_name
-    self.boto_client.upload_file(
-        file_name, self.bucket_config.name, remote_file_name)
+    self._forget_cached([remote_file_name])
+    self.backend.put_file(file_name, remote_file_name, callback=callback)
+
+  def upload_fileobj(
+      self, fileobj, remote_file_name, content_type=None, callback=None):
+    """ Upload whatever's in fileobj, say a BytesIO, from wherever it's
+    currently positioned. """
+    self._forget_cached([remote_file_name])
+    self.backend.put(
+        remote_file_name, fileobj, content_type=content_type,
+        callback=callback)
 
   def delete(self, file_name):
     """ Regardless of whether file_name exists or not in the bucket, this will
     return a 204. """
-    got = self.boto_client.delete_object(
-        Bucket=self.bucket_config.name, Key=file_name)
-    return got['ResponseMetadata']['HTTPStatusCode'] == 204
+    self._forget_cached([file_name])
+    return self.backend.delete(file_name)
+
+  def delete_many(self, file_names):
+    """ Delete a pile of files, DELETE_MANY_BATCH_SIZE per request. Like
+    delete, it's fine if some of these files don't exist. Returns
+    {file_name: error message} for every file that S3 refused to delete, so an
+    empty dict means it all worked. """
+    file_names = list(file_names)
+    self._forget_cached(file_names)
+    return self.backend.delete_many(file_names)
+
+  def presigned_url(self, file_name, expires_in=60, response_headers=None):
+    """ A URL anybody can use to GET file_name for the next expires_in
+    seconds. response_headers is like {'ResponseContentType': 'image/jpeg'}
+    and pins headers on the response. See RESPONSE_HEADER_PARAMS in
+    djaveS3.storage_backends. Don't hand one of these out until your security
+    checks pass. """
+    check_file_name(file_name)
+    return self.backend.presign_get(
+        file_name, expires_in, response_headers=response_headers)
+
+  def generate_presigned_post(
+      self, file_name, fields, conditions, expires_in=3600):
+    return self.backend.presign_post(
+        file_name, fields, conditions, expires_in)
+
+  def _forget_cached(self, file_names):
+    if self.file_cache:
+      for file_name in file_names:
+        self.file_cache.invalidate(self.name(), file_name)
 
   def __repr__(self):
     return '<Bucket {}>'.format(self.bucket_config.name)
+
+
+def read_body(response, file_name, max_bytes=None):
+  """ Read the Body of a get_object response. """
+  body = response['Body']
+  try:
+    if max_bytes is None:
+      return body.read()
+    size = response.get('ContentLength')
+    if size is not None and size > max_bytes:
+      raise FileTooBigException(file_name, size, max_bytes)
+    # S3 doesn't always tell you ContentLength, so read one byte more than
+    # allowed to find out if it's too big.
+    read = body.read(max_bytes + 1)
+    if len(read) > max_bytes:
+      raise FileTooBigException(file_name, None, max_bytes)
+    return read
+  finally:
+    body.close()
+
+
+def iter_body(body, chunk_size=DEFAULT_CHUNK_SIZE):
+  """ body is a file like object, such as the streaming Body of a get_object
+  response. """
+  try:
+    while True:
+      chunk = body.read(chunk_size)
+      if not chunk:
+        return
+      yield chunk
+  finally:
+    body.close()
+
+
+def check_file_name(file_name):
+  if re.compile(r'[\/\\]').search(file_name):
+    raise Exception(
+        'I\'m expecting simply a file_name I can download, '
+        'not a path to a file that\'s already downloaded.')
+
+
+def client_error_code(client_error):
+  return str(client_error.response.get('Error', {}).get('Code', ''))
@@ -1,17 +1,25 @@
 from datetime import timedelta
+import heapq
+from operator import itemgetter
 
 from django.conf import settings
-from django.db.models import Q
+from django.db.models import Exists, OuterRef, Q, prefetch_related_objects
 from djaveDT import now
-from djaveS3.models.bucket import Bucket
-from djaveS3.models.file import File
+from djavError.log_error import log_error
+from djaveS3.get_bucket_config import get_bucket_config
+from djaveS3.models.bucket import Bucket, DELETE_MANY_BATCH_SIZE
+from djaveS3.models.cleanup_checkpoint import CheckpointedRun
+from djaveS3.models.file import File, as_child_classes, deletable_file_names
+from djaveS3.models.rendition_file import RenditionFile
 from djaveS3.models.signed_file import SignedFile
 from djaveS3.public_file_url import public_file_url
+from djaveS3.s3_executor import S3WorkExecutor, RETRY_CODES
 from djaveThread.background_command import background_command
 
 
 @background_command
-def clean_up_never_used(nnow=None, bucket=None):
+def clean_up_never_used(
+    nnow=None, bucket=None, executor=None, seconds=None, items=None):
   """ I find out about every file that users upload because the server has to
   sign them. But WHY they're being used doesn't become clear until somebody
   creates a File object, and then the child class explains everything. So
@@ -21,24 +29,62 @@ def clean_up_never_used(nnow=None, bucket=None):
   submit the form that says why they uploaded that file.
 
   Once we know whether or not a file is used, we no longer need the
-  SignedFile. """
+  SignedFile.
+
+  File.s3_bucket_name makes this a couple of set based queries no matter how
+  many SignedFiles there are, so the only per file work is the actual
+  deleting of abandoned uploads. You can limit how many seconds or items that
+  takes, and the next run picks up where this one left off. Returns
+  CleanupProgress. See djaveS3.models.cleanup_checkpoint """
   nnow = nnow or now()
+  buckets = {}
+  deleter = BatchedDelete(_delete_signed_file_rows, executor=executor)
   # It may take a moment for the background thread to catch up and use a file,
   # or it may take the user a while to submit the form that says how to use the
   # file they just uploaded. So give it a day for the reason for the upload to
   # show up, and if it doesn't, chuck the upload.
-  for signed in SignedFile.objects.filter(
-      created__lte=nnow - timedelta(days=1)).order_by('pk'):
-    if not signed_file_is_used(signed):
-      signed.delete_file(bucket=bucket)
-    signed.delete()
+  stale = SignedFile.objects.filter(created__lte=nnow - timedelta(days=1))
+  used = Exists(_matching_files(s3_bucket_name=OuterRef('bucket_name')))
+  # Files from before File.s3_bucket_name existed don't know their bucket
+  # yet, so those need a closer look, the slow way.
+  unknown = Exists(_matching_files(s3_bucket_name=''))
+  # Used files are easy. Their SignedFiles can go in one DELETE.
+  stale.filter(used).delete()
+  run = CheckpointedRun(
+      'clean_up_never_used', stale.filter(~used).annotate(unknown=unknown),
+      seconds=seconds, items=items)
+  used_pks = []
+  for chunk in run.chunks():
+    for signed in chunk:
+      if signed.unknown and signed_file_is_used(signed):
+        used_pks.append(signed.pk)
+      else:
+        # Everything else is an abandoned upload.
+        deleter.add(
+            bucket or _bucket_for(buckets, signed.bucket_name),
+            [signed.file_name], signed.pk)
+  deleter.flush()
+  for start in range(0, len(used_pks), DELETE_MANY_BATCH_SIZE):
+    _delete_signed_file_rows(used_pks[start:start + DELETE_MANY_BATCH_SIZE])
+  return run.finish()
+
+
+def _matching_files(**kwargs):
+  return File.objects.filter(file_name=OuterRef('file_name'), **kwargs)
+
+
+def _delete_signed_file_rows(pks):
+  if pks:
+    SignedFile.objects.filter(pk__in=pks).delete()
 
 
 def signed_file_is_used(signed_file):
-  for name_match in File.objects.filter(
-      file_name=signed_file.file_name):
-    # we gotta make sure it's also a bucket match because different buckets can
-    # have files with the same name.
+  # we gotta make sure it's also a bucket match because different buckets can
+  # have files with the same name.
+  name_matches = File.objects.filter(file_name=signed_file.file_name)
+  if name_matches.filter(s3_bucket_name=signed_file.bucket_name).exists():
+    return True
+  for name_match in name_matches.filter(s3_bucket_name=''):
     next_bucket_name = name_match.as_child_class().bucket_config().name
     if next_bucket_name == signed_file.bucket_name:
       return True
@@ -46,77 +92,357 @@ def signed_file_is_used(signed_file):
 
 
 @background_command
-def clean_up_no_longer_needed(nnow=None, bucket=None):
+def fill_in_s3_bucket_names(batch_size=1000):
+  """ Files saved before File.s3_bucket_name existed don't have one. Run this
+  once after you migrate so clean_up_never_used never has to look at child
+  classes. """
+  # Paging by primary key means files that as_child_classes can't find don't
+  # end the run early, and files that don't get a name don't come back around.
+  last_pk = 0
+  while True:
+    batch = list(File.objects.filter(
+        s3_bucket_name='', pk__gt=last_pk).order_by('pk')[:batch_size])
+    if not batch:
+      return
+    last_pk = batch[-1].pk
+    files = as_child_classes(batch)
+    for file in files:
+      file.s3_bucket_name = file.bucket_config().name
+      if not file.s3_bucket_name:
+        raise Exception(
+            '{} has a bucket_config with no name, so I can not tell which '
+            'bucket it is in'.format(file))
+    # bulk_update saves the field on the File table, where it lives.
+    File.objects.bulk_update(files, ['s3_bucket_name'])
+    if len(batch) < batch_size:
+      return
+
+
+CLEAN_UP_CHUNK_SIZE = 1000
+
+
+@background_command
+def clean_up_no_longer_needed(
+    nnow=None, bucket=None, chunk_size=CLEAN_UP_CHUNK_SIZE, executor=None,
+    seconds=None, items=None):
   """ Files have to describe when they can be thrown out. bucket is just used
   in tests to inject dependencies, but in case anybody actually tries to just
   clean_up_no_longer_needed in a specific bucket, I only deal with files in
-  bucket if provided. """
+  bucket if provided.
+
+  Expired files come out of the database chunk_size at a time, in primary key
+  order, so memory stays flat however many there are. Each chunk costs a
+  query per child class to find out what the files are, one bulk_update for
+  the new keep_untils, and the deletes get batched up. Note that this saves
+  keep_until without calling save on your File child classes.
+
+  Like clean_up_never_used, this takes a budget of seconds or items, resumes
+  where the last run left off and returns CleanupProgress. """
   nnow = nnow or now()
+  buckets = {}
+  deleter = BatchedDelete(_delete_file_rows, executor=executor)
   # Sometimes a single empty file name slips into the database. There's a
   # unique constraint, so only 1 empty file_name is allowed haha Anyway
   # obviously you can't delete a file with no name.
-  for file in File.objects.filter(
-      ~Q(file_name=''), keep_until__lt=nnow):
-    file = file.as_child_class()
-    if bucket and bucket.name() != file.bucket_config().name:
-      continue
-    if file.explain_why_can_delete():
-      file.delete(bucket=bucket)
-    else:
-      file.calc_and_set_keep(nnow=nnow)
-      if file.keep_until >= nnow:
-        file.save()
+  expired = File.objects.filter(~Q(file_name=''), keep_until__lt=nnow)
+  job_name = 'clean_up_no_longer_needed'
+  if bucket:
+    expired = expired.filter(s3_bucket_name__in=[bucket.name(), ''])
+    job_name += ' ' + bucket.name()
+  # Paging by primary key instead of OFFSET means every chunk is just as fast
+  # as the first, and deleting rows as I go doesn't skip any.
+  run = CheckpointedRun(
+      job_name, expired, chunk_size=chunk_size, seconds=seconds, items=items)
+  # Doomed Files that left a copy in S3 behind for somebody else. Their rows
+  # don't actually go until the deleter gets to them, so without this, a File
+  # in a later chunk that shares that copy would think they still need it, and
+  # the copy would never go.
+  left_behind = set()
+  for chunk in run.chunks():
+    keep = []
+    files = as_child_classes(chunk)
+    # So all_file_names doesn't cost a query per file.
+    prefetch_related_objects(files, 'rendition_files')
+    doomed = []
+    for file in files:
+      bucket_config = file.bucket_config()
+      if bucket and bucket.name() != bucket_config.name:
+        continue
+      if file.explain_why_can_delete():
+        doomed.append((file, bucket_config))
       else:
-        raise Exception(
-            'Theres no reason to keep {} but calc_and_set_keep set '
-            'keep_until to {} which is in the past'.format(
-                file, file.keep_until))
+        file.calc_and_set_keep(nnow=nnow)
+        if file.keep_until < nnow:
+          raise Exception(
+              'Theres no reason to keep {} but calc_and_set_keep set '
+              'keep_until to {} which is in the past'.format(
+                  file, file.keep_until))
+        keep.append(file)
+    File.objects.bulk_update(keep, ['keep_until'])
+    # Copies in S3 that other Files still share stay put.
+    deletable = deletable_file_names(
+        (file for file, _ in doomed), also_going=left_behind)
+    for file, bucket_config in doomed:
+      if file.stored_file_name() not in deletable[file.pk]:
+        left_behind.add(file.pk)
+      deleter.add(
+          bucket or _bucket_for(buckets, bucket_config),
+          deletable[file.pk], file.pk)
+  deleter.flush()
+  return run.finish()
+
+
+def _delete_file_rows(pks):
+  if pks:
+    # This skips File.delete, but we already know we can delete these, and
+    # the files are already gone from S3.
+    File.objects.filter(pk__in=pks).delete()
+
+
+UNACCOUNTED = 'unaccounted'
+MISSING = 'missing'
 
 
 def list_unaccounted_images(
-    bucket, also_delete=False, also_print_urls=False):
+    bucket, also_delete=False, also_print_urls=False, executor=None):
   """ Actually list the contents of the directory and compare it with the File
   and SignedFile classes. If you specify also_delete, you'll remove anything
   that we don't recognize from S3. Wow is this function dangerous. Especially
   in production, list the files first and double check a few to make sure you
-  actually want to delete them. """
+  actually want to delete them.
+
+  This returns the set of unaccounted file names. See reconcile if there are
+  too many of those to keep in memory. """
   if not isinstance(bucket, Bucket):
     raise Exception(
         'bucket should be a Bucket object, not a {}'.format(bucket.__class__))
-  actual_files = set()
-  for file_name, modified_at in bucket.list():
-    actual_files.add(file_name)
-  known_files = set()
-  for file in File.objects.all():
-    known_files.add(file.file_name)
-  for signed_file in SignedFile.objects.all():
-    known_files.add(signed_file.file_name)
-  unaccounted = actual_files - known_files
-  if also_print_urls:
-    for file_name in unaccounted:
-      print(public_file_url(bucket, file_name))
   if also_delete:
-    if not hasattr(settings, 'DEV_BUCKET_NAMES'):
-      raise Exception(
-          'Before I delete any files from S3, I want you to list the dev '
-          'bucket names in settings.DEV_BUCKET_NAMES so I can make sure '
-          'you do not make the horrific mistake of asking a non-prod '
-          'environment to clean up a production bucket, which would delete '
-          'all files from the production bucket.')
-    dev_bucket_names = settings.DEV_BUCKET_NAMES
-
-    # settings.PROD should describe whether or not we're in a production
-    # environment. So you need something like this in your settings.py
-
-    # PROD = os.environ.get('PROD', default='False') == 'True'
-
-    if bucket not in dev_bucket_names and not settings.PROD:
-      raise Exception(
-          'It seems like youre trying to clean up images in a production S3 '
-          'bucket that are unaccounted for in a non production database. But '
-          'a non production database has no idea what images are in '
-          'production. So this would completely empty an entire S3 bucket of '
-          'production images, which is a terrible mistake.')
-    for file_name in unaccounted:
-      bucket.delete(file_name)
+    _check_ok_to_delete_unaccounted(bucket)
+  unaccounted = set()
+  deleter = BatchedDelete(lambda file_names: None, executor=executor)
+  for file_name, _ in reconcile(bucket):
+    unaccounted.add(file_name)
+    if also_print_urls:
+      if bucket.bucket_config.is_public:
+        print(public_file_url(bucket.bucket_config, file_name))
+      else:
+        print(file_name)
+    if also_delete:
+      deleter.add(bucket, [file_name], file_name)
+  deleter.flush()
   return unaccounted
+
+
+def reconcile(bucket, also_missing=False, page_size=1000):
+  """ Generate (file_name, UNACCOUNTED) for every file in bucket that isn't a
+  File, a RenditionFile or a SignedFile. If also_missing, also generate
+  (file_name, MISSING) for every one of those in bucket that isn't actually in
+  the bucket. Files that share a copy with another File count by their
+  blob_file_name. See djaveS3.models.dedupe
+
+  S3 lists files in order, and all the file name columns have indexes, so
+  this walks all of them in file name order at the same time, like the merge
+  step of a merge sort. Only a page of each is ever in memory, so it doesn't
+  matter how many files there are.
+
+  That only works if your database sorts file names the same way S3 does,
+  which is by their UTF-8 bytes. Postgres databases with a locale like
+  en_US.UTF-8 don't, so if I notice names coming back out of order I raise an
+  Exception rather than report files that aren't really unaccounted. """
+  s3_names = _check_order((
+      listed.key for listed in bucket.iter_list(page_size=page_size)),
+      'S3 bucket {}'.format(bucket.name()))
+  db_names = heapq.merge(
+      _check_order(_ordered_names(
+          File.objects.filter(blob_file_name=''), 's3_bucket_name',
+          page_size), 'File', key=itemgetter(0)),
+      _check_order(_ordered_names(
+          File.objects.exclude(blob_file_name=''), 's3_bucket_name',
+          page_size, name_field='blob_file_name'), 'File blob',
+          key=itemgetter(0)),
+      _check_order(_ordered_names(
+          RenditionFile.objects.all(), 'file__s3_bucket_name', page_size),
+          'RenditionFile', key=itemgetter(0)),
+      _check_order(_ordered_names(
+          SignedFile.objects.all(), 'bucket_name', page_size), 'SignedFile',
+          key=itemgetter(0)))
+  s3_name = next(s3_names, None)
+  db_name, db_bucket_name = next(db_names, (None, None))
+  last_missing = None
+  while s3_name is not None or db_name is not None:
+    if db_name is None or (s3_name is not None and s3_name < db_name):
+      yield s3_name, UNACCOUNTED
+      s3_name = next(s3_names, None)
+    elif s3_name is None or db_name < s3_name:
+      if also_missing and db_bucket_name == bucket.name() and (
+          db_name != last_missing):
+        last_missing = db_name
+        yield db_name, MISSING
+      db_name, db_bucket_name = next(db_names, (None, None))
+    else:
+      # Everybody knows about this one.
+      while db_name == s3_name:
+        db_name, db_bucket_name = next(db_names, (None, None))
+      s3_name = next(s3_names, None)
+
+
+def _ordered_names(
+    queryset, bucket_name_field, page_size, name_field='file_name'):
+  """ Generate (file name, bucket name) in file name order, page_size at a
+  time. If several rows have the same file name, I might skip some of the
+  repeats, which is fine because they're the same file. """
+  queryset = queryset.order_by(name_field).values_list(
+      name_field, bucket_name_field)
+  last_name = None
+  while True:
+    page = queryset
+    if last_name is not None:
+      page = page.filter(**{name_field + '__gt': last_name})
+    rows = list(page[:page_size])
+    for row in rows:
+      yield row
+    if len(rows) < page_size:
+      return
+    last_name = rows[-1][0]
+
+
+def _check_order(items, where, key=None):
+  last = None
+  for item in items:
+    file_name = key(item) if key else item
+    if last is not None and file_name < last:
+      raise Exception((
+          '{} came after {} in {}, so the database and S3 do not sort file '
+          'names the same way, so I can not reconcile them. Make sure '
+          'file_name columns use a binary collation, like "C" in '
+          'Postgres.').format(file_name, last, where))
+    last = file_name
+    yield item
+
+
+def _check_ok_to_delete_unaccounted(bucket):
+  if not hasattr(settings, 'DEV_BUCKET_NAMES'):
+    raise Exception(
+        'Before I delete any files from S3, I want you to list the dev '
+        'bucket names in settings.DEV_BUCKET_NAMES so I can make sure '
+        'you do not make the horrific mistake of asking a non-prod '
+        'environment to clean up a production bucket, which would delete '
+        'all files from the production bucket.')
+  dev_bucket_names = settings.DEV_BUCKET_NAMES
+
+  # settings.PROD should describe whether or not we're in a production
+  # environment. So you need something like this in your settings.py
+
+  # PROD = os.environ.get('PROD', default='False') == 'True'
+
+  if bucket.name() not in dev_bucket_names and not settings.PROD:
+    raise Exception(
+        'It seems like youre trying to clean up images in a production S3 '
+        'bucket that are unaccounted for in a non production database. But '
+        'a non production database has no idea what images are in '
+        'production. So this would completely empty an entire S3 bucket of '
+        'production images, which is a terrible mistake.')
+
+
+class BatchedDelete(object):
+  """ Collect files to delete from S3 and delete them DELETE_MANY_BATCH_SIZE
+  at a time instead of one request per file. Each add comes with an item, say a
+  primary key, and once all of that item's files are gone from S3, the item
+  gets passed to on_deleted so you can clean up the database.
+
+  The deletes run in an S3WorkExecutor, so several batches can be in flight
+  at once, and SlowDowns and 5xx errors get retried, including for individual
+  files within a batch. on_deleted always runs in the thread that called add
+  or flush, so it can use the database like normal. Items whose files S3
+  wouldn't delete never get passed to on_deleted. """
+  def __init__(self, on_deleted, executor=None):
+    self.on_deleted = on_deleted
+    # If you don't give me an executor I make one, and shut it down in flush.
+    self.executor = executor
+    self.own_executor = executor is None
+    # bucket name -> (bucket, [(file names, item)])
+    self.pending = {}
+    self.pending_counts = {}
+    # [(bucket, [(file names, item)], future)]
+    self.in_flight = []
+
+  def add(self, bucket, file_names, item):
+    name = bucket.name()
+    _, batch = self.pending.setdefault(name, (bucket, []))
+    batch.append((file_names, item))
+    self.pending_counts[name] = self.pending_counts.get(name, 0) + len(
+        file_names)
+    if self.pending_counts[name] >= DELETE_MANY_BATCH_SIZE:
+      self._flush(name)
+
+  def flush(self):
+    """ Send whatever's pending and wait for everything to finish. """
+    for name in list(self.pending):
+      self._flush(name)
+    while self.in_flight:
+      self._finish(*self.in_flight.pop(0))
+    if self.own_executor and self.executor:
+      self.executor.shutdown()
+      self.executor = None
+
+  def _flush(self, name):
+    bucket, batch = self.pending.pop(name)
+    del self.pending_counts[name]
+    if not self.executor:
+      self.executor = S3WorkExecutor()
+    # _delete does its own capping and retrying.
+    self.in_flight.append((bucket, batch, self.executor.submit_unwrapped(
+        self._delete, bucket, [
+            file_name for file_names, _ in batch
+            for file_name in file_names])))
+    # Don't let finished batches pile up in memory.
+    while len(self.in_flight) > 2 * self.executor.max_workers:
+      self._finish(*self.in_flight.pop(0))
+
+  def _delete(self, bucket, file_names):
+    """ This runs in the executor's threads. Returns {file name: error} just
+    like Bucket.delete_many """
+    errors = {}
+    attempt = 1
+    while True:
+      got = self.executor.call(bucket.delete_many, file_names)
+      retry = [
+          file_name for file_name, error in got.items()
+          if error.split(':')[0] in RETRY_CODES]
+      if not retry or attempt >= self.executor.max_attempts:
+        errors.update(got)
+        return errors
+      errors.update(
+          (file_name, error) for file_name, error in got.items()
+          if file_name not in retry)
+      self.executor.back_off(attempt)
+      file_names = retry
+      attempt += 1
+
+  def _finish(self, bucket, batch, future):
+    try:
+      errors = future.result()
+    except Exception as ex:
+      log_error('Unable to delete files from S3', '{} files in {}: {}'.format(
+          len(batch), bucket.name(), ex))
+      return
+    _log_delete_errors(bucket, errors)
+    self.on_deleted([
+        item for file_names, item in batch
+        if not any(file_name in errors for file_name in file_names)])
+
+
+def _bucket_for(buckets, bucket_config):
+  """ bucket_config can be a bucket name or a BucketConfig. buckets is a
+  cache of the Buckets I've already made. """
+  bucket_config = get_bucket_config(bucket_config)
+  if bucket_config.name not in buckets:
+    buckets[bucket_config.name] = Bucket(bucket_config)
+  return buckets[bucket_config.name]
+
+
+def _log_delete_errors(bucket, errors):
+  if errors:
+    log_error('Unable to delete files from S3', '\n'.join(
+        '{} in {}: {}'.format(file_name, bucket.name(), error)
+        for file_name, error in errors.items()))
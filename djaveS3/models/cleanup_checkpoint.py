@@ -0,0 +1,107 @@
+""" After a long outage, the backlog for clean_up_never_used or
+clean_up_no_longer_needed can take longer than your cron window, or your
+dyno's lifetime. So you can give each of those a budget of seconds and/or
+items, and they stop once they've spent it. They remember where they
+stopped in a CleanupCheckpoint and pick up from there next time, so a big
+backlog drains over several short runs without redoing any work.
+
+Each run returns CleanupProgress(processed, remaining, finished). processed
+is how many items this run got through, remaining is how many are still
+waiting, and finished says whether the backlog is empty. Once a job gets to
+the end of its backlog it starts back at the beginning next time. """
+from collections import namedtuple
+import time
+
+from django.db import models
+
+
+CleanupProgress = namedtuple('CleanupProgress', 'processed remaining finished')
+
+
+class CleanupCheckpoint(models.Model):
+  job_name = models.CharField(max_length=200, unique=True)
+  # Primary keys are the cursor. Everything up to and including last_pk is
+  # done. None means start from the beginning.
+  last_pk = models.BigIntegerField(null=True)
+  processed = models.BigIntegerField(default=0, help_text=(
+      'How many items the last run processed'))
+  remaining = models.BigIntegerField(null=True, help_text=(
+      'How many items were left after the last run'))
+  updated = models.DateTimeField(auto_now=True)
+
+  def __repr__(self):
+    return '<CleanupCheckpoint {}: {}>'.format(self.job_name, self.last_pk)
+
+
+class CheckpointedRun(object):
+  """ Hands out a queryset chunk_size rows at a time in primary key order,
+  starting wherever the last run of job_name left off, until the queryset
+  runs dry or the budget of seconds or items runs out. Call finish once
+  you're done with the chunks, and after whatever work they kicked off has
+  actually happened, to save the checkpoint.
+
+  run = CheckpointedRun('my_job', MyModel.objects.filter(...), seconds=300)
+  for chunk in run.chunks():
+    for thing in chunk:
+      do_stuff(thing)
+  return run.finish() """
+  def __init__(
+      self, job_name, queryset, chunk_size=1000, seconds=None, items=None):
+    self.job_name = job_name
+    self.queryset = queryset
+    self.chunk_size = chunk_size
+    self.deadline = (
+        time.monotonic() + seconds if seconds is not None else None)
+    self.items = items
+    self.processed = 0
+    self.drained = False
+    self.checkpoint = CleanupCheckpoint.objects.filter(
+        job_name=job_name).first()
+    self.last_pk = self.checkpoint.last_pk if self.checkpoint else None
+
+  def chunks(self):
+    # Rows behind where the last run left off can start matching the
+    # queryset after it's gone by, like files whose keep_until passes. So
+    # once I reach the end I go back around to the beginning, as far as where
+    # I started.
+    started_at = self.last_pk
+    up_to = None
+    while not self.out_of_budget():
+      chunk_size = self.chunk_size
+      if self.items is not None:
+        chunk_size = min(chunk_size, self.items - self.processed)
+      chunk = self.queryset.order_by('pk')
+      if self.last_pk is not None:
+        chunk = chunk.filter(pk__gt=self.last_pk)
+      if up_to is not None:
+        chunk = chunk.filter(pk__lte=up_to)
+      chunk = list(chunk[:chunk_size])
+      if chunk:
+        yield chunk
+        self.last_pk = chunk[-1].pk
+        self.processed += len(chunk)
+      if len(chunk) < chunk_size:
+        if started_at is None:
+          self.drained = True
+          return
+        self.last_pk = None
+        up_to = started_at
+        started_at = None
+
+  def out_of_budget(self):
+    if self.items is not None and self.processed >= self.items:
+      return True
+    return self.deadline is not None and time.monotonic() >= self.deadline
+
+  def finish(self):
+    if self.drained:
+      remaining = 0
+    else:
+      remaining = self.queryset.filter(pk__gt=self.last_pk).count() if (
+          self.last_pk is not None) else self.queryset.count()
+    checkpoint = self.checkpoint or CleanupCheckpoint(job_name=self.job_name)
+    checkpoint.last_pk = None if self.drained else self.last_pk
+    checkpoint.processed = self.processed
+    checkpoint.remaining = remaining
+    checkpoint.save()
+    return CleanupProgress(self.processed, remaining, self.drained)
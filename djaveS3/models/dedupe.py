@@ -0,0 +1,150 @@
+""" Every upload goes to its own random file name, so when a thousand users
+upload the same profile photo, that's a thousand copies in S3, a thousand
+resizes and a thousand copies in everybody's caches. So once an upload
+arrives, I work out a content_hash for it, and if another File of the same
+class in the same bucket already has that content, the new File just points
+at the other File's copy with blob_file_name, and its own upload gets thrown
+out. Photos only share with photos that are already resized, so the new one
+doesn't need resizing at all, although it still gets its post_resize. Photo
+child classes that override do_additional_resize_steps don't share by
+default. See shares_blobs in djaveS3.models.photo
+
+This only happens for Photos, when the resize queue gets to them. See _work in
+djaveS3.models.photo. Other Files never get a content_hash, so every one keeps
+its own copy. If you want them deduped too, call dedupe_files on them once
+they're uploaded.
+
+A File whose keep_until is in the past might be getting thrown out by
+clean_up_no_longer_needed right now, so nothing gets to share its copy. And
+just before sharing, I lock the other File's row and make sure it's still
+there and still being kept.
+
+The Files table is the reference count. A copy in S3 only gets deleted when
+the last File that keeps its bytes there goes. See deletable_file_names in
+djaveS3.models.file
+
+The ETag S3 gives a file uploaded in one piece is the MD5 of its bytes, so
+usually the content_hash doesn't cost more than a HEAD request. Multipart
+uploads have ETags with a -N on the end, and then I download the file and hash
+it myself. I can't tell encryption ETags apart, though. With SSE-KMS or SSE-C
+the ETag is 32 hex characters just like an MD5, but it isn't one, so in
+buckets like that identical uploads get different content_hashes and simply
+never share. The size is part of the content_hash too, to make accidental
+collisions that much less likely. """
+import hashlib
+import re
+
+from django.db import transaction
+from django.db.models import Q, prefetch_related_objects
+from djavError.log_error import log_error
+from djaveDT import now
+from djaveS3.models.clean_up_files import BatchedDelete
+from djaveS3.models.file import File, as_child_classes
+from djaveS3.s3_executor import S3WorkExecutor
+
+
+MD5_ETAG = re.compile(r'^[0-9a-f]{32}$')
+
+
+def dedupe_files(files, bucket=None, executor=None, nnow=None):
+  """ Work out the content_hash of each of files, which should be child
+  classes, and point the ones whose content is already in S3 at that copy.
+  Returns the files that still have their own copy. bucket can be overridden
+  for the sake of tests. The HEAD requests run in executor's threads. """
+  nnow = nnow or now()
+  files = list(files)
+  own_executor = executor is None
+  executor = executor or S3WorkExecutor()
+  try:
+    hashed = _hash(files, bucket, executor)
+    canonicals = _canonicals(hashed, nnow)
+    shared = []
+    for file in hashed:
+      canonical = canonicals.get(_blob_key(file))
+      if not canonical:
+        continue
+      with transaction.atomic():
+        if not _kept(File.objects.select_for_update().filter(
+            pk=canonical.pk), nnow).exists():
+          continue
+        file.share_blob(canonical)
+      shared.append(file)
+    # Now that nothing points at them anymore, throw out the extra uploads.
+    deleter = BatchedDelete(lambda pks: None, executor=executor)
+    for file in shared:
+      deleter.add(bucket or file._bucket(), [file.file_name], file.pk)
+    deleter.flush()
+  finally:
+    if own_executor:
+      executor.shutdown()
+  return [file for file in files if file not in shared]
+
+
+def content_hash_from_metadata(metadata):
+  """ The content_hash from a FileMetadata, or None if the ETag isn't an MD5.
+  """
+  etag = (metadata.etag or '').strip('"').lower()
+  if not MD5_ETAG.match(etag) or metadata.size is None:
+    return None
+  return 'md5:{}:{}'.format(etag, metadata.size)
+
+
+def content_hash_from_bytes(data):
+  return 'md5:{}:{}'.format(hashlib.md5(data).hexdigest(), len(data))
+
+
+def _content_hash(bucket, file_name):
+  content_hash = content_hash_from_metadata(bucket.head_object(file_name))
+  if content_hash:
+    return content_hash
+  data = bucket.file_bytes(file_name)
+  return content_hash_from_bytes(data) if data is not None else None
+
+
+def _hash(files, bucket, executor):
+  """ Set and save the content_hash of files that need one, and return the
+  files that have one. """
+  futures = [
+      (file, executor.submit(
+          _content_hash, bucket or file._bucket(), file.file_name))
+      for file in files
+      if file.shares_blobs() and not file.blob_file_name
+      and not file.content_hash]
+  for file, future in futures:
+    try:
+      file.content_hash = future.result() or ''
+    except Exception as ex:
+      log_error('Unable to work out a content hash', '{}: {}'.format(
+          file.file_name, ex))
+  File.objects.bulk_update(
+      [file for file, _ in futures if file.content_hash], ['content_hash'])
+  return [
+      file for file in files
+      if file.content_hash and not file.blob_file_name
+      and file.shares_blobs()]
+
+
+def _canonicals(hashed, nnow):
+  """ {_blob_key: the oldest File with that content that others can share}
+  """
+  if not hashed:
+    return {}
+  candidates = as_child_classes(_kept(File.objects.filter(
+      content_hash__in={file.content_hash for file in hashed},
+      blob_file_name=''), nnow).exclude(
+          pk__in=[file.pk for file in hashed]).order_by('pk'))
+  prefetch_related_objects(candidates, 'rendition_files')
+  canonicals = {}
+  for candidate in candidates:
+    if candidate.blob_is_ready():
+      canonicals.setdefault(_blob_key(candidate), candidate)
+  return canonicals
+
+
+def _kept(files, nnow):
+  """ The files that clean_up_no_longer_needed isn't about to throw out. """
+  return files.filter(Q(keep_until__isnull=True) | Q(keep_until__gte=nnow))
+
+
+def _blob_key(file):
+  return (file.s3_bucket_name, file.child_class_id, file.content_hash)
@@ -25,11 +25,16 @@ photos, so you probably want to inherit from Photo in djaveS3.models.photo
 which has resize tools.
 
 Files have to describe when they can be thrown out. This keeps cost and
-clutter down. I also keep cost and clutter down by resizing all photos. """
+clutter down. I also keep cost and clutter down by resizing all photos.
+
+And when the same photo gets uploaded over and over again, the Files all
+share one copy of it in S3. See djaveS3.models.dedupe """
 from abc import abstractmethod
 
+from django.contrib.contenttypes.models import ContentType
 from django.core.exceptions import ValidationError
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Q
 from djaveClassMagic import BaseKnowsChild
 from djaveS3.models.bucket import Bucket
 from djaveS3.public_file_url import public_file_url
@@ -47,10 +52,26 @@ class File(BaseKnowsChild):
   keep_until = models.DateTimeField(db_index=True, null=True, help_text=(
       'Once keep_until is in the past, if I can '
       'explain_why_can_delete, I will chuck this file.'))
+  # bucket_config() lives on the child class, so finding out which bucket a
+  # File is in used to cost a query per File. So I keep a copy of the bucket
+  # name right here, which lets clean_up_never_used match SignedFiles to Files
+  # in a single query. It gets set on every save. Files saved before this
+  # field existed have '' until fill_in_s3_bucket_names in
+  # djaveS3.models.clean_up_files gets to them.
+  s3_bucket_name = models.CharField(
+      max_length=200, default='', blank=True, db_index=True)
+  # Like 'md5:5d41402abc4b2a76b9719d911017c592:5' See djaveS3.models.dedupe
+  content_hash = models.CharField(
+      max_length=100, default='', blank=True, db_index=True)
+  # If some other File already had the same content, this is the file name in
+  # S3 that they share, and this File's own upload is gone. Otherwise it's ''.
+  blob_file_name = models.CharField(
+      max_length=200, default='', blank=True, db_index=True)
 
   def save(self, *args, **kwargs):
     if not self.file_name:
       raise Exception('File name is required!')
+    self.s3_bucket_name = self._bucket_config().name
     super().save(*args, **kwargs)
 
   @abstractmethod
@@ -78,8 +99,45 @@ class File(BaseKnowsChild):
           'Why are you deleting a file with no explanation for why '
           'we can delete it?'), child_instance)
     bucket = bucket or self._bucket()
-    bucket.delete(self.file_name)
-    return super().delete()
+    stored_file_name = self.stored_file_name()
+    with transaction.atomic():
+      # dedupe locks the File it's about to share with, so locking every File
+      # that keeps its bytes where I do means nobody can start sharing my copy
+      # while I decide whether to delete it.
+      list(File.objects.select_for_update().filter(
+          Q(pk=self.pk) | Q(blob_file_name=stored_file_name) | Q(
+              file_name=stored_file_name, blob_file_name='')))
+      file_names = deletable_file_names([child_instance])[self.pk]
+      if file_names == [self.file_name]:
+        bucket.delete(self.file_name)
+      else:
+        bucket.delete_many(file_names)
+      return super().delete()
+
+  def stored_file_name(self):
+    """ Where this File's bytes actually are in S3. """
+    return self.blob_file_name or self.file_name
+
+  def all_file_names(self):
+    """ Every file in S3 that goes when the last File that stores its bytes
+    there goes. """
+    return [self.stored_file_name()]
+
+  def shares_blobs(self):
+    """ Override this to return False if Files of your class with the same
+    content shouldn't share a copy in S3. Only Photos get deduped on their
+    own, when they get resized. Other Files only share if you call
+    dedupe_files in djaveS3.models.dedupe on them yourself. """
+    return True
+
+  def blob_is_ready(self):
+    """ Whether other Files can share this one's copy in S3 yet. """
+    return True
+
+  def share_blob(self, other):
+    """ Point this File at other's copy in S3, and save. """
+    self.blob_file_name = other.stored_file_name()
+    self.save()
 
   def clean(self):
     if not self.file_name:
@@ -87,14 +145,77 @@ class File(BaseKnowsChild):
     return super().clean()
 
   def public_file_url(self):
-    return public_file_url(self.bucket_config(), self.file_name)
+    return public_file_url(self.bucket_config(), self.stored_file_name())
+
+  def alternate_file_names(self):
+    """ {content type: file name} for copies of this file in other formats.
+    See ImageEncoding in djaveS3.bucket_config """
+    return {}
 
   def _bucket(self):
     return Bucket(self.as_child_class().bucket_config())
 
+  def _bucket_config(self):
+    try:
+      return self.bucket_config()
+    except NotImplementedError:
+      # I'm a File or a Photo, not the child class that knows its bucket.
+      return self.as_child_class().bucket_config()
+
   def __repr__(self):
     return '<{} {}: {}>'.format(
         self._meta.model_name, self.pk, self.file_name)
 
   class Meta:
     abstract = False  # This makes cleaning up files fairly simple.
+
+
+def referenced_file_names(file_names, excluding_pks=()):
+  """ Which of file_names some File, other than excluding_pks, still keeps
+  its bytes in. """
+  file_names = set(file_names)
+  referenced = File.objects.filter(
+      Q(blob_file_name__in=file_names) | Q(
+          file_name__in=file_names, blob_file_name='')).exclude(
+              pk__in=excluding_pks).values_list('file_name', 'blob_file_name')
+  return {
+      blob_file_name or file_name
+      for file_name, blob_file_name in referenced} & file_names
+
+
+def deletable_file_names(files, also_going=()):
+  """ {file pk: [the files in S3 that can go when that File goes]} for files
+  that are all about to go. A File that shares its copy in S3 with a File
+  that's staying only takes its own original upload with it. also_going is
+  the pks of other Files that are on their way out too, so they don't count
+  as staying. This costs one query no matter how many files there are. """
+  files = list(files)
+  referenced = referenced_file_names(
+      [file.stored_file_name() for file in files],
+      [file.pk for file in files] + list(also_going))
+  taken = set()
+  deletable = {}
+  for file in files:
+    stored_file_name = file.stored_file_name()
+    # Deleting a file that isn't there is fine, and this upload could still
+    # be there if deleting it after sharing didn't work.
+    file_names = [file.file_name] if file.blob_file_name else []
+    if stored_file_name not in referenced | taken:
+      taken.add(stored_file_name)
+      file_names = file.all_file_names() + file_names
+    deletable[file.pk] = file_names
+  return deletable
+
+
+def as_child_classes(files):
+  """ [file.as_child_class() for file in files] except with one query per
+  child class instead of one query per file. """
+  pks_by_child_class = {}
+  for file in files:
+    pks_by_child_class.setdefault(file.child_class_id, []).append(file.pk)
+  children = {}
+  for child_class_id, pks in pks_by_child_class.items():
+    model = ContentType.objects.get_for_id(child_class_id).model_class()
+    children.update(
+        (child.pk, child) for child in model.objects.filter(pk__in=pks))
+  return [children[file.pk] for file in files if file.pk in children]
@@ -1,27 +1,352 @@
+from collections import namedtuple
+from concurrent.futures import (
+    wait, FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor)
 from datetime import timedelta
+from io import BytesIO
 import os
+import threading
+import time
 
+import django
 from django.conf import settings
 from django.db import models
 from django.db.models import Q
+from djavError.log_error import log_error
 from djaveDT import now
-from djaveS3.models.file import File
+from djaveS3.bucket_config import ImageEncoding
+from djaveS3.file_types import (
+    suffix_from_content_type, AVIF_CONTENT_TYPE,
+    JPEG_CONTENT_TYPE, WEBP_CONTENT_TYPE)
+from djaveS3.models.cleanup_checkpoint import CleanupProgress
+from djaveS3.models.dedupe import dedupe_files
+from djaveS3.models.file import File, as_child_classes
+from djaveS3.models.rendition_file import RenditionFile
+from djaveS3.models.resize_job import (
+    claim_resize_jobs, enqueue_resize, fail_resize_job, finish_resize_jobs,
+    lease_seconds, ready_resize_job_count, renew_resize_jobs, ResizeJob)
+from djaveS3.public_file_url import public_file_url_root, public_file_urls
+from djaveS3.s3_executor import S3WorkExecutor
 from djaveThread.background_command import background_command
 from djaveThread.background import background
 from PIL import Image
 
 
+# See Image.resize. Bigger is slower and better. 3 is indistinguishable from
+# a plain resize.
+RESIZE_REDUCING_GAP = 3.0
+
+
+# Photo.renditions returns a list of these. name ends up in the rendition's
+# file name, so keep it short and url friendly, like 'thumb'.
+Rendition = namedtuple('Rendition', 'name max_width_or_height')
+# Photo.resized_images returns a list of these. data is a BytesIO. name is
+# None for the resized photo itself, including its copies in other formats.
+ResizedImage = namedtuple(
+    'ResizedImage', 'name file_name width height data content_type')
+# content type -> Pillow format
+PIL_FORMATS = {
+    JPEG_CONTENT_TYPE: 'JPEG', WEBP_CONTENT_TYPE: 'WEBP',
+    AVIF_CONTENT_TYPE: 'AVIF'}
+
+
+# ResizePipeline.resize calls on_wait at least this often.
+WAIT_SECONDS = 30
+# ResizePipeline steps
+DOWNLOAD = 'download'
+ENCODE = 'encode'
+UPLOAD = 'upload'
+# ResizePipeline.errors says this for photos that aren't usable images. There's
+# no point trying those again.
+BAD_IMAGE = 'Not a usable image'
+# The ResizeJob error for photos that got deleted. Those can't be resized
+# either.
+NO_FILE_NAME = 'This photo has no file_name'
+
+
 @background_command
-def resize_all(nnow=None, **kwargs):
+def resize_all(nnow=None, seconds=None, items=None, processes=None, **kwargs):
   """ If all we ever get is a SignedFile, then the image will never be
-  resized. """
+  resized. So this makes sure every photo from the last week that still isn't
+  resized has a ResizeJob, and then works the queue with work_resize_jobs,
+  with the same budget of seconds or items. Returns CleanupProgress. """
   nnow = nnow or now()
   photos = Photo.objects.filter(
       ~Q(file_name=''),  # Sometimes a single empty file name is in the db
       resized_at__isnull=True,
       created__gte=nnow - timedelta(days=7))
-  for photo in photos:
-    photo.as_child_class().resize(**kwargs)
+  enqueue_resize(photos.values_list('pk', flat=True).iterator(), nnow=nnow)
+  return work_resize_jobs(
+      seconds=seconds, items=items, processes=processes, nnow=nnow, **kwargs)
+
+
+@background_command
+def work_resize_jobs(
+    seconds=None, items=None, processes=None, batch_size=None, file_ids=None,
+    nnow=None, **kwargs):
+  """ Claim ResizeJobs, batch_size at a time, and resize their photos in a
+  ResizePipeline, until there aren't any more ready to go or the budget of
+  seconds or items runs out. Run as many of these at once as you like,
+  wherever you like. See djaveS3.models.resize_job. file_ids limits which
+  jobs this works on. nnow is what resized_at gets set to. Claims and leases
+  always go by the actual time. Returns CleanupProgress. """
+  deadline = time.monotonic() + seconds if seconds is not None else None
+  processed = 0
+  with ResizePipeline(
+      processes=processes, bucket=kwargs.get('bucket'),
+      image_opener=kwargs.get('image_opener')) as pipeline:
+    # Claiming more than the pipeline can hold would just make other workers
+    # wait on jobs that are sitting here.
+    batch_size = batch_size or pipeline.max_in_flight
+    while True:
+      if items is not None and processed >= items:
+        break
+      if deadline is not None and time.monotonic() >= deadline:
+        break
+      limit = batch_size if items is None else min(
+          batch_size, items - processed)
+      jobs = claim_resize_jobs(limit, file_ids=file_ids)
+      if not jobs:
+        break
+      processed += len(jobs)
+      _work(pipeline, jobs, nnow)
+  remaining = ready_resize_job_count()
+  return CleanupProgress(processed, remaining, not remaining)
+
+
+def _work(pipeline, jobs, nnow):
+  def keep_leases():
+    # Big batches of big photos can take a while. Renew once half the lease
+    # is gone so nobody else claims these while I'm still on them.
+    claimed_until = min(job.claimed_until for job in jobs)
+    if claimed_until - now() < timedelta(seconds=lease_seconds() / 2):
+      renew_resize_jobs(jobs)
+
+  photos = as_child_classes(File.objects.filter(
+      pk__in=[job.file_id for job in jobs]))
+  # Somebody may have called Photo.resize directly.
+  done = {photo.pk for photo in photos if photo.resized_at}
+  unresized = [
+      photo for photo in photos if photo.file_name and not photo.resized_at]
+  # Photos that turn out to be the same as one that's already resized just
+  # share that one's copy in S3, and that counts as resizing them.
+  own_copies = dedupe_files(
+      unresized, bucket=pipeline.bucket, executor=pipeline.executor,
+      nnow=nnow)
+  for photo in unresized:
+    if photo not in own_copies:
+      done.add(photo.pk)
+      photo.post_resize()
+  resized = pipeline.resize(own_copies, nnow=nnow, on_wait=keep_leases)
+  done.update(photo.pk for photo in resized)
+  finish_resize_jobs([job for job in jobs if job.file_id in done])
+  for job in jobs:
+    if job.file_id not in done:
+      error = pipeline.errors.get(job.file_id, NO_FILE_NAME)
+      fail_resize_job(
+          job, error, give_up=error in (BAD_IMAGE, NO_FILE_NAME))
+
+
+class ResizePipeline(object):
+  """ Resizes a pile of photos at once. Decoding, resizing and encoding is
+  CPU bound, and threads can't help with that because of the GIL, so that
+  happens in a pool of processes. Meanwhile downloads and uploads overlap in
+  an S3WorkExecutor's threads. Only so many photos are in flight at once so
+  the originals don't pile up in memory.
+
+  With processes=1 the CPU part happens in a single thread instead, which is
+  handy in tests because nothing has to get pickled.
+
+  Everything that got resized gets its resized_at set in a single UPDATE per
+  resize call instead of saving photos one at a time. The database only ever
+  gets used from the thread that calls resize. """
+  def __init__(
+      self, processes=None, executor=None, bucket=None, image_opener=None):
+    # bucket and image_opener can be overridden for the sake of tests.
+    self.processes = processes or getattr(
+        settings, 'S3_RESIZE_PROCESSES', None) or os.cpu_count() or 1
+    if self.processes > 1:
+      # Forked processes already have Django set up, but processes that get
+      # spawned, like on a Mac, don't.
+      self.pool = ProcessPoolExecutor(
+          max_workers=self.processes, initializer=django.setup)
+    else:
+      self.pool = ThreadPoolExecutor(max_workers=1)
+    # If you don't give me an executor I make one, and shut it down in
+    # shutdown.
+    self.own_executor = executor is None
+    self.executor = executor or S3WorkExecutor()
+    self.bucket = bucket
+    self.image_opener = image_opener
+    self.max_in_flight = 2 * (self.processes + self.executor.max_workers)
+    # photo pk -> what went wrong, for the last call to resize
+    self.errors = {}
+
+  def resize(self, photos, nnow=None, on_wait=None):
+    """ photos should already be child classes. Returns the photos that got
+    resized, with their resized_at set to nnow. on_wait gets called every
+    WAIT_SECONDS or so while the photos are in flight, from this thread. """
+    waiting = list(reversed(list(photos)))
+    # future -> (step, photo, bucket)
+    in_flight = {}
+    # photo pk -> [ResizedImage]
+    uploading = {}
+    # photo pk -> how many of its uploads haven't finished yet
+    uploads_left = {}
+    failed = set()
+    resized = []
+    # photo pk -> what went wrong
+    self.errors = {}
+    while waiting or in_flight:
+      while waiting and len(in_flight) < self.max_in_flight:
+        photo = waiting.pop()
+        bucket = self.bucket or photo._bucket()
+        in_flight[self.executor.submit(
+            bucket.download_fileobj, photo.file_name)] = (
+                DOWNLOAD, photo, bucket)
+      done, _ = wait(
+          in_flight, timeout=WAIT_SECONDS, return_when=FIRST_COMPLETED)
+      if on_wait:
+        on_wait()
+      for future in done:
+        step, photo, bucket = in_flight.pop(future)
+        try:
+          result = future.result()
+        except Exception as ex:
+          log_error('Unable to resize a photo', '{} in {}: {}'.format(
+              photo.file_name, bucket.name(), ex))
+          self.errors[photo.pk] = '{} failed: {}'.format(step, ex)
+          if step == UPLOAD:
+            failed.add(photo.pk)
+            self._uploaded(photo, uploads_left, uploading, failed, resized)
+          continue
+        if step == DOWNLOAD:
+          in_flight[self.pool.submit(
+              photo.resized_images, result,
+              image_opener=self.image_opener)] = (ENCODE, photo, bucket)
+        elif step == ENCODE and result is None:
+          self.errors[photo.pk] = BAD_IMAGE
+          photo.notify_bad_image()
+        elif step == ENCODE:
+          uploading[photo.pk] = result
+          uploads_left[photo.pk] = len(result)
+          for image in result:
+            in_flight[self.executor.submit(
+                bucket.upload_fileobj, image.data, image.file_name,
+                content_type=image.content_type)] = (UPLOAD, photo, bucket)
+        else:
+          self._uploaded(photo, uploads_left, uploading, failed, resized)
+    save_resized(resized, nnow or now())
+    for photo, _ in resized:
+      photo.post_resize()
+    return [photo for photo, _ in resized]
+
+  def _uploaded(self, photo, uploads_left, uploading, failed, resized):
+    uploads_left[photo.pk] -= 1
+    if uploads_left[photo.pk]:
+      return
+    del uploads_left[photo.pk]
+    images = uploading.pop(photo.pk)
+    if photo.pk in failed:
+      failed.remove(photo.pk)
+    else:
+      resized.append((photo, images))
+
+  def shutdown(self):
+    self.pool.shutdown(wait=True)
+    if self.own_executor:
+      self.executor.shutdown()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.shutdown()
+
+
+def save_resized(photos_and_images, resized_at):
+  """ photos_and_images is [(photo, [ResizedImage])]. Record that all those
+  photos got resized, and what renditions they have now, in one bulk_update
+  and one bulk_create no matter how many photos there are. This doesn't call
+  save on your Photo child classes. """
+  if not photos_and_images:
+    return
+  rendition_files = []
+  for photo, images in photos_and_images:
+    photo.resized_at = resized_at
+    rendition_files.extend(_take_in_resized_images(photo, images))
+  Photo.objects.bulk_update(
+      [photo for photo, _ in photos_and_images],
+      ['resized_at', 'width', 'height'])
+  # Resizing the same photo twice makes the same renditions twice.
+  RenditionFile.objects.bulk_create(rendition_files, ignore_conflicts=True)
+
+
+def _take_in_resized_images(photo, images):
+  """ Set photo's width and height, and return RenditionFiles for the rest of
+  the images. """
+  rendition_files = []
+  for image in images:
+    if image.file_name == photo.file_name:
+      photo.width = image.width
+      photo.height = image.height
+    else:
+      rendition_files.append(RenditionFile(
+          file_id=photo.pk, name=image.name or '', file_name=image.file_name,
+          width=image.width, height=image.height,
+          content_type=image.content_type))
+  return rendition_files
+
+
+def rendition_file_name(file_name, name):
+  """ rendition_file_name('Ab3dE.png', 'thumb') == 'Ab3dE_thumb.jpg' because
+  renditions are always JPEGs. """
+  return '{}_{}.jpg'.format(os.path.splitext(file_name)[0], name)
+
+
+def _fit(width, height, max_width_or_height):
+  """ The size that shrinks (width, height) to fit in max_width_or_height, or
+  None if it already fits. """
+  max_dimension = max((width, height))
+  if max_dimension <= max_width_or_height:
+    return None
+  ratio = max_width_or_height / max_dimension
+  return (int(ratio * width), int(ratio * height))
+
+
+def alternate_file_name(file_name, content_type):
+  """ alternate_file_name('Ab3dE.png', WEBP_CONTENT_TYPE) == 'Ab3dE.png.webp'
+  """
+  return '{}.{}'.format(file_name, suffix_from_content_type(content_type))
+
+
+def can_encode(content_type):
+  """ Whether this Pillow can write content_type. AVIF needs Pillow 11.2 or
+  pillow-avif-plugin. """
+  Image.init()
+  return PIL_FORMATS.get(content_type) in Image.SAVE
+
+
+def _encoded(name, file_name, image, encoding):
+  """ [ResizedImage] with image as a JPEG, and in each of the
+  alternate_formats in encoding that Pillow can write. """
+  encoded = [_save(
+      name, file_name, image, JPEG_CONTENT_TYPE, quality=encoding.quality,
+      progressive=encoding.progressive, optimize=encoding.optimize,
+      subsampling=encoding.subsampling)]
+  for content_type in encoding.alternate_formats:
+    if can_encode(content_type):
+      encoded.append(_save(
+          name, alternate_file_name(file_name, content_type), image,
+          content_type, quality=encoding.quality))
+  return encoded
+
+
+def _save(name, file_name, image, content_type, **kwargs):
+  data = BytesIO()
+  image.save(data, format=PIL_FORMATS[content_type], **kwargs)
+  data.seek(0)
+  return ResizedImage(
+      name, file_name, image.width, image.height, data, content_type)
 
 
 @background
@@ -31,11 +356,48 @@ def _do_resize_background(photo_id, **kwargs):
   # Put something like this in your settintgs.py TEST = 'test' in sys.argv
   if settings.TEST and 'bucket' not in kwargs:
     return
-  File.objects.get(pk=photo_id).as_child_class().resize(**kwargs)
+  # This is just to get the photo resized sooner. If some other worker
+  # already claimed the job, this does nothing, and if this process dies, the
+  # job is still in the queue. Unlike work_resize_jobs, this doesn't count
+  # the whole queue, and every save shares one pipeline instead of starting
+  # up its own threads.
+  if 'bucket' in kwargs or 'image_opener' in kwargs:
+    with ResizePipeline(
+        processes=1, bucket=kwargs.get('bucket'),
+        image_opener=kwargs.get('image_opener')) as pipeline:
+      _work_one(pipeline, photo_id)
+    return
+  with _background_pipeline_lock:
+    _work_one(_get_background_pipeline(), photo_id)
+
+
+def _work_one(pipeline, photo_id):
+  jobs = claim_resize_jobs(1, file_ids=[photo_id])
+  if jobs:
+    _work(pipeline, jobs, None)
+
+
+# Shared by every background resize in this process. The lock means only one
+# of those uses it at a time, and _background_pipeline_pid means a forked
+# process makes its own.
+_background_pipeline = None
+_background_pipeline_pid = None
+_background_pipeline_lock = threading.Lock()
+
+
+def _get_background_pipeline():
+  global _background_pipeline, _background_pipeline_pid
+  if _background_pipeline_pid != os.getpid():
+    _background_pipeline = ResizePipeline(processes=1)
+    _background_pipeline_pid = os.getpid()
+  return _background_pipeline
 
 
 class Photo(File):
   resized_at = models.DateTimeField(null=True)
+  # The size of the resized photo. These stay None until it gets resized.
+  width = models.IntegerField(null=True)
+  height = models.IntegerField(null=True)
 
   def notify_bad_image(self, **kwargs):
     """ You can use this to start a conversation with whoever uploaded a bad
@@ -43,12 +405,16 @@ class Photo(File):
     anything. """
     pass
 
-  def do_additional_resize_steps(
-      self, input_file_name, output_file_name, **kwargs):
+  def do_additional_resize_steps(self, image, **kwargs):
     """ You can override this function if you want to have additional steps as
     part of resizing. Maybe you wanna blank out credit card numbers or
-    something.  """
-    pass
+    something. image is the resized RGB PIL Image. Return the image you want
+    uploaded, which can be the same one.
+
+    ResizePipeline runs this in ProcessPoolExecutor workers, on a pickled copy
+    of the photo, so it must not touch the database or S3. Anything it changed
+    on the photo wouldn't make it back anyway. """
+    return image
 
   def post_resize(self):
     pass
@@ -57,21 +423,23 @@ class Photo(File):
     """ kwargs so I can pass in a mock bucket in tests """
     super().save()
     if not self.resized_at:
+      enqueue_resize([self.pk])
       _do_resize_background(self.pk, **kwargs)
 
-  def resize(
-      self, verbose=False, image_opener=None, use_os=None, use_open=None,
-      **kwargs):
-    """ This is a whole thing, and should run only in the background. It tries
-    to run right away, but it also runs every night at midnight to help catch
-    problems, so there are races possible, such as both threads trying to
-    delete the working images. """
+  def resize(self, verbose=False, image_opener=None, **kwargs):
+    """ This is a whole thing, and should run only in the background. Saving
+    an unresized photo puts it in the ResizeJob queue, and whoever claims the
+    job resizes it, so normally nothing calls this directly. See
+    djaveS3.models.resize_job
+
+    Everything happens in memory. The original comes down into a buffer, and
+    the resized photo goes back up from a buffer, so there are no working
+    files to clean up. JPEGs get decoded at a reduced scale to begin with
+    because there's no sense decoding all 12 megapixels of a phone photo just
+    to shrink it down to 800 pixels. """
     if self.resized_at:
       return True
 
-    image_opener = image_opener or Image.open
-    use_os = use_os or os
-    use_open = use_open or open
     bucket = kwargs.get('bucket', None) or self._bucket()
 
     if self.__class__ in (File, Photo):
@@ -80,16 +448,133 @@ class Photo(File):
       return
     if not self.file_name:
       raise Exception('This photo was deleted and can\'t be recovered.')
-    bucket.download(self.file_name)
+    original = bucket.download_fileobj(self.file_name)
+    images = self.resized_images(
+        original, image_opener=image_opener, **kwargs)
+    if images is None:
+      self.notify_bad_image(**kwargs)
+      return False
+    for image in images:
+      bucket.upload_fileobj(
+          image.data, image.file_name, content_type=image.content_type)
+
+    self.resized_at = kwargs.get('nnow', now())
+    rendition_files = _take_in_resized_images(self, images)
+    self.save()
+    RenditionFile.objects.bulk_create(rendition_files, ignore_conflicts=True)
+    ResizeJob.objects.filter(file_id=self.pk).delete()
+
+    self.post_resize()
+    return True
+
+  def renditions(self):
+    """ Override this if you want smaller copies of your photos, like
+    [Rendition('thumb', 120), Rendition('medium', 400)]. They all get made
+    from the same decode as the resized photo itself, which stays at
+    max_width_or_height, and they get stored next to it under
+    rendition_file_name. See photo_srcset in djaveS3.templatetags.photo_extras
+    for how to use them. """
+    return []
 
+  def image_encoding(self):
+    """ How resized photos get saved. Override this if you want, but by
+    default it's the image_encoding of the bucket_config, or ImageEncoding()
+    if that's not set. See ImageEncoding in djaveS3.bucket_config """
+    return self.bucket_config().image_encoding or ImageEncoding()
+
+  def all_file_names(self):
+    return super().all_file_names() + [
+        rendition_file.file_name
+        for rendition_file in self.rendition_files.all()]
+
+  def shares_blobs(self):
+    """ do_additional_resize_steps can make each photo come out different,
+    like with a watermark, even when the uploads are the same. So if your
+    child class overrides it, its photos don't share, unless you override
+    this too. """
+    return type(self).do_additional_resize_steps is (
+        Photo.do_additional_resize_steps)
+
+  def blob_is_ready(self):
+    # Photos that share a copy skip resizing, so the copy had better already
+    # be resized.
+    return self.resized_at is not None
+
+  def share_blob(self, other):
+    """ Photos share other's renditions and size too. """
+    self.resized_at = other.resized_at
+    self.width = other.width
+    self.height = other.height
+    super().share_blob(other)
+    RenditionFile.objects.bulk_create([
+        RenditionFile(
+            file_id=self.pk, name=rendition_file.name,
+            file_name=rendition_file.file_name, width=rendition_file.width,
+            height=rendition_file.height,
+            content_type=rendition_file.content_type)
+        for rendition_file in other.rendition_files.all()],
+        ignore_conflicts=True)
+
+  def alternate_file_names(self):
+    return {
+        rendition_file.content_type: rendition_file.file_name
+        for rendition_file in self.rendition_files.all()
+        if not rendition_file.name}
+
+  def public_file_url(self, accept=None):
+    """ Pass in the request's Accept header,
+    request.META.get('HTTP_ACCEPT'), to get the url of a WebP or AVIF copy if
+    the browser takes those. If you cache the page, it has to Vary on Accept.
+    Otherwise use photo_srcset in a <picture> and let the browser choose. """
+    return public_file_urls([self], accept=accept)[0]
+
+  def srcset(self, content_type=JPEG_CONTENT_TYPE):
+    """ The value of an img srcset attribute with the photo and all its
+    renditions, in content_type, which can be any of the alternate_formats in
+    image_encoding. If you're doing this for a bunch of photos,
+    prefetch_related('rendition_files') first. """
+    root = public_file_url_root(self.bucket_config())
+    sources = [
+        (rendition_file.file_name, rendition_file.width)
+        for rendition_file in self.rendition_files.all()
+        if rendition_file.content_type == content_type]
+    if content_type == JPEG_CONTENT_TYPE:
+      if not self.width:
+        # This hasn't been resized yet, so there's only the one file, and I
+        # don't know how wide it is.
+        return root + self.stored_file_name()
+      sources.append((self.stored_file_name(), self.width))
+    return ', '.join(
+        '{}{} {}w'.format(root, file_name, width)
+        for file_name, width in sorted(sources, key=lambda s: s[1]))
+
+  def resized_images(self, original, image_opener=None, **kwargs):
+    """ Decode original, which is a file like object, shrink it down to
+    max_width_or_height, and make the renditions from that. Returns a list of
+    ResizedImages, the resized photo first, or None if original isn't a
+    usable image.
+
+    ResizePipeline runs this in ProcessPoolExecutor workers, so if you
+    override it, it must not touch the database or S3 either. Downloading and
+    uploading happen back in the parent process. """
+    image_opener = image_opener or Image.open
     try:
-      image = image_opener(self.file_name)
+      image = image_opener(original)
     except OSError as ex:
       if ex.args[0].find('cannot identify image file') == 0:
-        self.notify_bad_image(**kwargs)
-        return False
+        return None
       raise ex
 
+    # Opening an image only reads its header, so I know how big it's going to
+    # end up before decoding anything.
+    new_size = _fit(image.width, image.height, self.max_width_or_height())
+    if new_size:
+      # The renditions are all smaller, so this is as big as it gets.
+      # JPEGs can decode at 1/2, 1/4 or 1/8 scale for a fraction of the work.
+      # draft picks the smallest of those that's still at least new_size.
+      # Other formats ignore this.
+      image.draft('RGB', new_size)
+
     # Sometimes people will upload pngs. Sometimes they'll upload pngs but
     # replace the file extension with jpg. Whatever, people are dumb at image
     # file formats. In any case just make sure it doesn't have an alpha channel
@@ -99,35 +584,28 @@ class Photo(File):
       image = image.convert('RGB')
     except OSError as ex:
       if ex.args[0].find('image file is truncated') == 0:
-        self.notify_bad_image(**kwargs)
-        return False
+        return None
       raise ex
 
-    (width, height) = (image.width, image.height)
-    max_dimension = max((width, height))
-    if max_dimension > self.max_width_or_height():
-      ratio = self.max_width_or_height() / max_dimension
-      image = image.resize((int(ratio * width), int(ratio * height)))
-
-    if use_os.path.exists(self.file_name):
-      use_os.remove(self.file_name)
-
-    # I don't use the handy `with ... as` because I didn't bother to figure out
-    # how to mock that whole thing in tests.
-    file_handle = use_open(self.file_name, 'wb')
-    image.save(file_handle, format='JPEG', quality=100)
-    file_handle.close()
+    if new_size:
+      # reducing_gap shrinks by whole multiples first, which is much faster,
+      # then resamples the rest of the way properly.
+      image = image.resize(new_size, reducing_gap=RESIZE_REDUCING_GAP)
 
-    self.do_additional_resize_steps(self.file_name, self.file_name, **kwargs)
+    image = self.do_additional_resize_steps(image, **kwargs) or image
 
-    bucket.upload(self.file_name)
-    use_os.remove(self.file_name)
-
-    self.resized_at = kwargs.get('nnow', now())
-    self.save()
-
-    self.post_resize()
-    return True
+    encoding = self.image_encoding()
+    images = _encoded(None, self.file_name, image, encoding)
+    for rendition in self.renditions():
+      rendition_size = _fit(
+          image.width, image.height, rendition.max_width_or_height)
+      rendition_image = image.resize(
+          rendition_size, reducing_gap=RESIZE_REDUCING_GAP) if (
+              rendition_size) else image
+      images.extend(_encoded(
+          rendition.name, rendition_file_name(self.file_name, rendition.name),
+          rendition_image, encoding))
+    return images
 
   def max_width_or_height(self):
     return 800.0
@@ -0,0 +1,32 @@
+""" A thumbnail grid of 120 pixel tiles shouldn't have to download 800 pixel
+photos. So Photo child classes can ask for renditions, which are smaller
+copies that get made at the same time the photo gets resized. Each rendition
+that actually made it to S3 gets a RenditionFile, so I know what to delete
+when the File goes, and so the reconciler knows these aren't strays. See
+renditions in djaveS3.models.photo
+
+Copies in other formats, like WebP, are RenditionFiles too. Those have a
+different content_type, and the copies of the resized photo itself have no
+name. """
+from django.db import models
+
+from djaveS3.file_types import JPEG_CONTENT_TYPE
+from djaveS3.models.file import File
+
+
+class RenditionFile(models.Model):
+  file = models.ForeignKey(
+      File, on_delete=models.CASCADE, related_name='rendition_files')
+  name = models.CharField(max_length=50, blank=True)
+  # Files that share a copy in S3 each have their own RenditionFiles for the
+  # same renditions. See djaveS3.models.dedupe
+  file_name = models.CharField(max_length=200, db_index=True)
+  width = models.IntegerField()
+  height = models.IntegerField()
+  content_type = models.CharField(max_length=50, default=JPEG_CONTENT_TYPE)
+
+  def __repr__(self):
+    return '<RenditionFile {}: {}>'.format(self.name, self.file_name)
+
+  class Meta:
+    unique_together = [('file', 'file_name')]
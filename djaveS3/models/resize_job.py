@@ -0,0 +1,132 @@
+""" Photos used to get resized from two places that didn't know about each
+other, a background thread on every Photo.save and the nightly resize_all, so
+they'd race and do the same work twice, and if the process died, the
+background thread's work just disappeared. Now both of those simply put a
+ResizeJob in this table, and whoever's working the queue claims jobs from it.
+
+Claiming uses select_for_update(skip_locked=True), so any number of worker
+processes on any number of dynos can work the queue at once without two of
+them ever downloading the same photo. A claimed job is leased for
+S3_RESIZE_JOB_LEASE_SECONDS, and the worker renews the lease while it's still
+at it, so if a worker dies, somebody else picks its jobs back up once the
+lease runs out. Jobs that fail get tried again later, waiting
+twice as long each time, and after S3_RESIZE_JOB_MAX_ATTEMPTS tries they go
+DEAD and stay in the table, with their last_error, for you to look at.
+
+S3_RESIZE_JOB_LEASE_SECONDS = 600
+S3_RESIZE_JOB_MAX_ATTEMPTS = 5
+
+See work_resize_jobs in djaveS3.models.photo """
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import models, transaction
+from django.db.models import F, Q
+from djaveDT import now
+from djaveS3.models.file import File
+
+
+PENDING = 'pending'
+CLAIMED = 'claimed'
+DEAD = 'dead'
+STATUSES = [PENDING, CLAIMED, DEAD]
+# Seconds before the first retry. It doubles from there.
+RETRY_DELAY = 60
+MAX_RETRY_DELAY = 6 * 60 * 60
+
+
+class ResizeJob(models.Model):
+  # Only one job per photo, which is what keeps enqueueing idempotent.
+  file = models.OneToOneField(
+      File, on_delete=models.CASCADE, related_name='resize_job')
+  status = models.CharField(
+      max_length=20, default=PENDING,
+      choices=[(status, status) for status in STATUSES])
+  attempts = models.IntegerField(default=0)
+  run_after = models.DateTimeField(db_index=True)
+  claimed_until = models.DateTimeField(null=True, help_text=(
+      'If the worker that claimed this job is still at it after this, it '
+      'probably died, so somebody else can claim it'))
+  last_error = models.TextField(default='', blank=True)
+  created = models.DateTimeField(auto_now_add=True)
+
+  def __repr__(self):
+    return '<ResizeJob {} {}: {}>'.format(
+        self.status, self.attempts, self.file_id)
+
+
+def enqueue_resize(file_ids, nnow=None):
+  """ Make a ResizeJob for each of file_ids that doesn't have one yet. This is
+  a single INSERT for up to a thousand files, and jobs that already exist,
+  including DEAD ones, are left alone. """
+  nnow = nnow or now()
+  file_ids = list(file_ids)
+  for start in range(0, len(file_ids), 1000):
+    ResizeJob.objects.bulk_create([
+        ResizeJob(file_id=file_id, run_after=nnow)
+        for file_id in file_ids[start:start + 1000]], ignore_conflicts=True)
+
+
+def claim_resize_jobs(limit, file_ids=None, nnow=None):
+  """ Claim up to limit jobs that are ready to run, and return them. Other
+  workers skip over these until the lease runs out. file_ids limits which jobs
+  to claim. """
+  nnow = nnow or now()
+  with transaction.atomic():
+    ready = ResizeJob.objects.select_for_update(skip_locked=True).filter(
+        Q(status=PENDING) | Q(status=CLAIMED, claimed_until__lt=nnow),
+        run_after__lte=nnow)
+    if file_ids is not None:
+      ready = ready.filter(file_id__in=file_ids)
+    jobs = list(ready.order_by('run_after', 'pk')[:limit])
+    claimed_until = nnow + timedelta(seconds=lease_seconds())
+    ResizeJob.objects.filter(pk__in=[job.pk for job in jobs]).update(
+        status=CLAIMED, claimed_until=claimed_until,
+        attempts=F('attempts') + 1)
+  for job in jobs:
+    job.status = CLAIMED
+    job.claimed_until = claimed_until
+    job.attempts += 1
+  return jobs
+
+
+def renew_resize_jobs(jobs, nnow=None):
+  """ I'm still working on these, so nobody else should claim them yet. """
+  claimed_until = (nnow or now()) + timedelta(seconds=lease_seconds())
+  ResizeJob.objects.filter(
+      pk__in=[job.pk for job in jobs], status=CLAIMED).update(
+          claimed_until=claimed_until)
+  for job in jobs:
+    job.claimed_until = claimed_until
+
+
+def lease_seconds():
+  return getattr(settings, 'S3_RESIZE_JOB_LEASE_SECONDS', 600)
+
+
+def finish_resize_jobs(jobs):
+  """ These worked, so they don't need to be in the queue anymore. """
+  ResizeJob.objects.filter(pk__in=[job.pk for job in jobs]).delete()
+
+
+def fail_resize_job(job, error, nnow=None, give_up=False):
+  """ Try again later, or if this has been tried enough times, or give_up,
+  leave it DEAD. """
+  nnow = nnow or now()
+  job.last_error = error
+  job.claimed_until = None
+  if give_up or job.attempts >= getattr(
+      settings, 'S3_RESIZE_JOB_MAX_ATTEMPTS', 5):
+    job.status = DEAD
+  else:
+    job.status = PENDING
+    job.run_after = nnow + timedelta(seconds=min(
+        MAX_RETRY_DELAY, RETRY_DELAY * 2 ** (job.attempts - 1)))
+  job.save()
+
+
+def ready_resize_job_count(nnow=None):
+  nnow = nnow or now()
+  return ResizeJob.objects.filter(
+      Q(status=PENDING) | Q(status=CLAIMED, claimed_until__lt=nnow),
+      run_after__lte=nnow).count()
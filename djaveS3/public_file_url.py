@@ -1,4 +1,5 @@
-from djaveS3.get_bucket_config import get_bucket_config
+from djaveS3.file_types import best_alternate
+from djaveS3.get_bucket_config import get_bucket_config, get_public_url_root
 
 
 def public_file_url(bucket_config, file_name):
@@ -7,8 +8,51 @@ def public_file_url(bucket_config, file_name):
 
 def public_file_url_root(bucket_config):
   # bucket_config can be a bucket name or a BucketConfig
+  if isinstance(bucket_config, str):
+    # Public bucket url roots get worked out once, at startup.
+    root = get_public_url_root(bucket_config)
+    if root:
+      return root
   bucket_config = get_bucket_config(bucket_config)
   if not bucket_config.is_public:
     raise Exception(
         'There is no public file url for files in sensitive buckets')
-  return 'https://{}.s3.amazonaws.com/'.format(bucket_config.name)
+  return bucket_config.public_url_root()
+
+
+def public_file_urls(files, bucket_config=None, accept=None):
+  """ [file.public_file_url() for file in files] except each bucket's url root
+  only gets worked out once, no matter how many files there are. files can be
+  a list or a queryset of Files, Photos or their child classes. I go by the
+  bucket name each File keeps in s3_bucket_name, so at most one File per
+  bucket has to work out its bucket_config. If you already know they're all
+  in the same bucket, pass in bucket_config, a BucketConfig or a bucket name.
+
+  accept is the request's Accept header. If you pass it in, photos with WebP
+  or AVIF copies that the browser takes get urls for those. Then
+  prefetch_related('rendition_files') first, and make sure the page Varies on
+  Accept if it gets cached. """
+  if bucket_config is not None:
+    root = public_file_url_root(bucket_config)
+    return [root + _file_name(file, accept) for file in files]
+  roots = {}
+  urls = []
+  for file in files:
+    # Files from before s3_bucket_name existed have to look it up.
+    bucket_name = file.s3_bucket_name or file._bucket_config().name
+    root = roots.get(bucket_name)
+    if root is None:
+      # Configured public buckets have their roots worked out at startup.
+      # Otherwise the first file in each bucket works it out.
+      root = roots[bucket_name] = get_public_url_root(
+          bucket_name) or public_file_url_root(file._bucket_config())
+    urls.append(root + _file_name(file, accept))
+  return urls
+
+
+def _file_name(file, accept):
+  if not accept:
+    return file.stored_file_name()
+  alternates = file.alternate_file_names()
+  return alternates.get(
+      best_alternate(alternates, accept), file.stored_file_name())
@@ -2,6 +2,9 @@ import secrets
 import string
 
 
+RANDOM_STRING_CHARACTERS = string.ascii_uppercase + string.digits
+
+
 def random_string(length=7):
-  choices = string.ascii_uppercase + string.digits
-  return ''.join(secrets.choice(choices) for _ in range(length))
+  return ''.join(
+      secrets.choice(RANDOM_STRING_CHARACTERS) for _ in range(length))
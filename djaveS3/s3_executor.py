@@ -0,0 +1,104 @@
+""" S3 is happy to do lots of things at once, but only so many per second per
+prefix. Past that it starts saying SlowDown. S3WorkExecutor runs S3 calls in a
+pool of threads, keeps them under a requests per second cap, and when S3 says
+SlowDown or has a 5xx hiccup, backs off exponentially and tries again.
+
+The cleanup jobs in djaveS3.models.clean_up_files use this. You can tune it in
+your settings.py:
+
+S3_WORK_MAX_WORKERS = 4  # S3 calls in flight at once
+S3_WORK_REQUESTS_PER_SECOND = None  # None means no cap
+S3_WORK_MAX_ATTEMPTS = 5  # Including the first try
+"""
+from concurrent.futures import ThreadPoolExecutor
+import random
+import threading
+import time
+
+from botocore.exceptions import ClientError
+from django.conf import settings
+
+
+RETRY_CODES = (
+    'SlowDown', 'ServiceUnavailable', 'InternalError', 'RequestTimeout',
+    'Throttling', 'ThrottlingException', 'RequestLimitExceeded',
+    'TooManyRequestsException', '500', '502', '503', '504')
+BASE_DELAY = 0.1
+MAX_DELAY = 20
+
+
+class S3WorkExecutor(object):
+  def __init__(
+      self, max_workers=None, requests_per_second=None, max_attempts=None,
+      sleep=time.sleep):
+    # sleep can be overridden for the sake of tests.
+    self.max_workers = max_workers or getattr(
+        settings, 'S3_WORK_MAX_WORKERS', 4)
+    self.requests_per_second = requests_per_second or getattr(
+        settings, 'S3_WORK_REQUESTS_PER_SECOND', None)
+    self.max_attempts = max_attempts or getattr(
+        settings, 'S3_WORK_MAX_ATTEMPTS', 5)
+    self.sleep = sleep
+    self.pool = ThreadPoolExecutor(max_workers=self.max_workers)
+    self.lock = threading.Lock()
+    self.next_request_at = 0
+    self.retries = 0
+
+  def submit(self, function, *args, **kwargs):
+    """ Run function(*args, **kwargs) in the pool. Returns a Future. """
+    return self.pool.submit(self.call, function, *args, **kwargs)
+
+  def submit_unwrapped(self, function, *args, **kwargs):
+    """ Run function(*args, **kwargs) in the pool as is, without the cap or
+    retries. That's for functions that use call themselves, so they don't
+    get capped and retried twice. Returns a Future. """
+    return self.pool.submit(function, *args, **kwargs)
+
+  def call(self, function, *args, **kwargs):
+    """ Run function(*args, **kwargs) right here, but still under the
+    requests per second cap, with retries. """
+    attempt = 1
+    while True:
+      self.wait_for_turn()
+      try:
+        return function(*args, **kwargs)
+      except ClientError as ex:
+        if attempt >= self.max_attempts or not is_retryable(ex):
+          raise ex
+      self.back_off(attempt)
+      attempt += 1
+
+  def wait_for_turn(self):
+    """ Block until it's ok to send another request. """
+    if not self.requests_per_second:
+      return
+    with self.lock:
+      nnow = time.monotonic()
+      my_turn = max(nnow, self.next_request_at)
+      self.next_request_at = my_turn + 1.0 / self.requests_per_second
+    if my_turn > nnow:
+      self.sleep(my_turn - nnow)
+
+  def back_off(self, attempt):
+    with self.lock:
+      self.retries += 1
+    # Full jitter, so a bunch of threads that got told to SlowDown at the same
+    # time don't all come back at the same time.
+    self.sleep(random.uniform(
+        0, min(MAX_DELAY, BASE_DELAY * 2 ** (attempt - 1))))
+
+  def shutdown(self):
+    self.pool.shutdown(wait=True)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.shutdown()
+
+
+def is_retryable(client_error):
+  error = client_error.response.get('Error', {})
+  status = client_error.response.get('ResponseMetadata', {}).get(
+      'HTTPStatusCode') or 0
+  return str(error.get('Code', '')) in RETRY_CODES or status >= 500
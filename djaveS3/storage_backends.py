@@ -0,0 +1,488 @@
+""" Bucket doesn't talk to storage directly. It goes through a backend, and
+BucketConfig.backend says which one:
+
+S3_BACKEND is Amazon S3 via boto3. This is what you want in production.
+
+LOCAL_BACKEND keeps files in a directory on local disk, at
+BucketConfig.local_root/bucket name/file name. This is handy for dev
+environments that shouldn't need AWS credentials.
+
+MEMORY_BACKEND keeps files in a dict in this process. It's fast, and it's handy
+for tests and for benchmarking cleanup and resizing with lots of files.
+
+Every backend has the same methods: list, head, get, get_into, get_file, put,
+put_file, delete, delete_many, presign_post and presign_get. They all act like
+S3, down to raising botocore ClientErrors with S3's error codes, so code above
+the backend doesn't care which one it's talking to.
+
+Browsers can't upload to local or memory buckets directly the way they upload
+to S3, so presign_post for those buckets points at the local_upload view in
+djaveS3.views instead. Same goes for presign_get and the local_download view.
+"""
+from collections import namedtuple
+from datetime import datetime, timezone
+import hashlib
+from io import BytesIO
+import os
+import re
+import shutil
+import threading
+import time
+
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
+from django.conf import settings
+from django.core import signing
+from django.urls import reverse
+from django.utils.http import urlencode
+from djaveS3.boto_client import get_boto_client
+from djaveS3.bucket_config import (
+    TransferProfile, S3_BACKEND, LOCAL_BACKEND, MEMORY_BACKEND)
+from djaveS3.file_types import content_type_from_file_name
+
+
+# This is the most S3 will delete in one delete_objects request.
+DELETE_MANY_BATCH_SIZE = 1000
+LOCAL_UPLOAD_SALT = 'djaveS3.local_upload'
+LOCAL_DOWNLOAD_SALT = 'djaveS3.local_download'
+# get_object parameters that override headers in the response, and the headers
+# they override.
+RESPONSE_HEADER_PARAMS = {
+    'ResponseCacheControl': 'Cache-Control',
+    'ResponseContentDisposition': 'Content-Disposition',
+    'ResponseContentEncoding': 'Content-Encoding',
+    'ResponseContentLanguage': 'Content-Language',
+    'ResponseContentType': 'Content-Type',
+    'ResponseExpires': 'Expires'}
+
+
+ListedObject = namedtuple('ListedObject', 'key last_modified size etag')
+FileMetadata = namedtuple(
+    'FileMetadata', 'etag last_modified content_type size')
+TransferStats = namedtuple(
+    'TransferStats', 'bytes_transferred seconds bytes_per_second')
+
+
+def metadata_from_response(response):
+  """ Pull the FileMetadata out of a head or get response. """
+  return FileMetadata(
+      response.get('ETag'), response.get('LastModified'),
+      response.get('ContentType'), response.get('ContentLength'))
+
+
+def make_backend(bucket_config, boto_client=None):
+  backend = bucket_config.backend or S3_BACKEND
+  if backend == S3_BACKEND:
+    return S3Backend(bucket_config, boto_client=boto_client)
+  if backend == LOCAL_BACKEND:
+    return LocalDirectoryBackend(bucket_config)
+  if backend == MEMORY_BACKEND:
+    return MemoryBackend(bucket_config)
+  raise Exception('I do not know about a {} storage backend'.format(backend))
+
+
+class S3Backend(object):
+  def __init__(self, bucket_config, boto_client=None):
+    self.bucket_config = bucket_config
+    if settings.TEST and not boto_client:
+      raise Exception(
+          'You should use a mock boto3 client in unit tests so your tests do '
+          'not attempt to contact Amazon servers because that could slow your '
+          'tests down and put test files on Amazon servers.')
+    # Clients are cached per process, so this is cheap after the first time.
+    self.boto_client = boto_client or get_boto_client(
+        bucket_config.access_key_id, bucket_config.secret_access_key,
+        region_name=bucket_config.region_name,
+        endpoint_url=bucket_config.endpoint_url)
+    self._transfer_config = None
+
+  def list(self, prefix='', start_after=None, page_size=1000):
+    kwargs = {'Bucket': self.bucket_config.name, 'MaxKeys': page_size}
+    if prefix:
+      kwargs['Prefix'] = prefix
+    if start_after:
+      kwargs['StartAfter'] = start_after
+    while True:
+      lookup_result = self.boto_client.list_objects_v2(**kwargs)
+      # If the bucket_name is empty they omit the Contents entirely.
+      for obj in lookup_result.get('Contents', []):
+        yield ListedObject(
+            obj['Key'], obj['LastModified'], obj.get('Size'), obj.get('ETag'))
+      if not lookup_result.get('IsTruncated'):
+        return
+      kwargs['ContinuationToken'] = lookup_result['NextContinuationToken']
+
+  def head(self, key):
+    return self.boto_client.head_object(
+        Bucket=self.bucket_config.name, Key=key)
+
+  def get(self, key, byte_range=None, if_none_match=None):
+    kwargs = {'Bucket': self.bucket_config.name, 'Key': key}
+    if byte_range:
+      kwargs['Range'] = byte_range
+    if if_none_match:
+      kwargs['IfNoneMatch'] = if_none_match
+    return self.boto_client.get_object(**kwargs)
+
+  def get_into(self, key, fileobj, callback=None):
+    self.boto_client.download_fileobj(
+        self.bucket_config.name, key, fileobj,
+        Config=self.transfer_config(), Callback=_progress_callback(callback))
+
+  def get_file(self, key, local_file_name, callback=None):
+    self.boto_client.download_file(
+        self.bucket_config.name, key, local_file_name,
+        Config=self.transfer_config(), Callback=_progress_callback(callback))
+
+  def put(self, key, fileobj, content_type=None, callback=None):
+    extra_args = {'ContentType': content_type} if content_type else None
+    self.boto_client.upload_fileobj(
+        fileobj, self.bucket_config.name, key,
+        ExtraArgs=extra_args, Config=self.transfer_config(),
+        Callback=_progress_callback(callback))
+
+  def put_file(self, local_file_name, key, callback=None):
+    self.boto_client.upload_file(
+        local_file_name, self.bucket_config.name, key,
+        Config=self.transfer_config(), Callback=_progress_callback(callback))
+
+  def delete(self, key):
+    """ Regardless of whether key exists or not in the bucket, this will
+    return a 204. """
+    got = self.boto_client.delete_object(
+        Bucket=self.bucket_config.name, Key=key)
+    return got['ResponseMetadata']['HTTPStatusCode'] == 204
+
+  def delete_many(self, keys):
+    errors = {}
+    for batch in _batches(keys):
+      got = self.boto_client.delete_objects(
+          Bucket=self.bucket_config.name,
+          Delete={
+              'Objects': [{'Key': key} for key in batch],
+              # Quiet means S3 only tells me about the failures.
+              'Quiet': True})
+      for error in got.get('Errors', []):
+        errors[error['Key']] = '{}: {}'.format(
+            error.get('Code', ''), error.get('Message', ''))
+    return errors
+
+  def presign_post(self, key, fields, conditions, expires_in):
+    return self.boto_client.generate_presigned_post(
+        Bucket=self.bucket_config.name,
+        Key=key,
+        Fields=fields,
+        Conditions=conditions,
+        ExpiresIn=expires_in)
+
+  def presign_get(self, key, expires_in, response_headers=None):
+    """ response_headers is like {'ResponseContentType': 'image/jpeg'}. See
+    RESPONSE_HEADER_PARAMS. They're part of the signature, so whoever has the
+    URL can't change them. """
+    params = {'Bucket': self.bucket_config.name, 'Key': key}
+    params.update(response_headers or {})
+    return self.boto_client.generate_presigned_url(
+        'get_object', Params=params, ExpiresIn=expires_in)
+
+  def transfer_config(self):
+    if not self._transfer_config:
+      profile = self.bucket_config.transfer_profile or TransferProfile()
+      self._transfer_config = TransferConfig(
+          multipart_threshold=profile.multipart_threshold,
+          multipart_chunksize=profile.multipart_chunksize,
+          max_concurrency=profile.max_concurrency,
+          use_threads=profile.use_threads)
+    return self._transfer_config
+
+
+class _NotS3Backend(object):
+  """ Everything the local and memory backends have in common. Child classes
+  just have to _read, _write, _remove, _stat and list keys. """
+  def __init__(self, bucket_config):
+    self.bucket_config = bucket_config
+
+  def head(self, key):
+    stat = self._stat(key)
+    if stat is None:
+      # HEAD responses don't have a body, so S3 can't say NoSuchKey.
+      raise _client_error('404', key, 'HeadObject')
+    size, last_modified, etag, content_type = stat
+    return {
+        'ETag': etag, 'LastModified': last_modified,
+        'ContentType': content_type, 'ContentLength': size}
+
+  def get(self, key, byte_range=None, if_none_match=None):
+    stat = self._stat(key)
+    if stat is None:
+      raise _client_error('NoSuchKey', key, 'GetObject')
+    size, last_modified, etag, content_type = stat
+    if if_none_match and if_none_match == etag:
+      # This is what boto3 does when S3 says 304 Not Modified.
+      raise _client_error('304', key, 'GetObject')
+    response = {
+        'ETag': etag, 'LastModified': last_modified,
+        'ContentType': content_type, 'ContentLength': size}
+    if byte_range:
+      start, end = _parse_byte_range(byte_range, size, key)
+      response['ContentLength'] = end - start + 1
+      response['ContentRange'] = 'bytes {}-{}/{}'.format(start, end, size)
+      response['Body'] = self._read(key, start, end - start + 1)
+    else:
+      response['Body'] = self._read(key, 0, size)
+    return response
+
+  def get_into(self, key, fileobj, callback=None):
+    progress = _progress_callback(callback)
+    body = self.get(key)['Body']
+    try:
+      while True:
+        chunk = body.read(1024 * 1024)
+        if not chunk:
+          return
+        fileobj.write(chunk)
+        if progress:
+          progress(len(chunk))
+    finally:
+      body.close()
+
+  def get_file(self, key, local_file_name, callback=None):
+    with open(local_file_name, 'wb') as f:
+      self.get_into(key, f, callback=callback)
+
+  def put(self, key, fileobj, content_type=None, callback=None):
+    data = fileobj.read()
+    self._write(
+        key, data, content_type or content_type_from_file_name(key) or '')
+    if callback:
+      _progress_callback(callback)(len(data))
+
+  def put_file(self, local_file_name, key, callback=None):
+    with open(local_file_name, 'rb') as f:
+      self.put(key, f, callback=callback)
+
+  def delete(self, key):
+    self._remove(key)
+    return True
+
+  def delete_many(self, keys):
+    for key in keys:
+      self._remove(key)
+    return {}
+
+  def presign_post(self, key, fields, conditions, expires_in):
+    fields = dict(fields)
+    fields['key'] = key
+    fields['signature'] = signing.dumps(
+        {'bucket': self.bucket_config.name, 'key': key,
+         'expires': time.time() + expires_in},
+        salt=LOCAL_UPLOAD_SALT)
+    return {
+        'url': reverse(
+            'local_upload', kwargs={'bucket_name': self.bucket_config.name}),
+        'fields': fields}
+
+  def presign_get(self, key, expires_in, response_headers=None):
+    signature = signing.dumps(
+        {'bucket': self.bucket_config.name, 'key': key,
+         'expires': time.time() + expires_in,
+         'headers': response_headers or {}},
+        salt=LOCAL_DOWNLOAD_SALT)
+    return '{}?{}'.format(
+        reverse('local_download', kwargs={
+            'bucket_name': self.bucket_config.name, 'file_name': key}),
+        urlencode({'signature': signature}))
+
+
+class MemoryBackend(_NotS3Backend):
+  """ All the MemoryBackends for the same bucket name share their files, just
+  like all the S3Backends for a bucket do. """
+  def list(self, prefix='', start_after=None, page_size=1000):
+    files = _memory_files(self.bucket_config.name)
+    with _memory_lock:
+      keys = sorted(files)
+    for key in keys:
+      if key.startswith(prefix) and (not start_after or key > start_after):
+        stored = files.get(key)
+        if stored:
+          yield ListedObject(
+              key, stored.last_modified, len(stored.data), stored.etag)
+
+  def _stat(self, key):
+    stored = _memory_files(self.bucket_config.name).get(key)
+    if stored:
+      return (
+          len(stored.data), stored.last_modified, stored.etag,
+          stored.content_type)
+
+  def _read(self, key, start, length):
+    stored = _memory_files(self.bucket_config.name).get(key)
+    if stored is None:
+      raise _client_error('NoSuchKey', key, 'GetObject')
+    return BytesIO(stored.data[start:start + length])
+
+  def _write(self, key, data, content_type):
+    with _memory_lock:
+      _memory_files(self.bucket_config.name)[key] = _MemoryFile(
+          bytes(data), content_type, datetime.now(timezone.utc),
+          '"{}"'.format(hashlib.md5(data).hexdigest()))
+
+  def _remove(self, key):
+    with _memory_lock:
+      _memory_files(self.bucket_config.name).pop(key, None)
+
+
+_MemoryFile = namedtuple(
+    '_MemoryFile', 'data content_type last_modified etag')
+_memory_buckets = {}
+_memory_lock = threading.RLock()
+
+
+def _memory_files(bucket_name):
+  if bucket_name not in _memory_buckets:
+    with _memory_lock:
+      _memory_buckets.setdefault(bucket_name, {})
+  return _memory_buckets[bucket_name]
+
+
+def forget_memory_buckets():
+  """ Empty every memory bucket. Tests should call this in setUp. """
+  with _memory_lock:
+    _memory_buckets.clear()
+
+
+class LocalDirectoryBackend(_NotS3Backend):
+  """ File names can have slashes in them, which turn into subdirectories. """
+  def __init__(self, bucket_config):
+    super().__init__(bucket_config)
+    root = bucket_config.local_root or getattr(settings, 'S3_LOCAL_ROOT', '')
+    if not root:
+      raise Exception((
+          'Bucket {} uses the local backend, so give its BucketConfig a '
+          'local_root or set S3_LOCAL_ROOT in your settings').format(
+              bucket_config.name))
+    self.directory = os.path.abspath(os.path.join(root, bucket_config.name))
+
+  def list(self, prefix='', start_after=None, page_size=1000):
+    keys = []
+    for directory, _, file_names in os.walk(self.directory):
+      for file_name in file_names:
+        keys.append(os.path.relpath(
+            os.path.join(directory, file_name), self.directory).replace(
+                os.sep, '/'))
+    for key in sorted(keys):
+      if key.startswith(prefix) and (not start_after or key > start_after):
+        stat = self._stat(key)
+        if stat:
+          yield ListedObject(key, stat[1], stat[0], stat[2])
+
+  def _path(self, key):
+    path = os.path.abspath(os.path.join(self.directory, key))
+    if not path.startswith(self.directory + os.sep):
+      raise Exception('{} is not a valid file name'.format(key))
+    return path
+
+  def _stat(self, key):
+    try:
+      stat = os.stat(self._path(key))
+    except FileNotFoundError:
+      return None
+    return (
+        stat.st_size,
+        datetime.fromtimestamp(stat.st_mtime, timezone.utc),
+        '"{:x}-{:x}"'.format(stat.st_mtime_ns, stat.st_size),
+        content_type_from_file_name(key) or '')
+
+  def _read(self, key, start, length):
+    f = open(self._path(key), 'rb')
+    f.seek(start)
+    return _FileRange(f, length)
+
+  def _write(self, key, data, content_type):
+    path = self._path(key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Write somewhere else first and then move it into place so readers never
+    # see half a file.
+    temp_path = '{}.{}.tmp'.format(path, threading.get_ident())
+    with open(temp_path, 'wb') as f:
+      f.write(data)
+    shutil.move(temp_path, path)
+
+  def _remove(self, key):
+    try:
+      os.remove(self._path(key))
+    except FileNotFoundError:
+      pass
+
+
+class _FileRange(object):
+  """ Reads at most length bytes out of f """
+  def __init__(self, f, length):
+    self.f = f
+    self.remaining = length
+
+  def read(self, amt=None):
+    if amt is None or amt > self.remaining:
+      amt = self.remaining
+    read = self.f.read(amt)
+    self.remaining -= len(read)
+    return read
+
+  def close(self):
+    self.f.close()
+
+
+class TransferProgress(object):
+  """ boto3 calls this with the number of bytes in each chunk it moves,
+  possibly from several threads at once. I keep a running total and pass
+  TransferStats along to callback. """
+  def __init__(self, callback):
+    self.callback = callback
+    self.bytes_transferred = 0
+    self.started = time.perf_counter()
+    self.lock = threading.Lock()
+
+  def __call__(self, bytes_amount):
+    with self.lock:
+      self.bytes_transferred += bytes_amount
+      seconds = time.perf_counter() - self.started
+      stats = TransferStats(
+          self.bytes_transferred, seconds,
+          self.bytes_transferred / seconds if seconds else 0.0)
+    self.callback(stats)
+
+
+def _progress_callback(callback):
+  return TransferProgress(callback) if callback else None
+
+
+def _batches(keys):
+  keys = list(keys)
+  for start in range(0, len(keys), DELETE_MANY_BATCH_SIZE):
+    yield keys[start:start + DELETE_MANY_BATCH_SIZE]
+
+
+BYTE_RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def _parse_byte_range(byte_range, size, key):
+  """ Returns the first and last byte, inclusive, the way S3 would. """
+  found = BYTE_RANGE.match(byte_range)
+  if not found:
+    raise _client_error('InvalidRange', key, 'GetObject')
+  start, end = found.group(1), found.group(2)
+  if start:
+    start = int(start)
+    end = min(int(end), size - 1) if end else size - 1
+  elif end:
+    start = max(size - int(end), 0)
+    end = size - 1
+  else:
+    raise _client_error('InvalidRange', key, 'GetObject')
+  if start >= size or end < start:
+    raise _client_error('InvalidRange', key, 'GetObject')
+  return start, end
+
+
+def _client_error(code, key, operation_name):
+  return ClientError(
+      {'Error': {'Code': code, 'Message': code, 'Key': key}}, operation_name)
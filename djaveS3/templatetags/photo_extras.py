@@ -1,6 +1,7 @@
 from django import template
 
-from djaveS3.file_types import VALID_IMAGE_TYPES
+from djaveS3.file_types import JPEG_CONTENT_TYPE, VALID_IMAGE_TYPES
+from djaveS3.public_file_url import public_file_urls
 
 
 register = template.Library()
@@ -10,3 +11,40 @@ register = template.Library()
 def valid_image_types():
   # Hack: this spits out valid Javascript.
   return str(VALID_IMAGE_TYPES)
+
+
+@register.filter
+def with_public_file_urls(files):
+  """ Loop over a bunch of public photos and their urls in one go:
+
+  {% load photo_extras %}
+  {% for photo, url in photos|with_public_file_urls %}
+    <img src="{{ url }}">
+  {% endfor %} """
+  files = list(files)
+  return list(zip(files, public_file_urls(files)))
+
+
+@register.simple_tag
+def photo_srcset(photo, content_type=JPEG_CONTENT_TYPE):
+  """ Let the browser pick the smallest of a photo's renditions that looks
+  good, instead of always downloading the full size photo:
+
+  {% load photo_extras %}
+  <img src="{{ photo.public_file_url }}" srcset="{% photo_srcset photo %}"
+       sizes="120px">
+
+  If you turned on alternate_formats in an ImageEncoding, let the browser pick
+  those if it can:
+
+  <picture>
+    <source type="image/webp" srcset="{% photo_srcset photo 'image/webp' %}"
+            sizes="120px">
+    <img src="{{ photo.public_file_url }}" srcset="{% photo_srcset photo %}"
+         sizes="120px">
+  </picture>
+
+  If you're showing a bunch of photos, prefetch_related('rendition_files')
+  so this doesn't cost a query per photo. See renditions in
+  djaveS3.models.photo """
+  return photo.srcset(content_type)
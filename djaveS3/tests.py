@@ -1,18 +1,62 @@
-from unittest.mock import Mock, call
+import asyncio
+from datetime import timedelta
+from io import BytesIO
+import json
+import os
+import tempfile
+import time
+from unittest.mock import Mock, call, patch
 
-from django.test import TestCase
+from botocore.exceptions import ClientError
+from django.http import Http404
+from django.test import TestCase, RequestFactory, override_settings
+from djaveS3.boto_client import (
+    get_boto_client, forget_boto_clients, refresh_boto_client,
+    boto_client_stats, reset_boto_client_stats, get_async_boto_client,
+    close_async_boto_clients)
 from djaveS3.models.clean_up_files import (
     clean_up_never_used, clean_up_no_longer_needed,
-    signed_file_is_used)
-from djaveS3.models.file import File
-from djaveS3.models.photo import resize_all, Photo
+    signed_file_is_used, fill_in_s3_bucket_names, list_unaccounted_images,
+    reconcile, UNACCOUNTED, MISSING, BatchedDelete)
+from djaveS3.s3_executor import S3WorkExecutor
+from djaveS3.models.cleanup_checkpoint import (
+    CleanupCheckpoint, CleanupProgress)
+from djaveS3.models.dedupe import (
+    content_hash_from_bytes, content_hash_from_metadata)
+from djaveS3.models.file import File, deletable_file_names
+from djaveS3.models.photo import (
+    resize_all, work_resize_jobs, Photo, Rendition, ResizePipeline,
+    BAD_IMAGE, NO_FILE_NAME)
+from djaveS3.models.rendition_file import RenditionFile
+from djaveS3.models.resize_job import (
+    claim_resize_jobs, renew_resize_jobs, ResizeJob, DEAD, PENDING)
 from djaveS3.models.signed_file import SignedFile
 from djaveS3.models.test_photo import (
     TestPhoto, PUBLIC_BUCKET_NAME, SENSITIVE_BUCKET_NAME,
-    SENSITIVE_BUCKET_CONFIG)
+    SENSITIVE_BUCKET_CONFIG, PUBLIC_BUCKET_CONFIG)
 from djaveS3.random_string import random_string
-from djaveS3.models.bucket import Bucket
-from djaveDT import str_to_tz_dt
+from djaveS3.bucket_config import (
+    ImageEncoding, TransferProfile, LOCAL_BACKEND, MEMORY_BACKEND,
+    PATH_ADDRESSING)
+from djaveS3.models.bucket import (
+    Bucket, FileTooBigException, ListedObject, TransferProgress)
+from djaveS3.models.async_bucket import AsyncBucket
+from djaveS3.generate_presigned_post import generate_presigned_posts
+from djaveS3.get_bucket_config import (
+    get_bucket_config, load_bucket_configs, forget_bucket_configs,
+    GetBucketConfigException)
+from djaveS3.public_file_url import public_file_url, public_file_urls
+from django.template import Context, Template
+from djaveS3.file_cache import FileCache, DiskTier
+from djaveS3.storage_backends import FileMetadata, forget_memory_buckets
+from djaveS3.views import (
+    sensitive_file_response, streaming_sensitive_file_response,
+    async_sensitive_file_response, sensitive_file_redirect,
+    forget_presigned_urls, sign_uploads)
+from djaveDT import now, str_to_tz_dt
+from djaveS3.file_types import (
+    AVIF_CONTENT_TYPE, WEBP_CONTENT_TYPE, best_alternate)
+from PIL import Image
 
 
 def get_test_photo(**kwargs):
@@ -23,6 +67,19 @@ def get_test_photo(**kwargs):
   return set_photo_stuff(test_photo, **kwargs)
 
 
+def memory_bucket():
+  """ A fresh, empty in memory copy of the public bucket. """
+  forget_memory_buckets()
+  return Bucket(PUBLIC_BUCKET_CONFIG._replace(backend=MEMORY_BACKEND))
+
+
+def upload_test_image(bucket, file_name, size, format='JPEG', color=0):
+  image = BytesIO()
+  Image.new('RGB', size, color).save(image, format=format)
+  image.seek(0)
+  bucket.upload_fileobj(image, file_name)
+
+
 def set_photo_stuff(photo, **kwargs):
   photo.resized_at = kwargs.get('resized_at', None)
   return set_file_stuff(photo, **kwargs)
@@ -89,13 +146,228 @@ class CleanUpNeverUsedTests(TestCase):
         created=str_to_tz_dt('2018-12-24 12:00'))
 
     bucket = Mock(spec=Bucket)
+    bucket.delete_many.return_value = {}
     clean_up_never_used(nnow=str_to_tz_dt('2018-12-25 12:00'), bucket=bucket)
     self.assertEqual(
-        [call('nouns.jpg'), call('adjectives.jpg')],
-        bucket.delete.call_args_list)
+        [call(['nouns.jpg', 'adjectives.jpg'])],
+        bucket.delete_many.call_args_list)
     self.assertEqual(set([recent]), set(list(SignedFile.objects.all())))
 
 
+  def test_failed_deletes_keep_their_signed_file(self):
+    failed = get_test_signed_file(
+        file_name='gerunds.jpg', bucket_name=PUBLIC_BUCKET_NAME,
+        created=str_to_tz_dt('2018-12-24 12:00'))
+    get_test_signed_file(
+        file_name='adverbs.jpg', bucket_name=PUBLIC_BUCKET_NAME,
+        created=str_to_tz_dt('2018-12-24 12:00'))
+    bucket = Mock(spec=Bucket)
+    bucket.delete_many.return_value = {'gerunds.jpg': 'AccessDenied: No'}
+    clean_up_never_used(nnow=str_to_tz_dt('2018-12-25 12:00'), bucket=bucket)
+    self.assertEqual([failed], list(SignedFile.objects.all()))
+
+  def test_query_count_does_not_grow_with_used_files(self):
+    for i in range(20):
+      get_test_signed_file(
+          file_name='{}.jpg'.format(i), bucket_name=PUBLIC_BUCKET_NAME,
+          created=str_to_tz_dt('2018-12-24 12:00'))
+      get_test_photo(file_name='{}.jpg'.format(i))
+    bucket = Mock(spec=Bucket)
+    # Delete the used ones, read the checkpoint, find the abandoned ones, and
+    # save the checkpoint.
+    with self.assertNumQueries(4):
+      clean_up_never_used(
+          nnow=str_to_tz_dt('2018-12-25 12:00'), bucket=bucket)
+    self.assertEqual(0, SignedFile.objects.count())
+    bucket.delete_many.assert_not_called()
+
+  def test_files_from_before_s3_bucket_name(self):
+    get_test_signed_file(
+        file_name='verbs.jpg', bucket_name=PUBLIC_BUCKET_NAME,
+        created=str_to_tz_dt('2018-12-24 12:00'))
+    photo = get_test_photo(file_name='verbs.jpg')
+    File.objects.filter(pk=photo.pk).update(s3_bucket_name='')
+    bucket = Mock(spec=Bucket)
+    clean_up_never_used(nnow=str_to_tz_dt('2018-12-25 12:00'), bucket=bucket)
+    self.assertEqual(0, SignedFile.objects.count())
+    bucket.delete_many.assert_not_called()
+    fill_in_s3_bucket_names()
+    self.assertEqual(
+        PUBLIC_BUCKET_NAME, File.objects.get(pk=photo.pk).s3_bucket_name)
+
+  def test_fill_in_s3_bucket_names_pages_by_pk(self):
+    photos = [get_test_photo(file_name='{}.jpg'.format(i)) for i in range(3)]
+    File.objects.update(s3_bucket_name='')
+    # Pretend the child row of the first photo is missing.
+    with patch(
+        'djaveS3.models.clean_up_files.as_child_classes',
+        side_effect=lambda files: [
+            file.as_child_class() for file in files
+            if file.pk != photos[0].pk]):
+      fill_in_s3_bucket_names(batch_size=1)
+    self.assertEqual(
+        ['', PUBLIC_BUCKET_NAME, PUBLIC_BUCKET_NAME],
+        list(File.objects.order_by('pk').values_list(
+            's3_bucket_name', flat=True)))
+    with patch.object(
+        TestPhoto, 'bucket_config',
+        return_value=PUBLIC_BUCKET_CONFIG._replace(name='')):
+      with self.assertRaises(Exception):
+        fill_in_s3_bucket_names()
+
+
+class DeleteManyTests(TestCase):
+  def test_delete_many(self):
+    boto_client = Mock()
+    boto_client.delete_objects.side_effect = [
+        {}, {'Errors': [
+            {'Key': '1000', 'Code': 'AccessDenied', 'Message': 'Nope'}]}]
+    bucket = Bucket(PUBLIC_BUCKET_CONFIG, boto_client=boto_client)
+    errors = bucket.delete_many(str(i) for i in range(1001))
+    self.assertEqual({'1000': 'AccessDenied: Nope'}, errors)
+    self.assertEqual(2, boto_client.delete_objects.call_count)
+    last_delete = boto_client.delete_objects.call_args_list[1][1]['Delete']
+    self.assertEqual([{'Key': '1000'}], last_delete['Objects'])
+
+
+class CheckpointTests(TestCase):
+  def setUp(self):
+    super().setUp()
+    self.bucket = Mock(spec=Bucket)
+    self.bucket.name.return_value = PUBLIC_BUCKET_NAME
+    self.bucket.delete_many.return_value = {}
+    for i in range(5):
+      get_test_photo(
+          file_name='chuck{}'.format(i),
+          keep_until=str_to_tz_dt('2018-12-24'),
+          why_no_need_for_file='You actually could delete this')
+
+  def clean_up(self, **kwargs):
+    return clean_up_no_longer_needed(
+        nnow=str_to_tz_dt('2018-12-25 12:00'), bucket=self.bucket,
+        chunk_size=2, **kwargs)
+
+  def test_item_budget(self):
+    self.assertEqual(
+        CleanupProgress(3, 2, False), self.clean_up(items=3))
+    self.assertEqual(2, TestPhoto.objects.count())
+    self.assertEqual(
+        ['chuck3', 'chuck4'],
+        sorted(TestPhoto.objects.values_list('file_name', flat=True)))
+    self.assertEqual(
+        TestPhoto.objects.order_by('pk').first().pk - 1,
+        CleanupCheckpoint.objects.get().last_pk)
+    self.assertEqual(CleanupProgress(2, 0, True), self.clean_up(items=3))
+    self.assertEqual(0, TestPhoto.objects.count())
+    self.assertIsNone(CleanupCheckpoint.objects.get().last_pk)
+
+  def test_expires_behind_the_checkpoint(self):
+    first = TestPhoto.objects.get(file_name='chuck0')
+    TestPhoto.objects.filter(pk=first.pk).update(
+        keep_until=str_to_tz_dt('2019-01-01'))
+    self.assertEqual(CleanupProgress(3, 1, False), self.clean_up(items=3))
+    # Now that the run is past it, it expires.
+    TestPhoto.objects.filter(pk=first.pk).update(
+        keep_until=str_to_tz_dt('2018-12-24'))
+    self.assertEqual(CleanupProgress(2, 0, True), self.clean_up(items=10))
+    self.assertEqual(0, TestPhoto.objects.count())
+
+  def test_time_budget(self):
+    self.assertEqual(CleanupProgress(0, 5, False), self.clean_up(seconds=-1))
+    self.assertEqual(CleanupProgress(0, 5, False), self.clean_up(seconds=0))
+    self.assertEqual(CleanupProgress(5, 0, True), self.clean_up(seconds=60))
+
+  def test_resize_all_budget(self):
+    get_test_photo(file_name='resize_me.jpg')
+    with patch.object(TestPhoto, 'resized_images') as resized_images:
+      self.assertEqual(CleanupProgress(1, 5, False), resize_all(
+          items=1, bucket=self.bucket, processes=1))
+      self.assertEqual(1, resized_images.call_count)
+      self.assertEqual(CleanupProgress(0, 5, False), resize_all(
+          seconds=0, bucket=self.bucket, processes=1))
+      self.assertEqual(1, resized_images.call_count)
+
+
+class S3WorkExecutorTests(TestCase):
+  def setUp(self):
+    super().setUp()
+    self.sleep = Mock()
+    self.executor = S3WorkExecutor(
+        max_workers=2, max_attempts=3, sleep=self.sleep)
+
+  def tearDown(self):
+    self.executor.shutdown()
+    super().tearDown()
+
+  def test_retries_slow_downs(self):
+    function = Mock(side_effect=[
+        ClientError({'Error': {'Code': 'SlowDown'}}, 'DeleteObjects'),
+        ClientError({'Error': {'Code': 'InternalError'}}, 'DeleteObjects'),
+        'done'])
+    self.assertEqual('done', self.executor.submit(function).result())
+    self.assertEqual(2, self.executor.retries)
+
+  def test_batched_delete_retries_once_per_attempt(self):
+    bucket = Mock(spec=Bucket)
+    bucket.name.return_value = PUBLIC_BUCKET_NAME
+    bucket.delete_many.side_effect = ClientError(
+        {'Error': {'Code': 'SlowDown'}}, 'DeleteObjects')
+    on_deleted = Mock()
+    deleter = BatchedDelete(on_deleted, executor=self.executor)
+    deleter.add(bucket, ['a.jpg'], 1)
+    deleter.flush()
+    self.assertEqual(3, bucket.delete_many.call_count)
+    self.assertEqual(2, self.executor.retries)
+    on_deleted.assert_not_called()
+
+  def test_does_not_retry_other_errors(self):
+    function = Mock(side_effect=ClientError(
+        {'Error': {'Code': 'AccessDenied'}}, 'DeleteObjects'))
+    with self.assertRaises(ClientError):
+      self.executor.call(function)
+    self.assertEqual(1, function.call_count)
+
+  def test_gives_up(self):
+    function = Mock(side_effect=ClientError(
+        {'Error': {'Code': '503'}}, 'DeleteObjects'))
+    with self.assertRaises(ClientError):
+      self.executor.call(function)
+    self.assertEqual(3, function.call_count)
+
+  def test_requests_per_second(self):
+    self.executor.requests_per_second = 10
+    for _ in range(3):
+      self.executor.call(Mock())
+    self.assertEqual(2, self.sleep.call_count)
+
+  def test_batched_delete_retries_slow_file_names(self):
+    bucket = Mock(spec=Bucket)
+    bucket.name.return_value = PUBLIC_BUCKET_NAME
+    bucket.delete_many.side_effect = [
+        {'a.jpg': 'SlowDown: Please reduce your request rate.',
+         'b.jpg': 'AccessDenied: No'},
+        {}]
+    deleted = []
+    deleter = BatchedDelete(deleted.extend, executor=self.executor)
+    deleter.add(bucket, ['a.jpg'], 'a')
+    deleter.add(bucket, ['b.jpg'], 'b')
+    deleter.add(bucket, ['c.jpg'], 'c')
+    deleter.flush()
+    self.assertEqual(['a', 'c'], deleted)
+    self.assertEqual(call(['a.jpg']), bucket.delete_many.call_args)
+
+  def test_failed_batches_are_not_deleted(self):
+    bucket = Mock(spec=Bucket)
+    bucket.name.return_value = PUBLIC_BUCKET_NAME
+    bucket.delete_many.side_effect = ClientError(
+        {'Error': {'Code': 'AccessDenied'}}, 'DeleteObjects')
+    deleted = []
+    deleter = BatchedDelete(deleted.extend, executor=self.executor)
+    deleter.add(bucket, ['a.jpg'], 'a')
+    deleter.flush()
+    self.assertEqual([], deleted)
+
+
 class CleanUpNoLongerNeededTests(TestCase):
   def test_had_earlier_remove_date_moved_to_later(self):
     file = get_test_photo(
@@ -124,12 +396,72 @@ class CleanUpNoLongerNeededTests(TestCase):
     self.assertEqual(3, TestPhoto.objects.count())
     bucket = Mock(spec=Bucket)
     bucket.name.return_value = PUBLIC_BUCKET_NAME
+    bucket.delete_many.return_value = {}
     clean_up_no_longer_needed(
         nnow=str_to_tz_dt('2018-12-25 12:00'), bucket=bucket)
-    self.assertEqual([call('mowers')], bucket.delete.call_args_list)
+    self.assertEqual([call(['mowers'])], bucket.delete_many.call_args_list)
     self.assertEqual(2, TestPhoto.objects.count())
     self.assertFalse(TestPhoto.objects.filter(pk=deleted.pk).exists())
 
+  def test_chunks(self):
+    for i in range(5):
+      get_test_photo(
+          file_name='keep{}'.format(i), keep_until=str_to_tz_dt('2018-12-24'),
+          next_keep_until=str_to_tz_dt('2019-01-01'))
+      get_test_photo(
+          file_name='chuck{}'.format(i),
+          keep_until=str_to_tz_dt('2018-12-24'),
+          why_no_need_for_file='You actually could delete this')
+    bucket = Mock(spec=Bucket)
+    bucket.name.return_value = PUBLIC_BUCKET_NAME
+    bucket.delete_many.return_value = {}
+    clean_up_no_longer_needed(
+        nnow=str_to_tz_dt('2018-12-25 12:00'), bucket=bucket, chunk_size=3)
+    self.assertEqual(
+        ['chuck{}'.format(i) for i in range(5)],
+        bucket.delete_many.call_args[0][0])
+    self.assertEqual(
+        ['keep{}'.format(i) for i in range(5)],
+        sorted(TestPhoto.objects.filter(
+            keep_until=str_to_tz_dt('2019-01-01')).values_list(
+                'file_name', flat=True)))
+
+
+class ReconcileTests(TestCase):
+  def setUp(self):
+    super().setUp()
+    self.bucket = memory_bucket()
+    for file_name in ['a.jpg', 'b.jpg', 'c.jpg', 'd.jpg', 'e.jpg']:
+      self.bucket.upload_fileobj(BytesIO(b'x'), file_name)
+    get_test_photo(file_name='b.jpg')
+    get_test_photo(file_name='bb.jpg')
+    get_test_signed_file(file_name='d.jpg', bucket_name=PUBLIC_BUCKET_NAME)
+    get_test_signed_file(file_name='dd.jpg', bucket_name=SENSITIVE_BUCKET_NAME)
+
+  def test_reconcile(self):
+    self.assertEqual(
+        [('a.jpg', UNACCOUNTED), ('bb.jpg', MISSING), ('c.jpg', UNACCOUNTED),
+         ('e.jpg', UNACCOUNTED)],
+        list(reconcile(self.bucket, also_missing=True, page_size=2)))
+
+  def test_out_of_order(self):
+    with patch.object(
+        self.bucket, 'iter_list', return_value=iter([
+            ListedObject('b', None, 1, ''), ListedObject('a', None, 1, '')])):
+      with self.assertRaises(Exception):
+        list(reconcile(self.bucket))
+
+  def test_list_unaccounted_images(self):
+    self.assertEqual(
+        {'a.jpg', 'c.jpg', 'e.jpg'}, list_unaccounted_images(self.bucket))
+    with self.assertRaises(Exception):
+      list_unaccounted_images(self.bucket, also_delete=True)
+    with override_settings(DEV_BUCKET_NAMES=[PUBLIC_BUCKET_NAME]):
+      list_unaccounted_images(self.bucket, also_delete=True)
+    self.assertEqual(
+        ['b.jpg', 'd.jpg'],
+        [listed.key for listed in self.bucket.iter_list()])
+
 
 class ResizeTests(TestCase):
   def setUp(self):
@@ -143,13 +475,8 @@ class ResizeTests(TestCase):
     self.mock_image.convert.return_value = self.mock_image
     self.mock_image.resize.return_value = self.mock_image
     self.image_opener = Mock(return_value=self.mock_image)
-    self.use_os = Mock()
-    self.use_os.path = Mock()
-    self.use_os.path.exists.return_value = False
-    self.use_os.remove = Mock()
-    self.file_handle = Mock()
-    self.file_handle.close = Mock()
-    self.use_open = Mock(return_value=self.file_handle)
+    self.original = BytesIO(b'original')
+    self.bucket.download_fileobj.return_value = self.original
 
   def test_resize_base_class_raises_exception(self):
     try:
@@ -157,46 +484,1177 @@ class ResizeTests(TestCase):
     except Exception as ex:
       self.assertEqual('Call resize on the child class', ex.args[0])
 
+  def test_save_resizes_just_that_photo(self):
+    with patch(
+        'djaveS3.models.photo.ready_resize_job_count') as ready_count:
+      self.file.save(bucket=self.bucket, image_opener=self.image_opener)
+    self.assertFalse(ready_count.called)
+    self.assert_resized()
+    self.assertEqual(0, ResizeJob.objects.count())
+
   def test_backup_resize(self):
     resize_all(
-        bucket=self.bucket, image_opener=self.image_opener, use_os=self.use_os,
-        use_open=self.use_open)
+        bucket=self.bucket, image_opener=self.image_opener, processes=1)
     self.assert_resized()
+    self.assertEqual(0, ResizeJob.objects.count())
+
+  def test_backup_resize_uses_nnow(self):
+    nnow = now() - timedelta(hours=1)
+    resize_all(
+        nnow=nnow, bucket=self.bucket, image_opener=self.image_opener,
+        processes=1)
+    self.file.refresh_from_db()
+    self.assertEqual(nnow, self.file.resized_at)
+
+  def test_backup_resize_bad_image(self):
+    self.image_opener.side_effect = OSError('cannot identify image file')
+    with patch.object(TestPhoto, 'notify_bad_image') as notify_bad_image:
+      resize_all(
+          bucket=self.bucket, image_opener=self.image_opener, processes=1)
+    self.assertEqual(1, notify_bad_image.call_count)
+    self.assertFalse(self.bucket.upload_fileobj.called)
+    self.file.refresh_from_db()
+    self.assertIsNone(self.file.resized_at)
 
   def test_resize(self):
-    self.file.resize(
-        bucket=self.bucket, image_opener=self.image_opener, use_os=self.use_os,
-        use_open=self.use_open)
+    self.file.resize(bucket=self.bucket, image_opener=self.image_opener)
     self.assert_resized()
 
   def assert_resized(self):
-    # Download the existing file.
+    # Download the existing file into memory.
     self.assertEqual(
-        self.bucket.download.call_args_list, [call('humblebrag.jpg')])
+        self.bucket.download_fileobj.call_args_list,
+        [call('humblebrag.jpg')])
     # Open it.
     self.assertEqual(
-        self.image_opener.call_args_list, [call('humblebrag.jpg')])
+        self.image_opener.call_args_list, [call(self.original)])
+    # Only decode as much of it as it takes.
+    self.assertEqual(
+        self.mock_image.draft.call_args_list, [call('RGB', (400, 800))])
     # Make sure it's in RGB format so it can save as a jpg
     self.assertEqual(
         self.mock_image.convert.call_args_list, [call('RGB')])
     # Resize it.
     self.assertEqual(
-        self.mock_image.resize.call_args_list, [call((400, 800))])
+        self.mock_image.resize.call_args_list,
+        [call((400, 800), reducing_gap=3.0)])
     # Write it.
+    self.assertEqual(1, len(self.mock_image.save.call_args_list))
+    resized = self.mock_image.save.call_args[0][0]
     self.assertEqual(
-        self.use_open.call_args_list, [call('humblebrag.jpg', 'wb')])
-    self.assertEqual(
-        self.mock_image.save.call_args_list,
-        [call(self.file_handle, format='JPEG', quality=100)])
-    self.assertEqual(
-        self.file_handle.close.call_args_list, [call()])
+        call(
+            resized, format='JPEG', quality=85, progressive=True,
+            optimize=True, subsampling='4:2:0'),
+        self.mock_image.save.call_args)
     # Upload it, overwriting the original.
     self.assertEqual(
-        self.bucket.upload.call_args_list, [call('humblebrag.jpg')])
-    # Clean up locally.
-    self.assertEqual(
-        [call('humblebrag.jpg')], self.use_os.remove.call_args_list)
+        self.bucket.upload_fileobj.call_args_list,
+        [call(resized, 'humblebrag.jpg', content_type='image/jpeg')])
     # The database reflects the changes.
     self.file.refresh_from_db()
     self.assertEqual(self.file.file_name, 'humblebrag.jpg')
     self.assertTrue(self.file.resized_at)
+
+
+class InMemoryResizeTests(TestCase):
+  def test_resize_real_jpeg(self):
+    bucket = memory_bucket()
+    upload_test_image(bucket, 'big.jpg', (3200, 2400), color=(200, 100, 50))
+    photo = get_test_photo(file_name='big.jpg')
+    self.assertTrue(photo.resize(bucket=bucket))
+    resized = Image.open(BytesIO(bucket.file_bytes('big.jpg')))
+    self.assertEqual((800, 600), resized.size)
+    self.assertEqual('JPEG', resized.format)
+
+  def test_resize_pipeline_processes(self):
+    bucket = memory_bucket()
+    photos = []
+    for i in range(4):
+      upload_test_image(bucket, 'big{}.jpg'.format(i), (1600, 1200 + i))
+      photos.append(get_test_photo(file_name='big{}.jpg'.format(i)))
+    with patch.object(TestPhoto, 'renditions', return_value=[
+        Rendition('thumb', 120)]):
+      with ResizePipeline(processes=2, bucket=bucket) as pipeline:
+        # One bulk_update for the photos and one bulk_create for their
+        # renditions.
+        with self.assertNumQueries(2):
+          resized = pipeline.resize(photos)
+    self.assertEqual(4, len(resized))
+    self.assertEqual(4, TestPhoto.objects.filter(
+        resized_at__isnull=False).count())
+    self.assertEqual(4, RenditionFile.objects.filter(name='thumb').count())
+    for i in range(4):
+      self.assertEqual(800, Image.open(BytesIO(bucket.file_bytes(
+          'big{}.jpg'.format(i)))).width)
+
+
+class ResizeJobTests(TestCase):
+  def setUp(self):
+    super().setUp()
+    self.photo = get_test_photo(file_name='queued.jpg')
+    self.bucket = Mock(spec=Bucket)
+    self.bucket.name.return_value = PUBLIC_BUCKET_NAME
+
+  def test_save_enqueues_once(self):
+    self.photo.save()
+    self.assertEqual(
+        [self.photo.pk], list(ResizeJob.objects.values_list(
+            'file_id', flat=True)))
+
+  def test_claims_are_leased(self):
+    nnow = ResizeJob.objects.get().run_after
+    self.assertEqual(1, len(claim_resize_jobs(10, nnow=nnow)))
+    self.assertEqual([], claim_resize_jobs(10, nnow=nnow))
+    # The worker that claimed it must have died.
+    jobs = claim_resize_jobs(10, nnow=nnow + timedelta(hours=1))
+    self.assertEqual(2, jobs[0].attempts)
+    self.assertEqual(2, ResizeJob.objects.get().attempts)
+
+  def test_retries_then_dead(self):
+    self.bucket.download_fileobj.side_effect = Exception('Nope')
+    with override_settings(S3_RESIZE_JOB_MAX_ATTEMPTS=2):
+      self.assertEqual(
+          CleanupProgress(1, 0, True),
+          work_resize_jobs(bucket=self.bucket, processes=1))
+      job = ResizeJob.objects.get()
+      self.assertEqual((PENDING, 1), (job.status, job.attempts))
+      self.assertEqual('download failed: Nope', job.last_error)
+      self.assertTrue(job.run_after > now() + timedelta(seconds=50))
+      ResizeJob.objects.update(run_after=now())
+      work_resize_jobs(bucket=self.bucket, processes=1)
+    job = ResizeJob.objects.get()
+    self.assertEqual((DEAD, 2), (job.status, job.attempts))
+    # Dead jobs stay dead.
+    resize_all(bucket=self.bucket, processes=1)
+    self.assertEqual(2, self.bucket.download_fileobj.call_count)
+
+  def test_leases_get_renewed(self):
+    self.bucket.download_fileobj.return_value = BytesIO(b'not an image')
+    with override_settings(S3_RESIZE_JOB_LEASE_SECONDS=0):
+      with patch(
+          'djaveS3.models.photo.renew_resize_jobs',
+          wraps=renew_resize_jobs) as renew:
+        work_resize_jobs(bucket=self.bucket, processes=1)
+    self.assertTrue(renew.called)
+    self.assertEqual(
+        [self.photo.pk], [job.file_id for job in renew.call_args[0][0]])
+
+  def test_renew(self):
+    job, = claim_resize_jobs(10, nnow=ResizeJob.objects.get().run_after)
+    later = job.claimed_until + timedelta(hours=1)
+    renew_resize_jobs([job], nnow=later)
+    self.assertEqual(
+        later + timedelta(seconds=600),
+        ResizeJob.objects.get().claimed_until)
+
+  def test_bad_image_is_dead_right_away(self):
+    self.bucket.download_fileobj.return_value = BytesIO(b'not an image')
+    work_resize_jobs(bucket=self.bucket, processes=1)
+    job = ResizeJob.objects.get()
+    self.assertEqual((DEAD, 1, BAD_IMAGE), (
+        job.status, job.attempts, job.last_error))
+
+  def test_no_file_name_is_dead_right_away(self):
+    TestPhoto.objects.filter(pk=self.photo.pk).update(file_name='')
+    work_resize_jobs(bucket=self.bucket, processes=1)
+    job = ResizeJob.objects.get()
+    self.assertEqual((DEAD, 1, NO_FILE_NAME), (
+        job.status, job.attempts, job.last_error))
+    self.assertFalse(self.bucket.download_fileobj.called)
+
+  def test_already_resized(self):
+    TestPhoto.objects.filter(pk=self.photo.pk).update(resized_at=now())
+    work_resize_jobs(bucket=self.bucket, processes=1)
+    self.assertEqual(0, ResizeJob.objects.count())
+    self.bucket.download_fileobj.assert_not_called()
+
+
+class DedupeTests(TestCase):
+  def setUp(self):
+    super().setUp()
+    self.bucket = memory_bucket()
+    for file_name in ['one.jpg', 'two.jpg', 'three.jpg']:
+      upload_test_image(self.bucket, file_name, (1600, 1200), color=(1, 2, 3))
+    # Photos that are about to get cleaned up don't get shared.
+    self.keep_until = now() + timedelta(days=1)
+    self.one, self.two, self.three = [
+        get_test_photo(
+            file_name=file_name, keep_until=self.keep_until,
+            why_no_need_for_file='Gone')
+        for file_name in ['one.jpg', 'two.jpg', 'three.jpg']]
+    renditions = patch.object(TestPhoto, 'renditions', return_value=[
+        Rendition('thumb', 120)])
+    renditions.start()
+    self.addCleanup(renditions.stop)
+
+  def work(self, *photos):
+    work_resize_jobs(
+        bucket=self.bucket, processes=1,
+        file_ids=[photo.pk for photo in photos])
+    for photo in photos:
+      photo.refresh_from_db()
+
+  def keys(self):
+    return [listed.key for listed in self.bucket.iter_list()]
+
+  def test_shares_resized_copy(self):
+    self.work(self.one)
+    self.assertTrue(self.one.content_hash.startswith('md5:'))
+    with patch.object(
+        ResizePipeline, 'resize', return_value=[]) as pipeline_resize:
+      self.work(self.two, self.three)
+    self.assertEqual([], pipeline_resize.call_args[0][0])
+    for photo in [self.two, self.three]:
+      self.assertEqual('one.jpg', photo.blob_file_name)
+      self.assertEqual(self.one.content_hash, photo.content_hash)
+      self.assertEqual(
+          (self.one.resized_at, 800, 600),
+          (photo.resized_at, photo.width, photo.height))
+      self.assertEqual(
+          'https://my_public_bucket.s3.amazonaws.com/one.jpg',
+          photo.public_file_url())
+      self.assertEqual(['one_thumb.jpg'], [
+          rendition_file.file_name
+          for rendition_file in photo.rendition_files.all()])
+    self.assertEqual(0, ResizeJob.objects.count())
+    self.assertEqual(['one.jpg', 'one_thumb.jpg'], self.keys())
+    self.assertEqual([], list(reconcile(self.bucket, also_missing=True)))
+
+  def test_last_reference_deletes_the_copy(self):
+    self.work(self.one)
+    self.work(self.two)
+    self.one.delete(bucket=self.bucket)
+    self.assertEqual(['one.jpg', 'one_thumb.jpg', 'three.jpg'], self.keys())
+    self.assertEqual([], list(reconcile(self.bucket, also_missing=True)))
+    TestPhoto.objects.filter(pk=self.three.pk).update(
+        why_no_need_for_file='',
+        next_keep_until=self.keep_until + timedelta(days=7))
+    clean_up_no_longer_needed(
+        nnow=self.keep_until + timedelta(hours=12), bucket=self.bucket)
+    self.assertEqual(['three.jpg'], self.keys())
+    self.assertEqual(
+        ['three.jpg'], list(TestPhoto.objects.values_list(
+            'file_name', flat=True)))
+
+  def test_does_not_share_expired_copy(self):
+    self.work(self.one)
+    TestPhoto.objects.filter(pk=self.one.pk).update(
+        keep_until=now() - timedelta(minutes=1))
+    self.work(self.two)
+    self.assertEqual('', self.two.blob_file_name)
+    self.assertIsNotNone(self.two.resized_at)
+    self.assertEqual(['two_thumb.jpg'], [
+        rendition_file.file_name
+        for rendition_file in self.two.rendition_files.all()])
+
+  def test_shared_photos_get_post_resize(self):
+    with patch.object(TestPhoto, 'post_resize') as post_resize:
+      self.work(self.one)
+      self.work(self.two)
+    self.assertEqual('one.jpg', self.two.blob_file_name)
+    self.assertEqual(2, post_resize.call_count)
+
+  def test_additional_resize_steps_dont_share(self):
+    with patch.object(
+        TestPhoto, 'do_additional_resize_steps',
+        side_effect=lambda image, **kwargs: image):
+      self.work(self.one)
+      self.work(self.two)
+    self.assertEqual('', self.two.blob_file_name)
+    self.assertEqual('', self.two.content_hash)
+
+  def test_sharers_cleaned_up_in_separate_chunks(self):
+    self.work(self.one)
+    self.work(self.two)
+    TestPhoto.objects.filter(pk=self.three.pk).update(
+        why_no_need_for_file='',
+        next_keep_until=self.keep_until + timedelta(days=7))
+    clean_up_no_longer_needed(
+        nnow=self.keep_until + timedelta(hours=12), bucket=self.bucket,
+        chunk_size=1)
+    self.assertEqual(['three.jpg'], self.keys())
+    self.assertEqual([], list(reconcile(self.bucket, also_missing=True)))
+
+  def test_sharers_deleted_together(self):
+    self.work(self.one)
+    self.work(self.two)
+    self.assertEqual(
+        {self.one.pk: ['one.jpg', 'one_thumb.jpg'], self.two.pk: ['two.jpg']},
+        deletable_file_names([self.one, self.two]))
+    self.assertEqual(
+        {self.two.pk: ['two.jpg']}, deletable_file_names([self.two]))
+
+  def test_content_hash_from_metadata(self):
+    self.assertEqual(
+        'md5:5d41402abc4b2a76b9719d911017c592:5',
+        content_hash_from_metadata(FileMetadata(
+            '"5D41402ABC4B2A76B9719D911017C592"', None, None, 5)))
+    self.assertEqual(
+        content_hash_from_bytes(b'hello'), content_hash_from_metadata(
+            FileMetadata('"5d41402abc4b2a76b9719d911017c592"', None, None, 5)))
+    # Multipart upload
+    self.assertIsNone(content_hash_from_metadata(FileMetadata(
+        '"5d41402abc4b2a76b9719d911017c592-2"', None, None, 5)))
+
+
+class RenditionTests(TestCase):
+  def setUp(self):
+    super().setUp()
+    self.bucket = memory_bucket()
+    upload_test_image(self.bucket, 'big.png', (1600, 1200), format='PNG')
+    self.photo = get_test_photo(
+        file_name='big.png', keep_until=str_to_tz_dt('2018-12-24'),
+        why_no_need_for_file='Gone')
+    renditions = patch.object(TestPhoto, 'renditions', return_value=[
+        Rendition('thumb', 120), Rendition('medium', 400)])
+    renditions.start()
+    self.addCleanup(renditions.stop)
+
+  def sizes(self):
+    return {
+        listed.key: Image.open(BytesIO(self.bucket.file_bytes(
+            listed.key))).size
+        for listed in self.bucket.iter_list()}
+
+  def test_resize(self):
+    self.assertTrue(self.photo.resize(bucket=self.bucket))
+    self.assertEqual({
+        'big.png': (800, 600), 'big_medium.jpg': (400, 300),
+        'big_thumb.jpg': (120, 90)}, self.sizes())
+    self.assertEqual(
+        ['big_medium.jpg', 'big_thumb.jpg'],
+        sorted(RenditionFile.objects.filter(file=self.photo).values_list(
+            'file_name', flat=True)))
+    self.assertEqual(
+        ['big.png', 'big_medium.jpg', 'big_thumb.jpg'],
+        sorted(self.photo.all_file_names()))
+    self.assertEqual([], list(reconcile(self.bucket, also_missing=True)))
+    self.assertEqual((
+        'https://my_public_bucket.s3.amazonaws.com/big_thumb.jpg '
+        '120w, '
+        'https://my_public_bucket.s3.amazonaws.com/big_medium.jpg '
+        '400w, '
+        'https://my_public_bucket.s3.amazonaws.com/big.png 800w'),
+        Template(
+            '{% load photo_extras %}{% photo_srcset photo %}').render(
+                Context({'photo': self.photo})))
+
+  def test_resize_all(self):
+    resize_all(
+        nnow=str_to_tz_dt('2018-12-24'), bucket=self.bucket, processes=1)
+    self.assertEqual({
+        'big.png': (800, 600), 'big_medium.jpg': (400, 300),
+        'big_thumb.jpg': (120, 90)}, self.sizes())
+    self.assertEqual(2, RenditionFile.objects.count())
+    self.photo.refresh_from_db()
+    self.assertEqual((800, 600), (self.photo.width, self.photo.height))
+
+  def test_clean_up_deletes_renditions(self):
+    self.photo.resize(bucket=self.bucket)
+    clean_up_no_longer_needed(
+        nnow=str_to_tz_dt('2018-12-25 12:00'), bucket=self.bucket)
+    self.assertEqual({}, self.sizes())
+    self.assertEqual(0, RenditionFile.objects.count())
+
+  def test_delete_deletes_renditions(self):
+    self.photo.resize(bucket=self.bucket)
+    self.photo.delete(bucket=self.bucket)
+    self.assertEqual({}, self.sizes())
+
+  def test_alternate_formats(self):
+    with patch.object(TestPhoto, 'image_encoding', return_value=ImageEncoding(
+        alternate_formats=[WEBP_CONTENT_TYPE, AVIF_CONTENT_TYPE])):
+      self.assertTrue(self.photo.resize(bucket=self.bucket))
+    keys = [listed.key for listed in self.bucket.iter_list()]
+    self.assertEqual([
+        'big.png', 'big.png.avif', 'big.png.webp', 'big_medium.jpg',
+        'big_medium.jpg.avif', 'big_medium.jpg.webp', 'big_thumb.jpg',
+        'big_thumb.jpg.avif', 'big_thumb.jpg.webp'], keys)
+    self.assertEqual('WEBP', Image.open(BytesIO(self.bucket.file_bytes(
+        'big_thumb.jpg.webp'))).format)
+    self.assertEqual([], list(reconcile(self.bucket, also_missing=True)))
+    root = 'https://my_public_bucket.s3.amazonaws.com/'
+    self.assertEqual(
+        root + 'big.png.avif',
+        self.photo.public_file_url(accept='image/avif,image/webp,*/*'))
+    self.assertEqual(
+        root + 'big.png.webp',
+        self.photo.public_file_url(accept='image/avif;q=0,image/webp'))
+    self.assertEqual(
+        root + 'big.png', self.photo.public_file_url(accept='*/*'))
+    self.assertEqual(root + 'big.png', self.photo.public_file_url())
+    self.assertEqual((
+        '{0}big_thumb.jpg.webp 120w, {0}big_medium.jpg.webp 400w, '
+        '{0}big.png.webp 800w').format(root),
+        self.photo.srcset(WEBP_CONTENT_TYPE))
+    self.photo.delete(bucket=self.bucket)
+    self.assertEqual([], list(self.bucket.iter_list()))
+
+  def test_srcset_before_resize(self):
+    self.assertEqual(
+        'https://my_public_bucket.s3.amazonaws.com/big.png',
+        self.photo.srcset())
+
+
+class BotoClientTests(TestCase):
+  def setUp(self):
+    super().setUp()
+    forget_boto_clients()
+    reset_boto_client_stats()
+
+  def tearDown(self):
+    forget_boto_clients()
+    super().tearDown()
+
+  @patch('djaveS3.boto_client._new_boto_client')
+  def test_clients_are_reused(self, new_boto_client):
+    new_boto_client.side_effect = lambda *args: Mock()
+    first = get_boto_client('key', 'secret')
+    self.assertIs(first, get_boto_client('key', 'secret'))
+    self.assertIsNot(first, get_boto_client('key', 'secret', 'eu-west-1'))
+    self.assertIsNot(first, get_boto_client('other_key', 'secret'))
+    stats = boto_client_stats()
+    self.assertEqual(1, stats.hits)
+    self.assertEqual(3, stats.misses)
+    self.assertEqual(3, stats.cached)
+
+  @patch('djaveS3.boto_client._new_boto_client')
+  def test_forget_and_refresh(self, new_boto_client):
+    new_boto_client.side_effect = lambda *args: Mock()
+    first = get_boto_client('key', 'secret')
+    get_boto_client('other_key', 'secret')
+    refreshed = refresh_boto_client('key', 'new_secret')
+    self.assertIsNot(first, refreshed)
+    self.assertIs(refreshed, get_boto_client('key', 'new_secret'))
+    self.assertEqual(1, forget_boto_clients(access_key_id='other_key'))
+    self.assertEqual(1, boto_client_stats().cached)
+
+  @patch('djaveS3.boto_client._new_async_boto_client')
+  def test_forgotten_async_clients_still_get_closed(self, new_client):
+    closed = []
+
+    async def make_client(*args):
+      client = Mock()
+
+      async def close():
+        closed.append(client)
+      client.close = close
+      return client
+    new_client.side_effect = make_client
+
+    async def go():
+      first = await get_async_boto_client('key', 'secret')
+      forget_boto_clients()
+      second = await get_async_boto_client('key', 'secret')
+      self.assertIsNot(first, second)
+      await close_async_boto_clients()
+      self.assertCountEqual([first, second], closed)
+    asyncio.run(go())
+
+
+class FileBytesTests(TestCase):
+  def setUp(self):
+    super().setUp()
+    self.boto_client = Mock()
+    self.boto_client.get_object.side_effect = lambda **kwargs: {
+        'Body': BytesIO(b'0123456789'), 'ContentLength': 10}
+    self.bucket = Bucket(SENSITIVE_BUCKET_CONFIG, boto_client=self.boto_client)
+
+  def test_file_bytes(self):
+    self.assertEqual(b'0123456789', self.bucket.file_bytes('ab.jpg'))
+    self.assertEqual(
+        [call(Bucket=SENSITIVE_BUCKET_NAME, Key='ab.jpg')],
+        self.boto_client.get_object.call_args_list)
+
+  def test_file_bytes_too_big(self):
+    self.assertEqual(
+        b'0123456789', self.bucket.file_bytes('ab.jpg', max_bytes=10))
+    with self.assertRaises(FileTooBigException):
+      self.bucket.file_bytes('ab.jpg', max_bytes=9)
+
+  def test_file_bytes_missing(self):
+    self.boto_client.get_object.side_effect = ClientError(
+        {'Error': {'Code': 'NoSuchKey'}}, 'GetObject')
+    self.assertIsNone(self.bucket.file_bytes('ab.jpg'))
+
+  def test_iter_file_bytes(self):
+    self.assertEqual(
+        [b'0123', b'4567', b'89'],
+        list(self.bucket.iter_file_bytes('ab.jpg', chunk_size=4)))
+
+  def test_utf8_encoded_image(self):
+    self.assertEqual(
+        'MDEyMzQ1Njc4OQ==', self.bucket.utf8_encoded_image('ab.jpg'))
+
+
+class StreamingSensitiveFileResponseTests(TestCase):
+  def setUp(self):
+    super().setUp()
+    self.file = get_test_photo(
+        bucket_name=SENSITIVE_BUCKET_NAME, file_name='secret.jpg')
+    self.boto_client = Mock()
+    self.bucket = Bucket(SENSITIVE_BUCKET_CONFIG, boto_client=self.boto_client)
+
+  def test_whole_file(self):
+    self.boto_client.get_object.return_value = {
+        'Body': BytesIO(b'0123456789'), 'ContentLength': 10}
+    response = streaming_sensitive_file_response(
+        RequestFactory().get('/'), self.file, chunk_size=4,
+        bucket=self.bucket)
+    self.assertEqual(200, response.status_code)
+    self.assertEqual('10', response['Content-Length'])
+    self.assertEqual('image/jpeg', response['Content-Type'])
+    self.assertEqual(b'0123456789', b''.join(response.streaming_content))
+    self.assertEqual(
+        [call(Bucket=SENSITIVE_BUCKET_NAME, Key='secret.jpg')],
+        self.boto_client.get_object.call_args_list)
+
+  def test_range(self):
+    self.boto_client.get_object.return_value = {
+        'Body': BytesIO(b'2345'), 'ContentLength': 4,
+        'ContentRange': 'bytes 2-5/10'}
+    response = streaming_sensitive_file_response(
+        RequestFactory().get('/', HTTP_RANGE='bytes=2-5'), self.file,
+        bucket=self.bucket)
+    self.assertEqual(206, response.status_code)
+    self.assertEqual('bytes 2-5/10', response['Content-Range'])
+    self.assertEqual(b'2345', b''.join(response.streaming_content))
+    self.assertEqual(
+        [call(Bucket=SENSITIVE_BUCKET_NAME, Key='secret.jpg',
+              Range='bytes=2-5')],
+        self.boto_client.get_object.call_args_list)
+
+  def test_multiple_ranges_get_the_whole_file(self):
+    self.boto_client.get_object.return_value = {
+        'Body': BytesIO(b'0123456789'), 'ContentLength': 10}
+    response = streaming_sensitive_file_response(
+        RequestFactory().get('/', HTTP_RANGE='bytes=0-1,4-5'), self.file,
+        bucket=self.bucket)
+    self.assertEqual(200, response.status_code)
+
+
+class SensitiveFileResponseTests(TestCase):
+  def setUp(self):
+    super().setUp()
+    forget_memory_buckets()
+    self.file = get_test_photo(
+        bucket_name=SENSITIVE_BUCKET_NAME, file_name='secret.jpg')
+    self.backend = Mock(wraps=Bucket(
+        SENSITIVE_BUCKET_CONFIG._replace(backend=MEMORY_BACKEND)).backend)
+    self.bucket = Bucket(SENSITIVE_BUCKET_CONFIG, backend=self.backend)
+    self.bucket.upload_fileobj(BytesIO(b'0123456789'), 'secret.jpg')
+
+  def test_cache_headers(self):
+    response = sensitive_file_response(
+        self.file, request=RequestFactory().get('/'), bucket=self.bucket)
+    self.assertEqual(200, response.status_code)
+    self.assertEqual(b'0123456789', response.content)
+    self.assertEqual('private, no-cache', response['Cache-Control'])
+    self.assertTrue(response['ETag'])
+    self.assertTrue(response['Last-Modified'])
+
+  def test_not_modified(self):
+    etag = sensitive_file_response(self.file, bucket=self.bucket)['ETag']
+    response = sensitive_file_response(
+        self.file, request=RequestFactory().get('/', HTTP_IF_NONE_MATCH=etag),
+        bucket=self.bucket)
+    self.assertEqual(304, response.status_code)
+    self.assertEqual(etag, response['ETag'])
+    self.assertEqual(1, self.backend.head.call_count)
+    self.assertEqual(1, self.backend.get.call_count)
+
+  def test_modified(self):
+    response = sensitive_file_response(
+        self.file, request=RequestFactory().get(
+            '/', HTTP_IF_NONE_MATCH='"stale"'),
+        bucket=self.bucket)
+    self.assertEqual(200, response.status_code)
+
+  def test_warm_file_cache_skips_s3(self):
+    self.bucket.file_cache = FileCache(100, max_age=60)
+    etag = sensitive_file_response(self.file, bucket=self.bucket)['ETag']
+    response = streaming_sensitive_file_response(
+        RequestFactory().get('/', HTTP_IF_NONE_MATCH=etag), self.file,
+        bucket=self.bucket)
+    self.assertEqual(304, response.status_code)
+    self.assertEqual(0, self.backend.head.call_count)
+
+  def test_negotiates_alternate_formats(self):
+    self.bucket.upload_fileobj(BytesIO(b'webp'), 'secret.jpg.webp')
+    RenditionFile.objects.create(
+        file=self.file, file_name='secret.jpg.webp', width=8, height=8,
+        content_type=WEBP_CONTENT_TYPE)
+    response = sensitive_file_response(
+        self.file, request=RequestFactory().get(
+            '/', HTTP_ACCEPT='image/avif,image/webp,*/*'),
+        bucket=self.bucket)
+    self.assertEqual(b'webp', response.content)
+    self.assertEqual(WEBP_CONTENT_TYPE, response['Content-Type'])
+    self.assertEqual('Accept', response['Vary'])
+    response = sensitive_file_response(
+        self.file, request=RequestFactory().get('/', HTTP_ACCEPT='*/*'),
+        bucket=self.bucket)
+    self.assertEqual(b'0123456789', response.content)
+    self.assertEqual('Accept', response['Vary'])
+
+  def test_missing(self):
+    self.bucket.delete('secret.jpg')
+    with self.assertRaises(Http404):
+      sensitive_file_response(self.file, bucket=self.bucket)
+    with self.assertRaises(Http404):
+      sensitive_file_response(
+          self.file, request=RequestFactory().get(
+              '/', HTTP_IF_NONE_MATCH='"stale"'),
+          bucket=self.bucket)
+
+
+class BestAlternateTests(TestCase):
+  def test_best_alternate(self):
+    both = {AVIF_CONTENT_TYPE: 'a', WEBP_CONTENT_TYPE: 'w'}
+    self.assertEqual(
+        AVIF_CONTENT_TYPE, best_alternate(both, 'image/webp, image/avif'))
+    self.assertEqual(
+        WEBP_CONTENT_TYPE,
+        best_alternate(both, 'image/avif; q=0, image/webp;q=0.8'))
+    self.assertIsNone(best_alternate(both, 'image/*, */*'))
+    self.assertIsNone(best_alternate(both, None))
+    self.assertIsNone(best_alternate({}, 'image/avif'))
+
+
+class SensitiveFileRedirectTests(TestCase):
+  def setUp(self):
+    super().setUp()
+    forget_presigned_urls()
+    self.file = get_test_photo(
+        bucket_name=SENSITIVE_BUCKET_NAME, file_name='secret.jpg')
+    self.boto_client = Mock()
+    self.boto_client.generate_presigned_url.side_effect = (
+        lambda *args, **kwargs: 'https://s3/{}'.format(
+            self.boto_client.generate_presigned_url.call_count))
+    self.bucket = Bucket(SENSITIVE_BUCKET_CONFIG, boto_client=self.boto_client)
+
+  def redirect(self, user_pk):
+    request = RequestFactory().get('/')
+    request.user = Mock(pk=user_pk)
+    return sensitive_file_redirect(
+        request, self.file, expires_in=30, bucket=self.bucket)
+
+  def test_urls_get_reused_per_user(self):
+    response = self.redirect(1)
+    self.assertEqual(302, response.status_code)
+    self.assertEqual('https://s3/1', response['Location'])
+    self.assertEqual('private, no-store', response['Cache-Control'])
+    self.assertEqual('https://s3/1', self.redirect(1)['Location'])
+    self.assertEqual('https://s3/2', self.redirect(2)['Location'])
+    self.assertEqual(
+        call('get_object', Params={
+            'Bucket': SENSITIVE_BUCKET_NAME, 'Key': 'secret.jpg',
+            'ResponseContentDisposition': 'inline',
+            'ResponseCacheControl': 'private, max-age=30',
+            'ResponseContentType': 'image/jpeg'}, ExpiresIn=30),
+        self.boto_client.generate_presigned_url.call_args_list[0])
+
+  def test_urls_expire(self):
+    self.redirect(1)
+    with patch('djaveS3.views.time.time', return_value=time.time() + 25):
+      self.assertEqual('https://s3/2', self.redirect(1)['Location'])
+
+  def test_cache_size_is_capped(self):
+    with patch('djaveS3.views.PRESIGNED_URL_CACHE_SIZE', 2):
+      self.redirect(1)
+      self.redirect(2)
+      # 1 is now the most recently used, so 2 is the one that goes.
+      self.redirect(1)
+      self.redirect(3)
+      self.assertEqual('https://s3/1', self.redirect(1)['Location'])
+      self.assertEqual('https://s3/4', self.redirect(2)['Location'])
+
+  def test_local_download(self):
+    forget_memory_buckets()
+    self.bucket = Bucket(
+        SENSITIVE_BUCKET_CONFIG._replace(backend=MEMORY_BACKEND))
+    self.bucket.upload_fileobj(BytesIO(b'0123456789'), 'secret.jpg')
+    url = self.redirect(1)['Location']
+    with patch('djaveS3.views.Bucket', return_value=self.bucket):
+      response = self.client.get(url)
+      forged = self.client.get(url.replace('secret', 'other'))
+    self.assertEqual(200, response.status_code)
+    self.assertEqual(b'0123456789', b''.join(response.streaming_content))
+    self.assertEqual('image/jpeg', response['Content-Type'])
+    self.assertEqual('private, max-age=30', response['Cache-Control'])
+    self.assertEqual(403, forged.status_code)
+
+
+class SignUploadsTests(TestCase):
+  def setUp(self):
+    super().setUp()
+    self.bucket_config = SENSITIVE_BUCKET_CONFIG._replace(
+        backend=MEMORY_BACKEND)
+
+  def test_generate_presigned_posts(self):
+    SignedFile.objects.create(
+        file_name='a.jpg', bucket_name=SENSITIVE_BUCKET_NAME)
+    with self.assertNumQueries(1):
+      presigned_posts = generate_presigned_posts(
+          self.bucket_config,
+          [('a.jpg', 'image/jpeg'), ('b.png', 'image/png')])
+    self.assertEqual(
+        ['a.jpg', 'b.png'],
+        [presigned['fields']['key'] for presigned in presigned_posts])
+    self.assertEqual(
+        'image/png', presigned_posts[1]['fields']['Content-Type'])
+    self.assertEqual(
+        ['a.jpg', 'b.png'],
+        sorted(SignedFile.objects.values_list('file_name', flat=True)))
+
+  def sign(self, *file_types):
+    request = RequestFactory().get('/', {'file_type': list(file_types)})
+    with patch(
+        'djaveS3.generate_presigned_post.get_bucket_config',
+        return_value=self.bucket_config):
+      return sign_uploads(request, SENSITIVE_BUCKET_NAME)
+
+  def test_sign_uploads(self):
+    response = self.sign('image/jpeg', 'image/png')
+    self.assertEqual(200, response.status_code)
+    uploads = json.loads(response.content)['uploads']
+    self.assertEqual(2, len(uploads))
+    self.assertTrue(uploads[1]['destination_file_name'].endswith('.png'))
+    self.assertEqual(2, SignedFile.objects.count())
+
+  @override_settings(S3_MAX_UPLOADS_PER_SIGN=1)
+  def test_cap(self):
+    self.assertEqual(400, self.sign('image/jpeg', 'image/png').status_code)
+    self.assertEqual(400, self.sign().status_code)
+    self.assertEqual(0, SignedFile.objects.count())
+
+
+class BucketConfigRegistryTests(TestCase):
+  def tearDown(self):
+    forget_bucket_configs()
+    super().tearDown()
+
+  def settings_with(self, s3_buckets):
+    return patch(
+        'djaveS3.get_bucket_config.settings',
+        Mock(TEST=False, S3_BUCKETS=s3_buckets, S3_LOCAL_ROOT=None))
+
+  def test_lookups(self):
+    with self.settings_with([PUBLIC_BUCKET_CONFIG, SENSITIVE_BUCKET_CONFIG]):
+      load_bucket_configs()
+      self.assertEqual(
+          SENSITIVE_BUCKET_CONFIG, get_bucket_config(SENSITIVE_BUCKET_NAME))
+      self.assertEqual(
+          'https://{}.s3.amazonaws.com/a.jpg'.format(PUBLIC_BUCKET_NAME),
+          public_file_url(PUBLIC_BUCKET_NAME, 'a.jpg'))
+      with self.assertRaises(GetBucketConfigException):
+        get_bucket_config('nope')
+
+  def test_reloads_after_changes(self):
+    with self.settings_with([PUBLIC_BUCKET_CONFIG]) as settings:
+      load_bucket_configs()
+      settings.S3_BUCKETS = [SENSITIVE_BUCKET_CONFIG]
+      with self.assertRaises(GetBucketConfigException):
+        get_bucket_config(SENSITIVE_BUCKET_NAME)
+      forget_bucket_configs()
+      self.assertEqual(
+          SENSITIVE_BUCKET_CONFIG, get_bucket_config(SENSITIVE_BUCKET_NAME))
+
+  def test_validation(self):
+    for bad in [
+        [PUBLIC_BUCKET_CONFIG, PUBLIC_BUCKET_CONFIG],
+        [('not', 'a', 'bucket', 'config')],
+        [PUBLIC_BUCKET_CONFIG._replace(name='')],
+        [PUBLIC_BUCKET_CONFIG._replace(backend='floppy')],
+        [PUBLIC_BUCKET_CONFIG._replace(backend=LOCAL_BACKEND)],
+        [PUBLIC_BUCKET_CONFIG._replace(transfer_profile=5)]]:
+      with self.settings_with(bad):
+        with self.assertRaises(GetBucketConfigException):
+          load_bucket_configs()
+
+
+class PublicFileUrlTests(TestCase):
+  def test_url_roots(self):
+    self.assertEqual(
+        'https://my_public_bucket.s3.amazonaws.com/',
+        PUBLIC_BUCKET_CONFIG.public_url_root())
+    self.assertEqual(
+        'https://s3.amazonaws.com/my_public_bucket/',
+        PUBLIC_BUCKET_CONFIG._replace(
+            addressing_style=PATH_ADDRESSING).public_url_root())
+    self.assertEqual(
+        'http://minio:9000/my_public_bucket/',
+        PUBLIC_BUCKET_CONFIG._replace(
+            addressing_style=PATH_ADDRESSING,
+            endpoint_url='http://minio:9000').public_url_root())
+    self.assertEqual(
+        'https://cdn.example.com/',
+        PUBLIC_BUCKET_CONFIG._replace(
+            public_domain='cdn.example.com').public_url_root())
+    self.assertEqual(
+        'https://cdn.example.com/photos/',
+        PUBLIC_BUCKET_CONFIG._replace(
+            public_domain='https://cdn.example.com/photos').public_url_root())
+
+  def test_public_file_urls(self):
+    photos = [
+        get_test_photo(file_name='a.jpg'), get_test_photo(file_name='b.jpg')]
+    expected = [
+        'https://my_public_bucket.s3.amazonaws.com/a.jpg',
+        'https://my_public_bucket.s3.amazonaws.com/b.jpg']
+    self.assertEqual(expected, public_file_urls(photos))
+    self.assertEqual(
+        expected,
+        public_file_urls(photos, bucket_config=PUBLIC_BUCKET_CONFIG))
+    # Base class Files don't know their bucket_config, but they do know their
+    # bucket name, so only the first one has to go find its child class.
+    with self.assertNumQueries(3):
+      self.assertEqual(expected, public_file_urls(
+          File.objects.filter(pk__in=[photo.pk for photo in photos]).order_by(
+              'file_name')))
+    self.assertEqual(
+        ' a.jpg=https://my_public_bucket.s3.amazonaws.com/a.jpg '
+        'b.jpg=https://my_public_bucket.s3.amazonaws.com/b.jpg',
+        Template(
+            '{% load photo_extras %}{% for photo, url in photos'
+            '|with_public_file_urls %} {{ photo.file_name }}={{ url }}'
+            '{% endfor %}').render(Context({'photos': photos})))
+
+
+class IterListTests(TestCase):
+  def setUp(self):
+    super().setUp()
+    self.keys = ['A1.jpg', 'A2.jpg', 'B1.jpg', 'B2.jpg', 'C1.jpg']
+    self.boto_client = Mock()
+    self.boto_client.list_objects_v2.side_effect = self.list_objects_v2
+    self.bucket = Bucket(PUBLIC_BUCKET_CONFIG, boto_client=self.boto_client)
+
+  def list_objects_v2(self, **kwargs):
+    # A 2 key per page stand in for S3.
+    keys = [
+        key for key in self.keys
+        if key.startswith(kwargs.get('Prefix', ''))
+        and key > kwargs.get('StartAfter', '')]
+    start = int(kwargs.get('ContinuationToken', 0))
+    page = keys[start:start + 2]
+    result = {'IsTruncated': start + 2 < len(keys), 'Contents': [
+        {'Key': key, 'LastModified': None, 'Size': 1, 'ETag': '"e"'}
+        for key in page]}
+    if result['IsTruncated']:
+      result['NextContinuationToken'] = str(start + 2)
+    return result
+
+  def test_iter_list_follows_continuation_tokens(self):
+    self.assertEqual(
+        self.keys, [listed.key for listed in self.bucket.iter_list()])
+    self.assertEqual(3, self.boto_client.list_objects_v2.call_count)
+
+  def test_iter_list_prefix_and_start_after(self):
+    self.assertEqual(
+        ['B2.jpg'], [listed.key for listed in self.bucket.iter_list(
+            prefix='B', start_after='B1.jpg')])
+
+  def test_iter_list_parallel(self):
+    self.assertEqual(self.keys, sorted(
+        listed.key for listed in self.bucket.iter_list_parallel(
+            max_workers=3)))
+
+  def test_iter_list_parallel_stops_early(self):
+    listing = self.bucket.iter_list_parallel(max_workers=3, page_size=1)
+    next(listing)
+    listing.close()
+
+
+class TransferTests(TestCase):
+  def test_transfer_profile(self):
+    bucket = Bucket(
+        PUBLIC_BUCKET_CONFIG._replace(transfer_profile=TransferProfile(
+            multipart_chunksize=16 * 1024 * 1024, max_concurrency=4)),
+        boto_client=Mock())
+    bucket.upload_fileobj(
+        BytesIO(b'abc'), 'abc.jpg', content_type='image/jpeg')
+    kwargs = bucket.boto_client.upload_fileobj.call_args[1]
+    self.assertEqual({'ContentType': 'image/jpeg'}, kwargs['ExtraArgs'])
+    self.assertEqual(16 * 1024 * 1024, kwargs['Config'].multipart_chunksize)
+    self.assertEqual(4, kwargs['Config'].max_concurrency)
+
+  def test_download_fileobj(self):
+    boto_client = Mock()
+    boto_client.download_fileobj.side_effect = (
+        lambda bucket, key, fileobj, **kwargs: fileobj.write(b'abc'))
+    bucket = Bucket(PUBLIC_BUCKET_CONFIG, boto_client=boto_client)
+    self.assertEqual(b'abc', bucket.download_fileobj('abc.jpg').read())
+
+  def test_transfer_progress(self):
+    callback = Mock()
+    progress = TransferProgress(callback)
+    progress(100)
+    progress(50)
+    self.assertEqual(150, callback.call_args[0][0].bytes_transferred)
+
+
+class FakeAsyncBody(object):
+  """ Like a real stream, a read with amt set can return fewer bytes than
+  that even when there are more to come. """
+  def __init__(self, data, max_read=3):
+    self.data = BytesIO(data)
+    self.max_read = max_read
+
+  async def read(self, amt=None):
+    await asyncio.sleep(0)
+    if amt is None:
+      return self.data.read()
+    return self.data.read(min(amt, self.max_read))
+
+  def close(self):
+    pass
+
+
+class FakeAsyncS3Client(object):
+  """ An in process stand in for an aiobotocore S3 client. """
+  def __init__(self):
+    self.files = {}
+    self.send_content_length = True
+    # How many delete_objects calls are going at once, and the most ever.
+    self.deleting = 0
+    self.max_deleting = 0
+
+  async def get_object(self, Bucket, Key, Range=None):
+    if (Bucket, Key) not in self.files:
+      raise ClientError({'Error': {'Code': 'NoSuchKey'}}, 'GetObject')
+    data = self.files[(Bucket, Key)]
+    response = {'Body': FakeAsyncBody(data), 'ETag': self.etag(data)}
+    if self.send_content_length:
+      response['ContentLength'] = len(data)
+    return response
+
+  async def head_object(self, Bucket, Key):
+    if (Bucket, Key) not in self.files:
+      raise ClientError({'Error': {'Code': '404'}}, 'HeadObject')
+    data = self.files[(Bucket, Key)]
+    return {'ETag': self.etag(data), 'ContentLength': len(data)}
+
+  def etag(self, data):
+    return '"{}"'.format(content_hash_from_bytes(data).split(':')[1])
+
+  async def put_object(self, Bucket, Key, Body, ContentType=None):
+    self.files[(Bucket, Key)] = Body
+
+  async def list_objects_v2(self, Bucket, MaxKeys, **kwargs):
+    keys = sorted(key for bucket, key in self.files if bucket == Bucket)
+    return {'Contents': [
+        {'Key': key, 'LastModified': None, 'Size': 1} for key in keys]}
+
+  async def delete_object(self, Bucket, Key):
+    self.files.pop((Bucket, Key), None)
+    return {'ResponseMetadata': {'HTTPStatusCode': 204}}
+
+  async def delete_objects(self, Bucket, Delete):
+    self.deleting += 1
+    self.max_deleting = max(self.max_deleting, self.deleting)
+    await asyncio.sleep(0)
+    for obj in Delete['Objects']:
+      self.files.pop((Bucket, obj['Key']), None)
+    self.deleting -= 1
+    return {}
+
+  async def generate_presigned_post(self, **kwargs):
+    return {'url': 'https://example.com', 'fields': kwargs['Fields']}
+
+
+class AsyncBucketTests(TestCase):
+  def setUp(self):
+    super().setUp()
+    self.client = FakeAsyncS3Client()
+    self.bucket = AsyncBucket(SENSITIVE_BUCKET_CONFIG, client=self.client)
+
+  def test_async_bucket(self):
+    async def go():
+      await asyncio.gather(*[
+          self.bucket.upload_bytes(str(i).encode(), '{}.jpg'.format(i))
+          for i in range(5)])
+      self.assertEqual(
+          ['0.jpg', '1.jpg', '2.jpg', '3.jpg', '4.jpg'],
+          [file_name for file_name, _ in await self.bucket.list()])
+      self.assertEqual(b'3', await self.bucket.file_bytes('3.jpg'))
+      self.assertEqual({}, await self.bucket.delete_many(['0.jpg', '1.jpg']))
+      self.assertTrue(await self.bucket.delete('2.jpg'))
+      self.assertEqual(2, len(await self.bucket.list()))
+      self.assertIsNone(await self.bucket.file_bytes('0.jpg'))
+    asyncio.run(go())
+
+  def test_async_file_bytes_max_bytes(self):
+    self.client.files[(SENSITIVE_BUCKET_NAME, 'a.jpg')] = b'0123456789'
+    for send_content_length in [True, False]:
+      self.client.send_content_length = send_content_length
+      self.assertEqual(b'0123456789', asyncio.run(
+          self.bucket.file_bytes('a.jpg', max_bytes=10)))
+      with self.assertRaises(FileTooBigException):
+        asyncio.run(self.bucket.file_bytes('a.jpg', max_bytes=9))
+
+  def test_async_delete_many_concurrency(self):
+    file_names = ['{}.jpg'.format(i) for i in range(5000)]
+    for file_name in file_names:
+      self.client.files[(SENSITIVE_BUCKET_NAME, file_name)] = b'x'
+    self.assertEqual({}, asyncio.run(
+        self.bucket.delete_many(file_names, max_concurrent=2)))
+    self.assertEqual(2, self.client.max_deleting)
+    self.assertEqual({}, self.client.files)
+
+  def test_async_sensitive_file_response(self):
+    photo = TestPhoto(bucket_name=SENSITIVE_BUCKET_NAME, file_name='a.jpg')
+    self.client.files[(SENSITIVE_BUCKET_NAME, 'a.jpg')] = b'abc'
+    response = asyncio.run(
+        async_sensitive_file_response(photo, bucket=self.bucket))
+    self.assertEqual(b'abc', response.content)
+    self.assertEqual('private, no-cache', response['Cache-Control'])
+    request = RequestFactory().get('/', HTTP_IF_NONE_MATCH=response['ETag'])
+    not_modified = asyncio.run(async_sensitive_file_response(
+        photo, request=request, bucket=self.bucket))
+    self.assertEqual(304, not_modified.status_code)
+    self.client.files[(SENSITIVE_BUCKET_NAME, 'a.jpg')] = b'abcd'
+    self.assertEqual(b'abcd', asyncio.run(async_sensitive_file_response(
+        photo, request=request, bucket=self.bucket)).content)
+    photo.file_name = 'b.jpg'
+    with self.assertRaises(Http404):
+      asyncio.run(async_sensitive_file_response(photo, bucket=self.bucket))
+
+
+class StorageBackendTestsMixin(object):
+  def test_backend(self):
+    self.bucket.upload_fileobj(BytesIO(b'0123456789'), 'B.jpg')
+    self.bucket.upload_fileobj(BytesIO(b'abc'), 'A.jpg')
+    self.bucket.upload_fileobj(BytesIO(b'xyz'), 'C.png')
+    self.assertEqual(
+        ['A.jpg', 'B.jpg', 'C.png'],
+        [file_name for file_name, _ in self.bucket.list()])
+    self.assertEqual(
+        ['B.jpg'], [listed.key for listed in self.bucket.iter_list(
+            prefix='B')])
+    self.assertEqual(b'0123456789', self.bucket.file_bytes('B.jpg'))
+    ranged = self.bucket.get_object('B.jpg', byte_range='bytes=2-4')
+    self.assertEqual('bytes 2-4/10', ranged['ContentRange'])
+    self.assertEqual(b'234', ranged['Body'].read())
+    self.assertEqual(
+        b'789', self.bucket.get_object(
+            'B.jpg', byte_range='bytes=-3')['Body'].read())
+    self.assertEqual(b'abc', self.bucket.download_fileobj('A.jpg').read())
+    self.assertEqual({}, self.bucket.delete_many(['A.jpg', 'B.jpg']))
+    self.assertTrue(self.bucket.delete('C.png'))
+    self.assertIsNone(self.bucket.file_bytes('A.jpg'))
+    self.assertEqual([], self.bucket.list())
+
+  def test_presigned_post_goes_to_local_upload(self):
+    presigned = self.bucket.generate_presigned_post(
+        'A.jpg', {'Content-Type': 'image/jpeg'}, [])
+    self.assertEqual(
+        '/local_upload/{}/'.format(self.bucket.name()), presigned['url'])
+    self.assertEqual('A.jpg', presigned['fields']['key'])
+
+
+class MemoryBackendTests(StorageBackendTestsMixin, TestCase):
+  def setUp(self):
+    super().setUp()
+    self.bucket = memory_bucket()
+
+  def test_async_bucket(self):
+    async_bucket = AsyncBucket(self.bucket.bucket_config)
+
+    async def go():
+      await async_bucket.upload_bytes(b'abc', 'A.jpg')
+      self.assertEqual(b'abc', await async_bucket.file_bytes('A.jpg'))
+      self.assertEqual(3, (await async_bucket.head_object('A.jpg')).size)
+      self.assertEqual(
+          ['A.jpg'], [name for name, _ in await async_bucket.list()])
+    asyncio.run(go())
+    self.assertEqual(b'abc', self.bucket.file_bytes('A.jpg'))
+
+
+class LocalDirectoryBackendTests(StorageBackendTestsMixin, TestCase):
+  def setUp(self):
+    super().setUp()
+    self.directory = tempfile.TemporaryDirectory()
+    self.bucket = Bucket(PUBLIC_BUCKET_CONFIG._replace(
+        backend=LOCAL_BACKEND, local_root=self.directory.name))
+
+  def tearDown(self):
+    self.directory.cleanup()
+    super().tearDown()
+
+
+class FileCacheTests(TestCase):
+  def setUp(self):
+    super().setUp()
+    forget_memory_buckets()
+    self.cache = FileCache(10)
+    self.bucket = Bucket(
+        PUBLIC_BUCKET_CONFIG._replace(backend=MEMORY_BACKEND),
+        file_cache=self.cache)
+    self.bucket.upload_fileobj(BytesIO(b'abcd'), 'A.jpg')
+    self.bucket.upload_fileobj(BytesIO(b'efgh'), 'B.jpg')
+    self.bucket.upload_fileobj(BytesIO(b'ijkl'), 'C.jpg')
+
+  def test_hits_revalidate(self):
+    self.assertEqual(b'abcd', self.bucket.file_bytes('A.jpg'))
+    self.assertEqual(b'abcd', self.bucket.file_bytes('A.jpg'))
+    stats = self.cache.stats()
+    self.assertEqual(
+        (1, 1, 4), (stats.misses, stats.revalidations, stats.bytes))
+
+  def test_max_age_skips_revalidation(self):
+    self.cache.max_age = 60
+    self.bucket.file_bytes('A.jpg')
+    self.bucket.file_bytes('A.jpg')
+    self.assertEqual(1, self.cache.stats().hits)
+
+  def test_lru_eviction(self):
+    self.bucket.file_bytes('A.jpg')
+    self.bucket.file_bytes('B.jpg')
+    self.bucket.file_bytes('A.jpg')
+    self.bucket.file_bytes('C.jpg')
+    self.assertEqual(1, self.cache.stats().evictions)
+    self.assertEqual(
+        [(PUBLIC_BUCKET_NAME, 'A.jpg'), (PUBLIC_BUCKET_NAME, 'C.jpg')],
+        list(self.cache.entries))
+
+  def test_upload_and_delete_invalidate(self):
+    self.cache.max_age = 60
+    self.bucket.file_bytes('A.jpg')
+    self.bucket.upload_fileobj(BytesIO(b'mnop'), 'A.jpg')
+    self.assertEqual(b'mnop', self.bucket.file_bytes('A.jpg'))
+    self.bucket.delete('A.jpg')
+    self.assertIsNone(self.bucket.file_bytes('A.jpg'))
+    self.assertEqual(2, self.cache.stats().invalidations)
+
+  def test_disk_tier(self):
+    with tempfile.TemporaryDirectory() as directory:
+      self.bucket.file_cache = FileCache(10, tier=DiskTier(directory))
+      self.bucket.file_bytes('A.jpg')
+      self.assertEqual(b'abcd', self.bucket.file_bytes('A.jpg'))
+      self.assertEqual(1, self.bucket.file_cache.stats().revalidations)
+
+  def test_disk_tier_throws_out_dead_processes(self):
+    with tempfile.TemporaryDirectory() as directory:
+      # Bigger than any pid Linux hands out.
+      dead = os.path.join(directory, '4194305')
+      running = os.path.join(directory, str(os.getppid()))
+      for subdirectory in [dead, running]:
+        os.makedirs(subdirectory)
+      DiskTier(directory)
+      self.assertEqual(
+          sorted([str(os.getpid()), str(os.getppid())]),
+          sorted(os.listdir(directory)))
+
+  def test_async_writes_invalidate(self):
+    self.cache.max_age = 60
+    self.bucket.file_bytes('A.jpg')
+    self.bucket.file_bytes('B.jpg')
+    async_bucket = AsyncBucket(
+        self.bucket.bucket_config, file_cache=self.cache)
+    asyncio.run(async_bucket.upload_bytes(b'mnop', 'A.jpg'))
+    self.assertEqual(b'mnop', self.bucket.file_bytes('A.jpg'))
+    asyncio.run(async_bucket.delete_many(['B.jpg']))
+    self.assertIsNone(self.bucket.file_bytes('B.jpg'))
+    asyncio.run(async_bucket.delete('A.jpg'))
+    self.assertIsNone(self.bucket.file_bytes('A.jpg'))
+    self.assertEqual(3, self.cache.stats().invalidations)
@@ -1,8 +1,14 @@
 from django.urls import path
 
-from djaveS3.views import photo_demo, sign_upload
+from djaveS3.views import (
+    photo_demo, sign_upload, sign_uploads, local_upload, local_download)
 
 
 djave_s3_urls = [
     path('photo_demo/', photo_demo, name='photo_demo'),
-    path('sign_upload/<bucket_name>/', sign_upload, name='sign_upload')]
+    path('sign_upload/<bucket_name>/', sign_upload, name='sign_upload'),
+    path('sign_uploads/<bucket_name>/', sign_uploads, name='sign_uploads'),
+    path('local_upload/<bucket_name>/', local_upload, name='local_upload'),
+    path(
+        'local_download/<bucket_name>/<file_name>/', local_download,
+        name='local_download')]
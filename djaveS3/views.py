@@ -1,15 +1,44 @@
-from django.http import JsonResponse, HttpResponse, Http404
+from collections import OrderedDict
+import re
+import threading
+import time
+
+from botocore.exceptions import ClientError
+from django.conf import settings
+from django.core import signing
+from django.http import (
+    JsonResponse, HttpResponse, HttpResponseRedirect, Http404,
+    StreamingHttpResponse)
 from django.shortcuts import render
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import http_date
+from django.views.decorators.csrf import csrf_exempt
 
 
 from djaveS3.file_types import (
-    suffix_from_file_type, content_type_from_file_name)
-from djaveS3.generate_presigned_post import generate_presigned_post
-from djaveS3.models.bucket import Bucket
+    best_alternate, suffix_from_file_type, content_type_from_file_name)
+from djaveS3.generate_presigned_post import (
+    generate_presigned_post, generate_presigned_posts,
+    async_generate_presigned_post)
+from djaveS3.models.async_bucket import AsyncBucket
+from djaveS3.models.bucket import (
+    Bucket, DEFAULT_CHUNK_SIZE, NO_SUCH_KEY_CODES, client_error_code,
+    iter_body, metadata_from_response)
 from djaveS3.random_string import random_string
+from djaveS3.storage_backends import (
+    LOCAL_DOWNLOAD_SALT, LOCAL_UPLOAD_SALT, RESPONSE_HEADER_PARAMS)
+
+
+# I only handle a single range. Browsers and video players pretty much never
+# ask for more than one, and when they do, RFC 7233 lets me ignore the Range
+# header and just send the whole file.
+SINGLE_BYTE_RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+# _presigned_urls never holds more presigned URLs than this. The ones that
+# were used longest ago get thrown out first.
+PRESIGNED_URL_CACHE_SIZE = 10000
 
 
-def sensitive_file_response(file):
+def sensitive_file_response(file, request=None, bucket=None):
   """ This function is helpful to construct your own views that will return the
   actual bytes for a sensitive image. You need to pass the literal bytes for
   sensitive photos through your server in order to put security checks in front
@@ -19,7 +48,8 @@ def sensitive_file_response(file):
   def view_photo_of_steve(request, file_name):
     if request.user.username != 'Steve':
       raise Exception('Only Steve may look at photos of Steve!')
-    return sensitive_file_response('steves_s3_bucket', file_name)
+    return sensitive_file_response(
+        SteveFile.objects.get(file_name=file_name), request=request)
 
   def steves_page(request):
     return render(
@@ -30,18 +60,240 @@ def sensitive_file_response(file):
   And something like this in steve.html or whatever
 
   <img src="{{ steve_photo_url }}">
+
+  The response carries the file's ETag and Last-Modified, and a Cache-Control
+  header from settings.S3_SENSITIVE_CACHE_CONTROL, which defaults to
+  'private, no-cache'. That means browsers keep the bytes, but they check back
+  every time, so your security checks still run every time. If you pass in the
+  request, browsers that already have the file get a 304 Not Modified after a
+  quick HEAD request to S3, or after no S3 request at all if the FileCache in
+  djaveS3.file_cache knows the file is fresh.
+
+  If the file is a Photo with copies in other formats, like WebP, and the
+  request's Accept header says the browser takes one of those, that's what it
+  gets. See ImageEncoding in djaveS3.bucket_config
   """
+  bucket = bucket or Bucket(_sensitive_bucket_config(file))
+  file_name, vary = _negotiated_file_name(request, file)
+  if request:
+    not_modified = _not_modified_response(request, bucket, file_name)
+    if not_modified:
+      return _vary_on_accept(not_modified, vary)
+  img_bytes, metadata = bucket.file_bytes_and_metadata(file_name)
+  if img_bytes is None:
+    raise Http404()
+  response = HttpResponse(
+      img_bytes, content_type=content_type_from_file_name(file_name))
+  _set_cache_headers(response, metadata)
+  return _vary_on_accept(response, vary)
+
+
+def _negotiated_file_name(request, file):
+  """ (file name to send, whether that depends on the Accept header) """
+  alternates = file.alternate_file_names()
+  if not alternates:
+    return file.stored_file_name(), False
+  content_type = best_alternate(
+      alternates, request.META.get('HTTP_ACCEPT') if request else None)
+  return alternates.get(content_type, file.stored_file_name()), True
+
+
+def _vary_on_accept(response, vary):
+  if vary:
+    patch_vary_headers(response, ['Accept'])
+  return response
+
+
+def streaming_sensitive_file_response(
+    request, file, chunk_size=DEFAULT_CHUNK_SIZE, bucket=None):
+  """ This is just like sensitive_file_response except the bytes go from S3
+  to the browser chunk_size bytes at a time, so it doesn't matter how big the
+  file is, this server only ever holds one chunk of it in memory. It also
+  honors the Range header, so browsers can resume downloads and seek around in
+  videos, and it does the same 304 Not Modified dance as
+  sensitive_file_response.
+
+  def view_video_of_steve(request, file_name):
+    if request.user.username != 'Steve':
+      raise Exception('Only Steve may look at videos of Steve!')
+    return streaming_sensitive_file_response(
+        request, SteveFile.objects.get(file_name=file_name))
+  """
+  bucket = bucket or Bucket(_sensitive_bucket_config(file))
+  file_name = file.stored_file_name()
+  not_modified = _not_modified_response(request, bucket, file_name)
+  if not_modified:
+    return not_modified
+  byte_range = _byte_range(request.META.get('HTTP_RANGE', ''))
+  try:
+    s3_response = bucket.get_object(file_name, byte_range=byte_range)
+  except ClientError as ex:
+    code = client_error_code(ex)
+    if code in NO_SUCH_KEY_CODES:
+      raise Http404()
+    if code == 'InvalidRange':
+      return HttpResponse(status=416)
+    raise ex
+  response = StreamingHttpResponse(
+      iter_body(s3_response['Body'], chunk_size),
+      content_type=content_type_from_file_name(file_name))
+  response['Accept-Ranges'] = 'bytes'
+  if 'ContentLength' in s3_response:
+    response['Content-Length'] = s3_response['ContentLength']
+  if byte_range and s3_response.get('ContentRange'):
+    response.status_code = 206
+    response['Content-Range'] = s3_response['ContentRange']
+  _set_cache_headers(response, metadata_from_response(s3_response))
+  return response
+
+
+# (bucket name, file name, user pk, expires_in) -> (url, expires at), least
+# recently used first.
+_presigned_urls = OrderedDict()
+_presigned_urls_lock = threading.Lock()
+
+
+def sensitive_file_redirect(request, file, expires_in=None, bucket=None):
+  """ Like sensitive_file_response, this goes at the end of your own view,
+  after your security checks. But instead of passing the bytes through this
+  server, it redirects the browser to a presigned S3 URL that expires in
+  expires_in seconds, settings.S3_SENSITIVE_URL_EXPIRES_IN by default, which
+  defaults to 60.
+
+  def view_photo_of_steve(request, file_name):
+    if request.user.username != 'Steve':
+      raise Exception('Only Steve may look at photos of Steve!')
+    return sensitive_file_redirect(
+        request, SteveFile.objects.get(file_name=file_name))
+
+  Each user gets the same URL for a file until it's 3/4 of the way to
+  expiring, so browsers can cache the bytes in the meantime. The
+  Content-Type, Content-Disposition and Cache-Control that S3 sends back are
+  part of the signature, so nobody can use the URL to serve the file as
+  something else. The redirect itself is never cached, so your security
+  checks run every time. """
+  expires_in = expires_in or getattr(
+      settings, 'S3_SENSITIVE_URL_EXPIRES_IN', 60)
+  bucket = bucket or Bucket(_sensitive_bucket_config(file))
+  user = getattr(request, 'user', None)
+  file_name = file.stored_file_name()
+  key = (bucket.name(), file_name, getattr(user, 'pk', None), expires_in)
+  now = time.time()
+  with _presigned_urls_lock:
+    cached = _presigned_urls.get(key)
+    if cached:
+      _presigned_urls.move_to_end(key)
+  if cached and cached[1] - now > expires_in / 4:
+    url = cached[0]
+  else:
+    url = bucket.presigned_url(
+        file_name, expires_in=expires_in,
+        response_headers=_pinned_response_headers(file, expires_in))
+    with _presigned_urls_lock:
+      _presigned_urls[key] = (url, now + expires_in)
+      _presigned_urls.move_to_end(key)
+      while len(_presigned_urls) > PRESIGNED_URL_CACHE_SIZE:
+        _presigned_urls.popitem(last=False)
+  response = HttpResponseRedirect(url)
+  response['Cache-Control'] = 'private, no-store'
+  return response
+
+
+def forget_presigned_urls():
+  with _presigned_urls_lock:
+    _presigned_urls.clear()
+
+
+def _pinned_response_headers(file, expires_in):
+  headers = {
+      'ResponseContentDisposition': 'inline',
+      'ResponseCacheControl': 'private, max-age={}'.format(expires_in)}
+  content_type = content_type_from_file_name(file.stored_file_name())
+  if content_type:
+    headers['ResponseContentType'] = content_type
+  return headers
+
+
+def _not_modified_response(request, bucket, file_name):
+  """ If the browser says which version of the file it already has, and that's
+  still the current version, return a 304. Otherwise return None. """
+  if not _is_conditional(request):
+    return None
+  try:
+    metadata = bucket.head_object(file_name)
+  except ClientError as ex:
+    _raise_404_if_missing(ex)
+  return _not_modified_for_metadata(request, metadata)
+
+
+async def _async_not_modified_response(request, bucket, file_name):
+  """ _not_modified_response for an AsyncBucket. """
+  if not _is_conditional(request):
+    return None
+  try:
+    metadata = await bucket.head_object(file_name)
+  except ClientError as ex:
+    _raise_404_if_missing(ex)
+  return _not_modified_for_metadata(request, metadata)
+
+
+def _is_conditional(request):
+  return bool(
+      request.META.get('HTTP_IF_NONE_MATCH')
+      or request.META.get('HTTP_IF_MODIFIED_SINCE'))
+
+
+def _raise_404_if_missing(ex):
+  if client_error_code(ex) in NO_SUCH_KEY_CODES:
+    raise Http404()
+  raise ex
+
+
+def _not_modified_for_metadata(request, metadata):
+  response = get_conditional_response(
+      request, etag=metadata.etag,
+      last_modified=_timestamp(metadata.last_modified))
+  if response:
+    _set_cache_headers(response, metadata)
+  return response
+
+
+def _set_cache_headers(response, metadata):
+  response['Cache-Control'] = getattr(
+      settings, 'S3_SENSITIVE_CACHE_CONTROL', 'private, no-cache')
+  if metadata.etag:
+    response['ETag'] = metadata.etag
+  if metadata.last_modified:
+    response['Last-Modified'] = http_date(
+        _timestamp(metadata.last_modified))
+
+
+def _timestamp(last_modified):
+  if last_modified:
+    return int(last_modified.timestamp())
+  return None
+
+
+def _sensitive_bucket_config(file):
   bucket_config = file.bucket_config()
   if bucket_config.is_public:
     raise Exception((
         'S3 bucket {} is public, so performance-wise, it is best to just '
         'leave this server out of it entirely and use public_photo_url '
         'in djaveS3.S3 instead.').format(bucket_config.name))
-  img_bytes = Bucket(bucket_config).file_bytes(file.file_name)
-  if img_bytes:
-    return HttpResponse(
-        img_bytes, content_type=content_type_from_file_name(file.file_name))
-  return Http404()
+  return bucket_config
+
+
+def _byte_range(range_header):
+  """ Turn a Range header into something I can hand to S3, or None if I'm
+  going to ignore it. """
+  found = SINGLE_BYTE_RANGE.match(range_header.strip())
+  if not found or found.group(1) == found.group(2) == '':
+    return None
+  start, end = found.group(1), found.group(2)
+  if start and end and int(end) < int(start):
+    return None
+  return 'bytes={}-{}'.format(start, end)
 
 
 def photo_demo(request):
@@ -54,18 +306,137 @@ def sign_upload(request, bucket_name, boto_client=None):
   sign it and say where it goes. """
   file_type = request.GET.get('file_type', '')
   if not file_type:
+    return _missing_file_type_response()
+  destination_file_name = _destination_file_name(file_type)
+  presigned_post = generate_presigned_post(
+      bucket_name, destination_file_name, file_type, boto_client=boto_client)
+
+  return JsonResponse({
+      'presigned_post': presigned_post,
+      'destination_file_name': destination_file_name})
+
+
+def sign_uploads(request, bucket_name, boto_client=None):
+  """ sign_upload for a bunch of files at once, so a user who drops 30 photos
+  into a form doesn't have to wait on 30 requests before the uploads start.
+  Pass one file_type per file, like ?file_type=image/jpeg&file_type=image/png
+  and you get back {'uploads': [{'presigned_post': ...,
+  'destination_file_name': ...}, ...]} in the same order. You can sign up to
+  settings.S3_MAX_UPLOADS_PER_SIGN files at a time, 50 by default. """
+  file_types = [
+      file_type for file_type in request.GET.getlist('file_type')
+      if file_type]
+  if not file_types:
+    return _missing_file_type_response()
+  max_uploads = getattr(settings, 'S3_MAX_UPLOADS_PER_SIGN', 50)
+  if len(file_types) > max_uploads:
     return HttpResponse(
-        'You have to include a file_type parameter in the query string',
+        'You can only sign {} uploads at a time'.format(max_uploads),
         status=400)
-  suffix = suffix_from_file_type(file_type)
-  if not suffix:
-    raise Exception(
-        'Not sure what suffix a {} file is supposed to have'.format(file_type))
+  destination_file_names = [
+      _destination_file_name(file_type) for file_type in file_types]
+  presigned_posts = generate_presigned_posts(
+      bucket_name, list(zip(destination_file_names, file_types)),
+      boto_client=boto_client)
+  return JsonResponse({'uploads': [
+      {'presigned_post': presigned_post,
+       'destination_file_name': destination_file_name}
+      for presigned_post, destination_file_name in zip(
+          presigned_posts, destination_file_names)]})
+
+
+async def async_sensitive_file_response(
+    file, request=None, bucket=None):
+  """ sensitive_file_response for async views, down to the 304s, the cache
+  headers and picking copies in other formats from the Accept header. """
+  bucket = bucket or AsyncBucket(_sensitive_bucket_config(file))
+  file_name, vary = _negotiated_file_name(request, file)
+  if request:
+    not_modified = await _async_not_modified_response(
+        request, bucket, file_name)
+    if not_modified:
+      return _vary_on_accept(not_modified, vary)
+  img_bytes, metadata = await bucket.file_bytes_and_metadata(file_name)
+  if img_bytes is None:
+    raise Http404()
+  response = HttpResponse(
+      img_bytes, content_type=content_type_from_file_name(file_name))
+  _set_cache_headers(response, metadata)
+  return _vary_on_accept(response, vary)
 
-  destination_file_name = '{}.{}'.format(random_string(), suffix)
-  presigned_post = generate_presigned_post(
-      bucket_name, destination_file_name, file_type, boto_client=boto_client)
 
+async def async_sign_upload(request, bucket_name, client=None):
+  """ sign_upload for async views. """
+  file_type = request.GET.get('file_type', '')
+  if not file_type:
+    return _missing_file_type_response()
+  destination_file_name = _destination_file_name(file_type)
+  presigned_post = await async_generate_presigned_post(
+      bucket_name, destination_file_name, file_type, client=client)
   return JsonResponse({
       'presigned_post': presigned_post,
       'destination_file_name': destination_file_name})
+
+
+@csrf_exempt
+def local_upload(request, bucket_name):
+  """ Browsers upload straight to S3, but buckets with a local or memory
+  backend aren't on S3. So for those buckets, sign_upload sends the browser
+  here instead, and this does what S3 would do. """
+  if request.method != 'POST':
+    return HttpResponse(status=405)
+  key = request.POST.get('key', '')
+  try:
+    signed = signing.loads(
+        request.POST.get('signature', ''), salt=LOCAL_UPLOAD_SALT)
+  except signing.BadSignature:
+    return HttpResponse(status=403)
+  if (signed['bucket'], signed['key']) != (bucket_name, key) or (
+      signed['expires'] < time.time()):
+    return HttpResponse(status=403)
+  if 'file' not in request.FILES:
+    return HttpResponse('There is no file', status=400)
+  Bucket(bucket_name).upload_fileobj(
+      request.FILES['file'], key,
+      content_type=request.POST.get('Content-Type', None))
+  return HttpResponse(status=204)
+
+
+def local_download(request, bucket_name, file_name):
+  """ Bucket.presigned_url for a local or memory bucket points here, and this
+  does what S3 would do with a presigned GET. """
+  try:
+    signed = signing.loads(
+        request.GET.get('signature', ''), salt=LOCAL_DOWNLOAD_SALT)
+  except signing.BadSignature:
+    return HttpResponse(status=403)
+  if (signed['bucket'], signed['key']) != (bucket_name, file_name) or (
+      signed['expires'] < time.time()):
+    return HttpResponse(status=403)
+  try:
+    s3_response = Bucket(bucket_name).get_object(file_name)
+  except ClientError as ex:
+    if client_error_code(ex) in NO_SUCH_KEY_CODES:
+      raise Http404()
+    raise ex
+  response = StreamingHttpResponse(
+      iter_body(s3_response['Body']),
+      content_type=s3_response.get('ContentType') or None)
+  for param, header in RESPONSE_HEADER_PARAMS.items():
+    if param in signed['headers']:
+      response[header] = signed['headers'][param]
+  return response
+
+
+def _missing_file_type_response():
+  return HttpResponse(
+      'You have to include a file_type parameter in the query string',
+      status=400)
+
+
+def _destination_file_name(file_type):
+  suffix = suffix_from_file_type(file_type)
+  if not suffix:
+    raise Exception(
+        'Not sure what suffix a {} file is supposed to have'.format(file_type))
+  return '{}.{}'.format(random_string(), suffix)